@@ -0,0 +1,254 @@
+# @file
+# Content addressed cache of intermediate build artifacts
+#
+# Copyright (c) 2019, Intel Corporation. All rights reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+
+import os
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+
+from cryptography.hazmat.primitives import hashes as hashes
+from cryptography.hazmat.backends import default_backend
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+##############################################################################
+#
+# Entries are keyed on a digest of everything the artifact depends on: the
+# data it was made from and the recipe (settings, command line, tool). Each
+# entry is stored in its own file named after the key, the SHA256 of the data
+# followed by the data, so a damaged file is dropped instead of being used.
+# The file times record the last use, so the least recently used entries are
+# removed first once the folder grows over its size limit.
+#
+# The build steps and the in-process compression share the cache instance of
+# this module, which configure() points at another folder.
+#
+# SIIP_CACHE_DIR selects the folder, an empty string only caches in memory.
+# SIIP_CACHE_SIZE is the size limit of the folder in megabytes.
+#
+##############################################################################
+
+CACHE_DIR_ENV = "SIIP_CACHE_DIR"
+CACHE_SIZE_ENV = "SIIP_CACHE_SIZE"
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "siiptool")
+DEFAULT_CACHE_SIZE = 512 * 1024 * 1024
+MEMORY_CACHE_SIZE = 64 * 1024 * 1024
+
+# Size of the SHA256 of the data heading every file
+ENTRY_DIGEST_SIZE = 32
+
+
+def cache_key(*parts):
+    """Digest of a sequence of bytes or strings"""
+
+    digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        digest.update(len(part).to_bytes(8, "little"))
+        digest.update(part)
+    return digest.finalize().hex()
+
+
+def _entry_digest(data):
+    digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
+    digest.update(data)
+    return digest.finalize()
+
+
+class ArtifactCache:
+    """Content addressed cache with least recently used eviction
+
+    Entries are kept in memory, up to memory_bytes, and when cache_dir is
+    set in one file per entry, up to max_bytes.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_CACHE_SIZE,
+                 memory_bytes=MEMORY_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self.entries = OrderedDict()
+        self.memory_used = 0
+        self.disk_used = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    key = staticmethod(cache_key)
+
+    def configure(self, cache_dir, max_bytes=None):
+        """Keep the entries in cache_dir, up to max_bytes when given"""
+
+        with self.lock:
+            self.cache_dir = cache_dir
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self.disk_used = None
+
+    def clear(self):
+        """Forget the entries kept in memory and the hit counts, the files
+        are left to trim()"""
+
+        with self.lock:
+            self.entries.clear()
+            self.memory_used = 0
+            self.hits = 0
+            self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _remember(self, key, data):
+        if len(data) > self.memory_bytes:
+            return
+        with self.lock:
+            if key not in self.entries:
+                self.memory_used += len(data)
+            self.entries[key] = data
+            self.entries.move_to_end(key)
+            while self.memory_used > self.memory_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.memory_used -= len(old)
+
+    def _touch(self, key):
+        # Mark the entry as recently used for the other stitches sharing
+        # the folder
+        if self.cache_dir:
+            try:
+                os.utime(self._path(key))
+            except OSError:
+                pass
+
+    def _load(self, key):
+        if not self.cache_dir:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as cache_file:
+                digest = cache_file.read(ENTRY_DIGEST_SIZE)
+                data = cache_file.read()
+        except OSError:
+            return None
+        if _entry_digest(data) != digest:
+            # Damaged or written by another version, stored again once built
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        self._touch(key)
+        return data
+
+    def _store(self, key, data):
+        size = ENTRY_DIGEST_SIZE + len(data)
+        if not self.cache_dir or size > self.max_bytes:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Concurrent stitches may store the same entry, so write it
+            # under a temporary name and rename it into place
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as cache_file:
+                cache_file.write(_entry_digest(data))
+                cache_file.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+
+        with self.lock:
+            if self.disk_used is not None:
+                self.disk_used += size
+            over = self.disk_used is None or self.disk_used > self.max_bytes
+        if over:
+            self.trim()
+
+    def _disk_entries(self):
+        entries = []
+        for folder, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+        return entries
+
+    def trim(self):
+        """Remove the least recently used files over the size limit"""
+
+        if not self.cache_dir:
+            return
+        entries = sorted(self._disk_entries())
+        used = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if used <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            used -= size
+        with self.lock:
+            self.disk_used = used
+
+    def get(self, key):
+        """Return the data stored under key, or None"""
+
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+        if data is not None:
+            self._touch(key)
+            return data
+
+        data = self._load(key)
+        with self.lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if data is not None:
+            self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        data = bytes(data)
+        self._remember(key, data)
+        self._store(key, data)
+
+    def compute(self, key, producer):
+        """Return the data stored under key, storing producer() if missing"""
+
+        data = self.get(key)
+        if data is None:
+            data = bytes(producer())
+            self.put(key, data)
+        return data
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "memory_bytes": self.memory_used, "disk_bytes": self.disk_used}
+
+
+def cache_size_from_env(default=DEFAULT_CACHE_SIZE):
+    """Size limit given in megabytes by SIIP_CACHE_SIZE"""
+
+    try:
+        return int(float(os.environ[CACHE_SIZE_ENV]) * 1024 * 1024)
+    except (KeyError, ValueError):
+        return default
+
+
+cache = ArtifactCache(os.environ.get(CACHE_DIR_ENV, DEFAULT_CACHE_DIR),
+                      cache_size_from_env())
@@ -0,0 +1,238 @@
+# @file
+# Run a matrix of stitch jobs in a bounded process pool
+#
+# Copyright (c) 2019, Intel Corporation. All rights reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+
+import os
+import sys
+import glob
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+##############################################################################
+#
+# A job matrix is a JSON or YAML dictionary:
+#
+#  "output_dir": folder receiving the stitched images and job logs
+#  "output":     template of the output file name. Fields are {ifwi} (file
+#                name of the base image), {ifwi_stem}, {ip}, {payload_stem}
+#                and {key_stem}
+#  "ifwi":       list of glob patterns of base IFWI images
+#  "payloads":   dictionary of IP name to list of glob patterns of IP files
+#  "keys":       list of glob patterns of private keys for IPs requiring one
+#  "jobs":       list of explicit jobs with "ifwi", "ip", "payload" and
+#                optionally "key" and "output"
+#  "delta":      if true, write deltas against the base images instead of
+#                full images. DELTA_SUFFIX is appended to the output names
+#
+# Every combination of base image, payload and key (when required) becomes
+# one job. Relative paths are relative to the folder of the matrix file.
+##############################################################################
+
+DEFAULT_OUTPUT = "{payload_stem}_{ifwi}"
+DEFAULT_KEY_OUTPUT = "{payload_stem}_{key_stem}_{ifwi}"
+DEFAULT_FANOUT_OUTPUT = "{ifwi_stem}_{ip}.bin"
+DELTA_SUFFIX = ".delta"
+
+
+def load_matrix(filename):
+    """Load a job matrix from a JSON or YAML file"""
+
+    with open(filename, "r") as matrix_file:
+        if filename.lower().endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("PyYAML is required to read {}".format(filename))
+            matrix = yaml.safe_load(matrix_file)
+        else:
+            matrix = json.load(matrix_file)
+
+    if not isinstance(matrix, dict):
+        raise ValueError("{} does not describe a job matrix".format(filename))
+    return matrix
+
+
+def merge_matrix_args(matrix, ifwi_patterns, payload_patterns, key_patterns):
+    """Add glob patterns given from the command line to the matrix"""
+
+    matrix = dict(matrix)
+    matrix["ifwi"] = list(matrix.get("ifwi", [])) + ifwi_patterns
+    payloads = {ip: list(patterns) for ip, patterns in matrix.get("payloads", {}).items()}
+    for arg in payload_patterns:
+        ip, sep, pattern = arg.partition("=")
+        if not sep:
+            raise ValueError("Payload pattern must be given as ipname=pattern: {}".format(arg))
+        payloads.setdefault(ip, []).append(pattern)
+    matrix["payloads"] = payloads
+    matrix["keys"] = list(matrix.get("keys", [])) + key_patterns
+    return matrix
+
+
+def _expand(patterns, base_dir):
+    files = []
+    for pattern in patterns:
+        for name in sorted(glob.glob(os.path.join(base_dir, pattern))):
+            name = os.path.abspath(name)
+            if os.path.isfile(name) and name not in files:
+                files.append(name)
+    return files
+
+
+def _stem(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def output_name(template, job):
+    """Format the output file name template for a job"""
+
+    return template.format(
+        ifwi=os.path.basename(job["ifwi"]),
+        ifwi_stem=_stem(job["ifwi"]),
+        ip=job["ip"],
+        payload_stem=_stem(job["payload"]),
+        key_stem=_stem(job["key"]) if job.get("key") else "",
+    )
+
+
+def expand_jobs(matrix, base_dir, key_required_ips):
+    """Turn a job matrix into a list of jobs"""
+
+    output_dir = os.path.abspath(os.path.join(base_dir, matrix.get("output_dir", "stitch_out")))
+    ifwi_files = _expand(matrix.get("ifwi", []), base_dir)
+    key_files = _expand(matrix.get("keys", []), base_dir)
+
+    jobs = []
+    for ifwi in ifwi_files:
+        for ip, patterns in sorted(matrix.get("payloads", {}).items()):
+            keys = key_files if ip in key_required_ips else [None]
+            if not keys:
+                raise ValueError("No key file found to stitch {}".format(ip))
+            for payload in _expand(patterns, base_dir):
+                for key in keys:
+                    jobs.append({"ifwi": ifwi, "ip": ip, "payload": payload, "key": key})
+
+    for job in matrix.get("jobs", []):
+        job = dict(job)
+        for field in ("ifwi", "payload", "key"):
+            if job.get(field):
+                job[field] = os.path.abspath(os.path.join(base_dir, job[field]))
+        jobs.append(job)
+
+    template = matrix.get("output")
+
+    outputs = set()
+    for job in jobs:
+        missing = [f for f in ("ifwi", "ip", "payload") if not job.get(f)]
+        if missing:
+            raise ValueError("Job is missing {}: {}".format(", ".join(missing), job))
+        if job.get("ip") in key_required_ips and not job.get("key"):
+            raise ValueError("Job requires a private key: {}".format(job))
+        if not job.get("output"):
+            if template is not None:
+                name = template
+            elif job.get("key") and len(key_files) > 1:
+                name = DEFAULT_KEY_OUTPUT
+            else:
+                name = DEFAULT_OUTPUT
+            job["output"] = output_name(name, job)
+            if matrix.get("delta"):
+                job["output"] += DELTA_SUFFIX
+        job["delta"] = bool(matrix.get("delta"))
+        job["output"] = os.path.abspath(os.path.join(output_dir, job["output"]))
+        if job["output"] in outputs:
+            raise ValueError("More than one job writes {}".format(job["output"]))
+        outputs.add(job["output"])
+        job["log"] = os.path.splitext(job["output"])[0] + ".log"
+
+    return jobs
+
+
+@contextmanager
+def redirect_output(logfile):
+    """Send stdout and stderr of this process and its children to logfile"""
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    try:
+        with open(logfile, "w") as log:
+            os.dup2(log.fileno(), 1)
+            os.dup2(log.fileno(), 2)
+            try:
+                yield
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+    finally:
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in saved:
+            os.close(fd)
+
+
+def _timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def run_jobs(jobs, worker, prepare=None, max_workers=None):
+    """Run jobs with worker in a process pool and return a summary.
+
+    prepare(ifwi) is called once per distinct base image, in the pool, and its
+    result is handed to every job using that base as job["fv_layout"].
+    worker(job) returns 0 on success.
+    """
+
+    start = time.perf_counter()
+    for job in jobs:
+        os.makedirs(os.path.dirname(job["output"]), exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        layouts = {}
+        if prepare is not None:
+            bases = sorted({job["ifwi"] for job in jobs})
+            for ifwi, layout in zip(bases, pool.map(prepare, bases)):
+                layouts[ifwi] = layout
+
+        futures = []
+        for job in jobs:
+            if layouts.get(job["ifwi"]) is not None:
+                job = dict(job, fv_layout=layouts[job["ifwi"]])
+            futures.append(pool.submit(_timed, worker, job))
+
+        results = []
+        for job, future in zip(jobs, futures):
+            try:
+                status, seconds = future.result()
+                error = None
+            except Exception as exc:
+                status, seconds, error = 1, None, str(exc)
+            result = {k: job.get(k) for k in ("ifwi", "ip", "payload", "key", "output", "log")}
+            result["delta"] = bool(job.get("delta"))
+            result["status"] = "ok" if status == 0 else "failed"
+            result["returncode"] = status
+            result["seconds"] = seconds
+            if error:
+                result["error"] = error
+            results.append(result)
+
+    succeeded = sum(1 for r in results if r["status"] == "ok")
+    return {
+        "jobs": results,
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def write_summary(summary, filename):
+    with open(filename, "w") as summary_file:
+        json.dump(summary, summary_file, indent=2)
@@ -0,0 +1,99 @@
+# @file
+# EDK2 compatible LZMA compression of GUIDed sections
+#
+# Copyright (c) 2019, Intel Corporation. All rights reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+
+import os
+import sys
+import lzma
+import struct
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import artifact_cache
+
+##############################################################################
+#
+# LzmaCompress from EDK2 stores the data as a 13 bytes header followed by a
+# raw LZMA1 stream. The header holds the properties byte ((pb * 5 + lp) * 9
+# + lc), the dictionary size and the uncompressed size (all little endian).
+# The settings below are the ones used by "LzmaCompress -e" so the firmware
+# decoder and FMMT read the sections produced here. The LZMA stream is not
+# byte-identical to the one of the tool, only decoded to the same data.
+#
+##############################################################################
+
+LZMA_HEADER = struct.Struct("<BIQ")
+LZMA_LC = 3
+LZMA_LP = 0
+LZMA_PB = 2
+LZMA_DICT_SIZE = 1 << 24
+LZMA_PRESET = 5
+
+
+def lzma_compress(data):
+    """Compress data with the settings of "LzmaCompress -e", which decodes
+    it, the output is not byte-identical to the one of the tool"""
+
+    filters = [{
+        "id": lzma.FILTER_LZMA1,
+        "preset": LZMA_PRESET,
+        "dict_size": LZMA_DICT_SIZE,
+        "lc": LZMA_LC,
+        "lp": LZMA_LP,
+        "pb": LZMA_PB,
+    }]
+    props = (LZMA_PB * 5 + LZMA_LP) * 9 + LZMA_LC
+    header = LZMA_HEADER.pack(props, LZMA_DICT_SIZE, len(data))
+    return header + lzma.compress(data, format=lzma.FORMAT_RAW, filters=filters)
+
+
+def lzma_decompress(data):
+    """Decompress data produced by lzma_compress() or "LzmaCompress -e" """
+
+    if len(data) < LZMA_HEADER.size:
+        raise ValueError("LZMA data is truncated")
+    props, dict_size, size = LZMA_HEADER.unpack_from(data)
+    if props >= 9 * 5 * 5:
+        raise ValueError("Bad LZMA properties {:#x}".format(props))
+
+    filters = [{
+        "id": lzma.FILTER_LZMA1,
+        "dict_size": max(dict_size, 4096),
+        "lc": props % 9,
+        "lp": (props // 9) % 5,
+        "pb": props // 45,
+    }]
+    decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=filters)
+    result = decompressor.decompress(bytes(data[LZMA_HEADER.size:]), size)
+    if len(result) != size:
+        raise ValueError("LZMA data is truncated")
+    return result
+
+
+def cached_compress(method, data, compressor, cache=None):
+    """Return compressor(data), computing it only for new data
+
+    The result is kept in cache, the artifact cache of the build steps by
+    default, keyed on the data and method, the compression settings.
+    """
+
+    if cache is None:
+        cache = artifact_cache.cache
+    return cache.compute(cache.key(method, data), lambda: compressor(data))
+
+# Settings of the compressors, part of the cache key
+LZMA_METHOD = "lzma:{}:{}:{}:{}:{}".format(LZMA_LC, LZMA_LP, LZMA_PB, LZMA_DICT_SIZE, LZMA_PRESET)
+
+
+def lzma_compress_file(inputfile, outputfile):
+    """Compress inputfile as outputfile with lzma_compress(), in place of
+    "LzmaCompress -e". Returns 0"""
+
+    with open(inputfile, "rb") as in_fd:
+        data = in_fd.read()
+    with open(outputfile, "wb") as out_fd:
+        out_fd.write(cached_compress(LZMA_METHOD, data, lzma_compress))
+    return 0
@@ -0,0 +1,239 @@
+# @file
+# Binary delta of a stitched image against its base image
+#
+# Copyright (c) 2019, Intel Corporation. All rights reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+
+import os
+import sys
+import mmap
+from contextlib import contextmanager
+from ctypes import Structure
+from ctypes import c_char, c_uint32, c_uint64, c_uint8, sizeof, ARRAY
+
+from cryptography.hazmat.primitives import hashes as hashes
+from cryptography.hazmat.backends import default_backend
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import utilities as utils
+
+##############################################################################
+#
+# A delta file is a DELTA_HEADER followed by NumRanges DELTA_RANGE entries,
+# each one directly followed by Length bytes to be written at Offset of the
+# base image. The result is truncated or extended to ResultSize. SHA256 of
+# the base image and of the result are used to check the delta is applied
+# to the right image and produced the expected one.
+#
+##############################################################################
+
+DELTA_SIGNATURE = b"SIIPDLTA"
+DELTA_VERSION = 1
+
+# Size of the blocks compared in one go when looking for changed ranges
+DIFF_BLOCK_SIZE = 0x10000
+DIFF_SUBBLOCK_SIZE = 0x100
+
+# Changed ranges closer than this are stored as one range
+DIFF_MERGE_GAP = 16
+
+
+class DELTA_HEADER(Structure):
+    _pack_ = 1
+    _fields_ = [
+        ("Signature", ARRAY(c_char, 8)),
+        ("Version", c_uint32),
+        ("NumRanges", c_uint32),
+        ("BaseSize", c_uint64),
+        ("ResultSize", c_uint64),
+        ("BaseHash", ARRAY(c_uint8, 32)),
+        ("ResultHash", ARRAY(c_uint8, 32)),
+    ]
+
+
+class DELTA_RANGE(Structure):
+    _pack_ = 1
+    _fields_ = [
+        ("Offset", c_uint64),
+        ("Length", c_uint32),
+    ]
+
+
+class DeltaError(Exception):
+    """Delta cannot be applied to the given image"""
+
+
+def sha256(data):
+    """Return SHA256 of a bytes-like object"""
+
+    digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
+    digest.update(data)
+    return digest.finalize()
+
+
+def _differing_span(old, new):
+    """Return the (start, end) of the differing bytes of two small blocks.
+
+    The first and last differing bytes are found by bisecting on slice
+    compares, the bytes are never looked at one by one.
+    """
+
+    size = len(old)
+    equal, differ = 0, size
+    while differ - equal > 1:
+        mid = (equal + differ) // 2
+        if old[:mid] == new[:mid]:
+            equal = mid
+        else:
+            differ = mid
+    start = differ - 1
+
+    equal, differ = 0, size - start
+    while differ - equal > 1:
+        mid = (equal + differ) // 2
+        if old[size - mid:] == new[size - mid:]:
+            equal = mid
+        else:
+            differ = mid
+    return start, size - equal
+
+
+def diff_ranges(old, new, merge_gap=DIFF_MERGE_GAP):
+    """Return the list of (offset, length) ranges where new differs from old.
+
+    old and new are bytes-like objects or mmaps, whose unchanged blocks are
+    not kept in memory. A changed sub-block is reported from its first to
+    its last differing byte. Bytes past the end of old are reported as
+    changed.
+    """
+
+    ranges = []
+
+    def add(offset, length):
+        if ranges and offset - (ranges[-1][0] + ranges[-1][1]) <= merge_gap:
+            last_offset, _ = ranges[-1]
+            ranges[-1] = (last_offset, offset + length - last_offset)
+        else:
+            ranges.append((offset, length))
+
+    common = min(len(old), len(new))
+    for blk in range(0, common, DIFF_BLOCK_SIZE):
+        blk_end = min(blk + DIFF_BLOCK_SIZE, common)
+        if old[blk:blk_end] == new[blk:blk_end]:
+            utils.release_pages(old, blk, blk_end - blk)
+            utils.release_pages(new, blk, blk_end - blk)
+            continue
+        for sub in range(blk, blk_end, DIFF_SUBBLOCK_SIZE):
+            sub_end = min(sub + DIFF_SUBBLOCK_SIZE, blk_end)
+            old_sub = old[sub:sub_end]
+            new_sub = new[sub:sub_end]
+            if old_sub == new_sub:
+                continue
+            start, end = _differing_span(old_sub, new_sub)
+            add(sub + start, end - start)
+
+    if len(new) > common:
+        add(common, len(new) - common)
+
+    return ranges
+
+
+def merge_ranges(*range_lists):
+    """Return the sorted (offset, length) ranges covering all range_lists,
+    overlapping and adjacent ranges being merged"""
+
+    merged = []
+    for offset, length in sorted(rng for ranges in range_lists for rng in ranges):
+        if merged and offset <= merged[-1][0] + merged[-1][1]:
+            last_offset, last_length = merged[-1]
+            merged[-1] = (last_offset, max(last_length, offset + length - last_offset))
+        else:
+            merged.append((offset, length))
+    return merged
+
+
+@contextmanager
+def map_file(filename):
+    """Map a file read-only, empty files are given as empty bytes"""
+
+    with open(filename, "rb") as fd:
+        if os.fstat(fd.fileno()).st_size == 0:
+            yield b""
+        else:
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield mapped
+
+
+def make_delta(base_file, result_file, delta_file):
+    """Write the delta turning base_file into result_file.
+
+    Returns the list of changed ranges.
+    """
+
+    with map_file(base_file) as base, map_file(result_file) as result:
+        ranges = diff_ranges(base, result)
+
+        hdr = DELTA_HEADER()
+        hdr.Signature = DELTA_SIGNATURE
+        hdr.Version = DELTA_VERSION
+        hdr.NumRanges = len(ranges)
+        hdr.BaseSize = len(base)
+        hdr.ResultSize = len(result)
+        hdr.BaseHash[:] = sha256(base)
+        hdr.ResultHash[:] = sha256(result)
+
+        with open(delta_file, "wb") as delta_fd:
+            delta_fd.write(hdr)
+            for offset, length in ranges:
+                delta_fd.write(DELTA_RANGE(offset, length))
+                delta_fd.write(result[offset:offset + length])
+
+    return ranges
+
+
+def read_delta(delta_file):
+    """Return the header and the list of (offset, data) of a delta file"""
+
+    with open(delta_file, "rb") as delta_fd:
+        data = delta_fd.read()
+
+    if len(data) < sizeof(DELTA_HEADER):
+        raise DeltaError("{} is not a delta file".format(delta_file))
+    hdr = DELTA_HEADER.from_buffer_copy(data)
+    if hdr.Signature != DELTA_SIGNATURE or hdr.Version != DELTA_VERSION:
+        raise DeltaError("{} is not a delta file".format(delta_file))
+
+    ranges = []
+    offset = sizeof(DELTA_HEADER)
+    for _ in range(hdr.NumRanges):
+        rng = DELTA_RANGE.from_buffer_copy(data, offset)
+        offset += sizeof(DELTA_RANGE)
+        chunk = data[offset:offset + rng.Length]
+        if len(chunk) != rng.Length:
+            raise DeltaError("{} is truncated".format(delta_file))
+        ranges.append((rng.Offset, chunk))
+        offset += rng.Length
+
+    return hdr, ranges
+
+
+def apply_delta(base_file, delta_file, out_file):
+    """Recreate the stitched image out_file from base_file and a delta"""
+
+    if os.path.exists(out_file) and os.path.samefile(base_file, out_file):
+        raise DeltaError("{} is the base image, cannot overwrite it".format(out_file))
+
+    hdr, ranges = read_delta(delta_file)
+
+    with map_file(base_file) as base:
+        if len(base) != hdr.BaseSize or sha256(base) != bytes(hdr.BaseHash):
+            raise DeltaError("{} is not the base image of {}".format(base_file, delta_file))
+
+    utils.clone_file(base_file, out_file)
+    utils.patch_file(out_file, ranges, hdr.ResultSize)
+
+    with map_file(out_file) as result:
+        if sha256(result) != bytes(hdr.ResultHash):
+            raise DeltaError("{} does not match the expected result".format(out_file))
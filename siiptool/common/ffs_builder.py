@@ -0,0 +1,195 @@
+# @file
+# In-process build of the firmware file of an IP, like GenSec and GenFfs
+#
+# Copyright (c) 2019, Intel Corporation. All rights reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+
+import os
+import sys
+import uuid
+import shutil
+import tempfile
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import compression
+from common import subregion_image as sbrgn_image
+from common import utilities as utils
+from common.ffs_replace import FFS_DATA_ALIGNMENT, FFS_HEADER_SIZE, file_header
+from common.firmware_volume import EFI_FV_FILETYPE, EFI_SECTION_TYPE, align
+from common.siip_constants import IP_OPTIONS
+
+##############################################################################
+#
+# The recipes of IP_OPTIONS are built here the way the command lines of
+# subregion_image.build_command_list() build them with GenSec, LzmaCompress
+# and GenFfs. The sections and files are the same bytes as the ones of
+# GenSec and GenFfs:
+#
+#  - sections are a 4 bytes header (24 bits size, type) and their data, a
+#    user interface section holding the NUL terminated UTF-16 name
+#  - None merges the sections built so far, each aligned on 4 bytes
+#  - a GUIDed section adds the GUID, the data offset and its attributes
+#  - the file header holds the GUID, a header checksum, the fixed 0xAA file
+#    checksum, the type, the alignment attribute, the size and the state
+#
+# Steps without an in-process equivalent (EFI_SECTION_COMPRESSION, section
+# alignment, LzmaCompress options other than -e) are built with the tools in
+# a temporary folder.
+#
+# The compressed data is equivalent but not byte-identical to the output of
+# LzmaCompress: "lzma -e" steps use compression.lzma_compress(), with the
+# settings of "LzmaCompress -e" and decoded by "LzmaCompress -d", in both
+# build_recipe() and build_with_tools().
+#
+##############################################################################
+
+SECTION_TYPES = {
+    "ui": EFI_SECTION_TYPE.USER_INTERFACE,
+    "raw": EFI_SECTION_TYPE.RAW,
+    "pe32": EFI_SECTION_TYPE.PE32,
+    "depex": EFI_SECTION_TYPE.PEI_DEPEX,
+}
+
+FILE_TYPES = {
+    "free": EFI_FV_FILETYPE.FREEFORM,
+    "gop": EFI_FV_FILETYPE.DRIVER,
+    "peim": EFI_FV_FILETYPE.PEIM,
+}
+
+GUIDED_ATTRIBUTES = {
+    "PROCESSING_REQUIRED": 0x01,
+    "AUTH_STATUS_VALID": 0x02,
+}
+
+SECTION_HEADER_SIZE = 4
+GUIDED_HEADER_SIZE = SECTION_HEADER_SIZE + 20
+MAX_SECTION_SIZE = 0xFFFFFF
+FILE_STATE = 0x07
+
+
+class FfsBuildError(Exception):
+    """The firmware file cannot be built in-process"""
+
+
+def section(stype, data):
+    """Return a section of type stype holding data"""
+
+    size = SECTION_HEADER_SIZE + len(data)
+    if size >= MAX_SECTION_SIZE:
+        raise FfsBuildError("Section of {} bytes needs an extended header".format(size))
+    return size.to_bytes(3, "little") + bytes([stype]) + bytes(data)
+
+
+def ui_section(name):
+    return section(EFI_SECTION_TYPE.USER_INTERFACE, name.encode("utf-16le") + b"\0\0")
+
+
+def merge_sections(sections):
+    """Return the sections one after the other, each aligned on 4 bytes"""
+
+    merged = bytearray()
+    for sec in sections:
+        merged += bytes(align(len(merged), 4) - len(merged))
+        merged += sec
+    return bytes(merged)
+
+
+def guid_section(guid, data, attributes):
+    """Return a GUIDed section holding data"""
+
+    size = GUIDED_HEADER_SIZE + len(data)
+    if size >= MAX_SECTION_SIZE:
+        raise FfsBuildError("Section of {} bytes needs an extended header".format(size))
+    if attributes not in GUIDED_ATTRIBUTES:
+        raise FfsBuildError("Unknown GUIDed section attribute {}".format(attributes))
+    return (size.to_bytes(3, "little") + bytes([EFI_SECTION_TYPE.GUID_DEFINED])
+            + uuid.UUID(guid).bytes_le + GUIDED_HEADER_SIZE.to_bytes(2, "little")
+            + GUIDED_ATTRIBUTES[attributes].to_bytes(2, "little") + bytes(data))
+
+
+def alignment_attribute(alignment):
+    """Return the file attribute bits of an alignment given like "1K" """
+
+    if alignment is None:
+        return 0
+    size = int(alignment[:-1]) * 1024 if alignment.upper().endswith("K") else int(alignment)
+    if size not in FFS_DATA_ALIGNMENT:
+        raise FfsBuildError("File alignment {} is not supported in-process".format(alignment))
+    return FFS_DATA_ALIGNMENT.index(size) << 3
+
+
+def ffs_file(ftype, guid, data, alignment=None):
+    """Return a firmware file of type ftype holding the sections data"""
+
+    if FFS_HEADER_SIZE + len(data) >= MAX_SECTION_SIZE:
+        raise FfsBuildError("File of {} bytes needs an extended header".format(len(data)))
+    header = bytearray(uuid.UUID(guid).bytes_le + bytes(FFS_HEADER_SIZE - 16))
+    header[18] = ftype
+    header[19] = alignment_attribute(alignment)
+    header[23] = FILE_STATE
+    return bytes(file_header(header, data)) + bytes(data)
+
+
+def build_recipe(build_list, payload):
+    """Return the firmware file built from payload following build_list"""
+
+    ui = None
+    data = bytes(payload)
+    for instr in build_list:
+        kind = instr[0]
+        if kind == "ui":
+            ui = ui_section(instr[1])
+        elif kind in SECTION_TYPES:
+            data = section(SECTION_TYPES[kind], data)
+        elif kind is None:
+            if len(instr) > 1:
+                raise FfsBuildError("Section alignment is not supported in-process")
+            data = merge_sections([data, ui])
+        elif kind == "lzma":
+            if instr[1] != "-e":
+                raise FfsBuildError("LZMA option {} is not supported in-process".format(instr[1]))
+            data = compression.cached_compress(compression.LZMA_METHOD, data,
+                                               compression.lzma_compress)
+        elif kind == "guid":
+            data = guid_section(instr[1], data, instr[2])
+        elif kind in FILE_TYPES:
+            _, guid, alignment = instr
+            data = ffs_file(FILE_TYPES[kind], guid, data, alignment)
+        else:
+            raise FfsBuildError("Build step {} is not supported in-process".format(kind))
+    return data
+
+
+def build_with_tools(log, ipname, payload):
+    """Return the firmware file of ipname built from payload with the tools"""
+
+    workdir = tempfile.mkdtemp(prefix="siip_ffs_")
+    try:
+        ip_file = os.path.join(workdir, "payload.bin")
+        with open(ip_file, "wb") as ip_fd:
+            ip_fd.write(payload)
+        inputfiles, num_replace_files = sbrgn_image.ip_inputfiles([None, ip_file], ipname)
+        cmds = sbrgn_image.build_command_list(IP_OPTIONS.get(ipname), inputfiles,
+                                              num_replace_files)
+        if utils.execute_cmds(log, cmds, cwd=workdir) != 0:
+            raise FfsBuildError("Building the firmware file of {} failed".format(ipname))
+        with open(os.path.join(workdir, "tmp.ffs"), "rb") as ffs_fd:
+            return ffs_fd.read()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def build(log, ipname, payload):
+    """Return the firmware file of ipname holding payload
+
+    It is built in-process when the recipe allows it, with the tools
+    otherwise.
+    """
+
+    try:
+        return build_recipe(IP_OPTIONS.get(ipname), payload)
+    except FfsBuildError as err:
+        log.info("Building firmware file of {} with the tools: {}".format(ipname, err))
+    return build_with_tools(log, ipname, payload)
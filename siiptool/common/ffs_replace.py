@@ -0,0 +1,635 @@
+# @file
+# Replace a firmware file of an image in place, without FMMT
+#
+# Copyright (c) 2019, Intel Corporation. All rights reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+
+import os
+import sys
+import mmap
+import uuid
+import struct
+from collections import OrderedDict
+from ctypes import sizeof
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import delta
+from common import guided_tools
+from common import utilities as utils
+from common.firmware_volume import (
+    EFI_FIRMWARE_VOLUME_HEADER,
+    EFI_FFS_FILE_HEADER,
+    EFI_FV_FILETYPE,
+    EFI_SECTION_TYPE,
+    FFS_ATTRIB_CHECKSUM,
+    FFS_FIXED_CHECKSUM,
+    align,
+    scan_volumes,
+    section_cache,
+    fv_is_valid,
+)
+
+##############################################################################
+#
+# The file is looked up by its UI name through all firmware volumes of the
+# image, including volumes inside FV image sections and inside the GUIDed
+# sections having an in-process tool (LZMA and RSA2048SHA256SIGN).
+#
+# The volumes keep their size and position: the new file takes the place of
+# the old one, together with the pad files and free space following it. The
+# encapsulating sections and files are rebuilt around the new content and
+# placed the same way in their own volume. When a file does not fit, or the
+# image has a layout not handled here, NativeReplaceError is raised so the
+# caller can fall back to FMMT.
+#
+##############################################################################
+
+GUID_FFS2 = uuid.UUID("8C8CE578-8A3D-4F1C-9935-896185C32DD3").bytes_le
+GUID_FFS3 = uuid.UUID("5473C07A-3DCB-4DCA-BD6F-1E9689E7349A").bytes_le
+
+EFI_FVB2_ERASE_POLARITY = 0x00000800
+
+FFS_ATTRIB_LARGE_FILE = 0x01
+FFS_ATTRIB_DATA_ALIGNMENT_2 = 0x02
+FFS_ATTRIB_DATA_ALIGNMENT = 0x38
+FFS_HEADER_SIZE = sizeof(EFI_FFS_FILE_HEADER)
+FFS_HEADER2_SIZE = FFS_HEADER_SIZE + 8
+FFS_MAX_SIZE = 0xFFFFFF
+
+FFS_DATA_ALIGNMENT = [1, 16, 128, 512, 1024, 4 * 1024, 32 * 1024, 64 * 1024]
+FFS_DATA_ALIGNMENT_2 = [128 * 1024, 256 * 1024, 512 * 1024, 1024 * 1024,
+                        2048 * 1024, 4096 * 1024, 8192 * 1024, 16384 * 1024]
+
+EFI_GUIDED_SECTION_PROCESSING_REQUIRED = 0x01
+SECTION_HEADER_SIZE = 4
+SECTION_HEADER2_SIZE = 8
+# SectionDefinitionGuid, DataOffset and Attributes of a GUIDed section
+GUIDED_SECTION_FIELDS_SIZE = 20
+
+# Sections which may have to stay at an aligned offset within their file
+ALIGNED_SECTIONS = (
+    EFI_SECTION_TYPE.PE32,
+    EFI_SECTION_TYPE.PIC,
+    EFI_SECTION_TYPE.TE,
+    EFI_SECTION_TYPE.FIRMWARE_VOLUME_IMAGE,
+)
+
+
+class NativeReplaceError(Exception):
+    """The file cannot be replaced without FMMT"""
+
+
+def _u24(data, offset):
+    return data[offset] | (data[offset + 1] << 8) | (data[offset + 2] << 16)
+
+
+def _sum8(data):
+    return sum(data) & 0xFF
+
+
+def find_fvs(data):
+    """Yield (offset, length) of the top level firmware volumes of data"""
+
+    # The pages of a map are released once scanned
+    return scan_volumes(data, release=lambda offset, length: utils.release_pages(
+        data, offset, length))
+
+
+class _FfsFile:
+    """Location of a file, pad file or free space within a volume"""
+
+    def __init__(self, offset, size, header_size=0, ftype=None, attributes=0):
+        self.offset = offset
+        self.size = size
+        self.header_size = header_size
+        self.type = ftype
+        self.attributes = attributes
+
+    @property
+    def end(self):
+        return self.offset + self.size
+
+    @property
+    def is_free(self):
+        return self.type is None
+
+    @property
+    def is_pad(self):
+        return self.type == EFI_FV_FILETYPE.FFS_PAD
+
+
+def file_alignment(attributes):
+    """Required alignment of the data of a file with the given attributes"""
+
+    index = (attributes & FFS_ATTRIB_DATA_ALIGNMENT) >> 3
+    if attributes & FFS_ATTRIB_DATA_ALIGNMENT_2:
+        return FFS_DATA_ALIGNMENT_2[index]
+    return FFS_DATA_ALIGNMENT[index]
+
+
+def fv_files(fv):
+    """Return the files of a volume, ending with its free space if any"""
+
+    fvh = EFI_FIRMWARE_VOLUME_HEADER.from_buffer_copy(fv)
+    erased = b"\xff" if fvh.Attributes & EFI_FVB2_ERASE_POLARITY else b"\x00"
+    if fvh.ExtHeaderOffset:
+        ext_size = struct.unpack_from("<I", fv, fvh.ExtHeaderOffset + 16)[0]
+        offset = fvh.ExtHeaderOffset + ext_size
+    else:
+        offset = fvh.HeaderLength
+
+    files = []
+    offset = align(offset)
+    while offset + FFS_HEADER_SIZE <= len(fv):
+        if fv[offset:offset + FFS_HEADER_SIZE] == erased * FFS_HEADER_SIZE:
+            # Free space lasts up to the end of the volume or up to the
+            # volume top file
+            end = (len(fv) - len(bytes(fv[offset:]).lstrip(erased))) & ~7
+            files.append(_FfsFile(offset, end - offset))
+            offset = end
+            continue
+
+        ftype, attributes = fv[offset + 18], fv[offset + 19]
+        size = _u24(fv, offset + 20)
+        header_size = FFS_HEADER_SIZE
+        if attributes & FFS_ATTRIB_LARGE_FILE and bytes(fvh.FileSystemGuid) == GUID_FFS3:
+            size = struct.unpack_from("<Q", fv, offset + FFS_HEADER_SIZE)[0]
+            header_size = FFS_HEADER2_SIZE
+        if size < header_size or offset + size > len(fv):
+            raise NativeReplaceError("Bad file size at {:x}".format(offset))
+
+        files.append(_FfsFile(offset, size, header_size, ftype, attributes))
+        offset = align(offset + size)
+
+    return files
+
+
+def sections(data):
+    """Yield (offset, size, header_size, type) of the sections of data"""
+
+    offset = 0
+    while offset + SECTION_HEADER_SIZE <= len(data):
+        size = _u24(data, offset)
+        header_size = SECTION_HEADER_SIZE
+        if size == FFS_MAX_SIZE:
+            size = struct.unpack_from("<I", data, offset + 4)[0]
+            header_size = SECTION_HEADER2_SIZE
+        if size < header_size or offset + size > len(data):
+            raise NativeReplaceError("Bad section size at {:x}".format(offset))
+        yield offset, size, header_size, data[offset + 3]
+        offset = align(offset + size, 4)
+
+
+def guided_payload(section, header_size):
+    """Return the GUID, data offset, processing flag and decoded data of a
+    GUIDed section
+
+    The data is None if it needs a tool not available in-process. Decoded
+    data is shared through section_cache with the other readers of the image.
+    """
+
+    guid = section[header_size:header_size + 16]
+    data_offset, attributes = struct.unpack_from("<HH", section, header_size + 16)
+    processed = bool(attributes & EFI_GUIDED_SECTION_PROCESSING_REQUIRED)
+    if not header_size + GUIDED_SECTION_FIELDS_SIZE <= data_offset <= len(section):
+        return guid, data_offset, processed, None
+    payload = section[data_offset:]
+    if processed:
+        try:
+            payload = section_cache.decode(guid, payload, guided_tools.decode)
+        except guided_tools.GuidedToolError:
+            payload = None
+    return guid, data_offset, processed, payload
+
+
+def ui_name(body):
+    """Return the UI name of a file given its sections
+
+    Like FMMT, the UI section is also looked for in GUIDed sections.
+    """
+
+    guided = []
+    for offset, size, header_size, stype in sections(body):
+        if stype == EFI_SECTION_TYPE.USER_INTERFACE:
+            return bytes(body[offset + header_size:offset + size]).decode(
+                "utf-16le", "ignore").rstrip("\0")
+        if stype == EFI_SECTION_TYPE.GUID_DEFINED:
+            guided.append((body[offset:offset + size], header_size))
+
+    for section, header_size in guided:
+        payload = guided_payload(section, header_size)[3]
+        if payload is not None:
+            try:
+                name = ui_name(payload)
+            except NativeReplaceError:
+                continue
+            if name is not None:
+                return name
+    return None
+
+
+def _set_section_size(header, size):
+    header = bytearray(header)
+    if len(header) >= SECTION_HEADER2_SIZE and _u24(header, 0) == FFS_MAX_SIZE:
+        struct.pack_into("<I", header, 4, size)
+    elif size < FFS_MAX_SIZE:
+        header[0:3] = size.to_bytes(3, "little")
+    else:
+        raise NativeReplaceError("Section too large for its header")
+    return header
+
+
+def file_header(header, body):
+    """Update size and checksums of a copy of a file header for body"""
+
+    header = bytearray(header)
+    size = len(header) + len(body)
+    if len(header) == FFS_HEADER2_SIZE:
+        struct.pack_into("<Q", header, FFS_HEADER_SIZE, size)
+    elif size < FFS_MAX_SIZE:
+        header[20:23] = size.to_bytes(3, "little")
+    else:
+        raise NativeReplaceError("File too large for its header")
+
+    state = header[23]
+    header[16] = header[17] = header[23] = 0
+    header[16] = (0x100 - _sum8(header)) & 0xFF
+    if header[19] & FFS_ATTRIB_CHECKSUM:
+        header[17] = (0x100 - _sum8(body)) & 0xFF
+    else:
+        header[17] = FFS_FIXED_CHECKSUM
+    header[23] = state
+    return header
+
+
+def pad_file(size, state, erased):
+    """Return a pad file of size bytes"""
+
+    header = bytearray(b"\xff" * 16) + bytearray(FFS_HEADER_SIZE - 16)
+    header[18] = EFI_FV_FILETYPE.FFS_PAD
+    header[23] = state
+    body = erased * (size - FFS_HEADER_SIZE)
+    return bytes(file_header(header, body)) + body
+
+
+class _Replacer:
+    """Walks the volumes of an image, replacing the files of UI name
+
+    When ffs is None the files are only collected in found. When name is
+    None as well, the UI names of all files are collected in names.
+    """
+
+    def __init__(self, name, ffs, key_file):
+        self.name = name
+        self.ffs = ffs
+        self.key_file = key_file
+        self.matches = 0
+        self.found = []
+        self.names = []
+        self.skipped = 0
+        self.undecoded = 0
+
+    def fv(self, fv):
+        """Return the volume with the file replaced, None if not found in it"""
+
+        fvh = EFI_FIRMWARE_VOLUME_HEADER.from_buffer_copy(fv)
+        if bytes(fvh.FileSystemGuid) not in (GUID_FFS2, GUID_FFS3):
+            return None
+        erased = b"\xff" if fvh.Attributes & EFI_FVB2_ERASE_POLARITY else b"\x00"
+
+        try:
+            files = fv_files(fv)
+        except NativeReplaceError:
+            self.skipped += 1
+            return None
+
+        result = None
+        for idx, ffs in enumerate(files):
+            if ffs.is_free or ffs.is_pad or ffs.type == EFI_FV_FILETYPE.RAW:
+                continue
+            header = fv[ffs.offset:ffs.offset + ffs.header_size]
+            body = fv[ffs.offset + ffs.header_size:ffs.end]
+            try:
+                name = ui_name(body)
+            except NativeReplaceError:
+                # Not a section file, it cannot hold the file we look for
+                continue
+
+            if self.name is None:
+                if name is not None:
+                    self.names.append(name)
+                self.sections(body)
+                continue
+
+            if name == self.name:
+                self.matches += 1
+                self.found.append(bytes(fv[ffs.offset:ffs.end]))
+                if self.ffs is None:
+                    continue
+                new_file = bytearray(self.ffs)
+                new_file[23] = header[23]
+            else:
+                new_body = self.sections(body)
+                if new_body is None:
+                    continue
+                new_file = file_header(header, new_body) + new_body
+
+            if result is None:
+                result = self.place(fv, files, idx, new_file, erased)
+
+        return result
+
+    def place(self, fv, files, idx, new_file, erased):
+        """Put new_file in the room of files[idx] and the free room after it"""
+
+        old = files[idx]
+        end = old.end
+        next_idx = idx + 1
+        while next_idx < len(files) and (files[next_idx].is_pad or files[next_idx].is_free):
+            end = files[next_idx].end
+            next_idx += 1
+        to_free_space = files[next_idx - 1].is_free
+
+        attributes = new_file[19]
+        header_size = FFS_HEADER2_SIZE if attributes & FFS_ATTRIB_LARGE_FILE else FFS_HEADER_SIZE
+        if (old.offset + header_size) % file_alignment(attributes):
+            raise NativeReplaceError("New file cannot be aligned in place")
+
+        new_end = align(old.offset + len(new_file))
+        room = end - new_end
+        if room < 0:
+            raise NativeReplaceError("New file does not fit in place")
+
+        filler = erased * (new_end - old.offset - len(new_file))
+        if to_free_space or room == 0:
+            filler += erased * room
+        elif room >= FFS_HEADER_SIZE:
+            filler += pad_file(room, new_file[23], erased)
+        else:
+            raise NativeReplaceError("No room for a pad file after the new file")
+
+        return fv[:old.offset] + bytes(new_file) + filler + fv[end:]
+
+    def sections(self, body):
+        """Return body with the file replaced, None if not found in it"""
+
+        try:
+            secs = list(sections(body))
+        except NativeReplaceError:
+            return None
+
+        for idx, (offset, size, header_size, stype) in enumerate(secs):
+            new = self.section(body[offset:offset + size], header_size, stype)
+            if new is None:
+                continue
+
+            later = secs[idx + 1:]
+            if len(new) != size and any(sec[3] in ALIGNED_SECTIONS for sec in later):
+                raise NativeReplaceError("Sections following the file would move")
+
+            result = bytearray(body[:offset]) + new
+            for offset, size, _, _ in later:
+                result += bytes(align(len(result), 4) - len(result))
+                result += body[offset:offset + size]
+            return bytes(result)
+
+        return None
+
+    def section(self, section, header_size, stype):
+        """Return the section with the file replaced, None if not found in it"""
+
+        if stype == EFI_SECTION_TYPE.FIRMWARE_VOLUME_IMAGE:
+            inner = section[header_size:]
+            if not fv_is_valid(inner, 0):
+                return None
+            new = self.fv(inner)
+            if new is None:
+                return None
+            return section[:header_size] + new
+
+        if stype == EFI_SECTION_TYPE.GUID_DEFINED:
+            guid, data_offset, processed, payload = guided_payload(section, header_size)
+            if payload is None:
+                self.undecoded += 1
+                return None
+
+            new = self.sections(payload)
+            if new is None:
+                return None
+            if processed:
+                try:
+                    new = guided_tools.encode(guid, new, self.key_file)
+                except guided_tools.GuidedToolError as err:
+                    raise NativeReplaceError(str(err))
+
+            header = _set_section_size(section[:data_offset], data_offset + len(new))
+            return bytes(header) + new
+
+        return None
+
+
+def replace_volumes(image, name, ffs, key_file=None, fvs=None, replaced=None):
+    """Return the (offset, data) of the top level volumes of image changed
+    by replacing the file of UI name by ffs
+
+    Volumes are copied out of image one at a time, so image can be a map of
+    a file larger than the memory to spare. key_file is the private key used
+    to sign RSA2048SHA256 sections holding the file, required when there are
+    some. fvs limits the search to these (offset, length) top level
+    volumes, as given by index_files(). replaced maps the offsets of the
+    volumes already replaced by an earlier call to their data, used instead
+    of the one in image.
+    """
+
+    replacer = _Replacer(name, bytes(ffs), key_file)
+    if fvs is None:
+        fvs = list(find_fvs(image))
+    changes = []
+    for offset, length in fvs:
+        old = replaced.get(offset) if replaced else None
+        if old is None:
+            old = bytes(image[offset:offset + length])
+            utils.release_pages(image, offset, length)
+        new = replacer.fv(old)
+        if new is not None:
+            if len(new) != length:
+                raise NativeReplaceError("Volume size changed")
+            changes.append((offset, new))
+
+    if replacer.matches == 0:
+        raise NativeReplaceError("No file named {} found ({} volumes not parsed)".format(
+            name, replacer.skipped))
+    if replacer.matches > 1:
+        raise NativeReplaceError("{} files named {} found".format(replacer.matches, name))
+    return changes
+
+
+def replace_file(image, name, ffs, key_file=None, fvs=None):
+    """Return a copy of image with the file of UI name replaced by ffs"""
+
+    changes = replace_volumes(image, name, ffs, key_file, fvs)
+    image = bytearray(image)
+    for offset, new in changes:
+        image[offset:offset + len(new)] = new
+    return image
+
+
+def find_files(image, name):
+    """Return the list of files of UI name in image, decoding their sections"""
+
+    finder = _Replacer(name, None, None)
+    for offset, length in find_fvs(image):
+        finder.fv(bytes(image[offset:offset + length]))
+    return finder.found
+
+
+def find_volumes(image, name):
+    """Return the (offset, length) of the top level volumes holding a file
+    of UI name, once per file"""
+
+    volumes = []
+    for offset, length in find_fvs(image):
+        finder = _Replacer(name, None, None)
+        finder.fv(bytes(image[offset:offset + length]))
+        utils.release_pages(image, offset, length)
+        volumes.extend([(offset, length)] * finder.matches)
+    return volumes
+
+
+def count_files(image, name, fvs=None):
+    """Return the number of files of UI name in image, and the number of
+    volumes and GUIDed sections that could not be parsed to look for it
+
+    fvs limits the search to these (offset, length) top level volumes.
+    """
+
+    finder = _Replacer(name, None, None)
+    for offset, length in find_fvs(image) if fvs is None else fvs:
+        finder.fv(bytes(image[offset:offset + length]))
+        utils.release_pages(image, offset, length)
+    return finder.matches, finder.skipped + finder.undecoded
+
+
+def index_files(image):
+    """Return a dictionary of UI name to the list of (offset, length) of the
+    top level volumes holding a file of that name, once per file"""
+
+    index = {}
+    for offset, length in find_fvs(image):
+        indexer = _Replacer(None, None, None)
+        indexer.fv(bytes(image[offset:offset + length]))
+        utils.release_pages(image, offset, length)
+        for name in indexer.names:
+            index.setdefault(name, []).append((offset, length))
+    return index
+
+
+def image_key(filename):
+    """Return the key of an image file, changing when the file is changed"""
+
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    return (filename, stat.st_mtime_ns, stat.st_size)
+
+
+class BaseImage:
+    """A memory-mapped image and the index of its files"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as image_fd:
+            self.data = mmap.mmap(image_fd.fileno(), 0, access=mmap.ACCESS_READ)
+        self._index = None
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = index_files(self.data)
+        return self._index
+
+    def replace_volumes(self, name, ffs, key_file=None):
+        fvs = self.index.get(name, [])
+        if len(fvs) != 1:
+            raise NativeReplaceError("{} files named {} found".format(len(fvs), name))
+        return replace_volumes(self.data, name, ffs, key_file, fvs)
+
+    def close(self):
+        self.data.close()
+
+
+class BaseImageCache:
+    """Base images kept mapped and indexed, the least recently used ones are
+    dropped once their total size is over max_bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filename):
+        """Return the BaseImage of filename, reloaded if the file changed"""
+
+        filename = os.path.abspath(filename)
+        key = image_key(filename)
+
+        image = self.images.pop(key, None)
+        if image is None:
+            self.misses += 1
+            for old in [k for k in self.images if k[0] == filename]:
+                self.images.pop(old).close()
+            image = BaseImage(filename)
+        else:
+            self.hits += 1
+        self.images[key] = image
+
+        while len(self.images) > 1 and self.total_bytes() > self.max_bytes:
+            _, old = self.images.popitem(last=False)
+            old.close()
+        return image
+
+    def total_bytes(self):
+        return sum(image.size for image in self.images.values())
+
+    def stats(self):
+        return {
+            "images": [key[0] for key in self.images],
+            "bytes": self.total_bytes(),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def replace_file_in_image(inputfile, name, ffs_file, outfile, key_file=None,
+                          image_cache=None):
+    """Replace the file of UI name in inputfile by ffs_file and save it as outfile
+
+    image_cache is a BaseImageCache keeping inputfile mapped and indexed for
+    the next replacements. Returns the (offset, length) of the changed
+    volumes.
+    """
+
+    with open(ffs_file, "rb") as ffs_fd:
+        ffs = ffs_fd.read()
+
+    if len(ffs) < FFS_HEADER_SIZE:
+        raise NativeReplaceError("{} is not a firmware file".format(ffs_file))
+
+    # Only the changed volumes are held in memory, the output is a clone of
+    # the input patched with them
+    if image_cache is not None:
+        changes = image_cache.get(inputfile).replace_volumes(name, ffs, key_file)
+    else:
+        with delta.map_file(inputfile) as image:
+            changes = replace_volumes(image, name, ffs, key_file)
+
+    if not (os.path.exists(outfile) and os.path.samefile(inputfile, outfile)):
+        utils.clone_file(inputfile, outfile)
+    utils.patch_file(outfile, changes)
+    return [(offset, len(new)) for offset, new in changes]
@@ -4,11 +4,24 @@
 # SPDX-License-Identifier: BSD-2-Clause
 #
 
-"""A simple UEFI firmware volume parser"""
+"""A simple UEFI firmware volume parser
 
-# import os
+   python firmware_volume.py [--verify | --index] image.bin
+"""
+
+import os
+import io
 import sys
+import json
+import mmap
 import uuid
+import struct
+import hashlib
+import argparse
+import tempfile
+import threading
+import contextlib
+from collections import OrderedDict, namedtuple
 
 from ctypes import Structure
 from ctypes import c_char, c_uint32, c_uint8, c_uint64, c_uint16, sizeof, ARRAY
@@ -91,7 +104,7 @@ class c_uint24(Structure):
         self.Data[0:3] = valu2bytes(val, 3)
 
     def get_value(self):
-        return bytes2val(self.Data[0:3])
+        return int.from_bytes(bytearray(self.Data), "little")
 
     value = property(get_value, set_value)
 
@@ -181,50 +194,754 @@ GUID_MICROCODE_SIGNATURE = uuid.UUID("197DB236-F856-4924-90F8-CDF12FB875F3")
 GUID_FSP_INFO_HEADER = uuid.UUID("912740BE-2284-4734-B971-84B027353F0C")
 GUID_EMPTY = uuid.UUID("FFFFFFFF-FFFF-FFFF-FFFF-FFFFFFFFFFFF")
 
-class FirmwareDevice:
+# The GUIDs as found in the headers, compared for every file
+_EMPTY = GUID_EMPTY.bytes_le
+_VARIABLE_STORE = GUID_VARIABLE_STORE_SIGNATURE.bytes_le
+_FTW_WORKING_BLOCK = GUID_FTW_WORKING_BLOCK_SIGNATURE.bytes_le
+_MICROCODE = GUID_MICROCODE_SIGNATURE.bytes_le
+_FSP_INFO_HEADER = GUID_FSP_INFO_HEADER.bytes_le
+_SPECIAL_FILES = (_EMPTY, _VARIABLE_STORE, _FTW_WORKING_BLOCK, _MICROCODE)
+
+FV_SIGNATURE = b"_FVH"
+FV_SIGNATURE_OFFSET = 0x28
+FV_SCAN_WINDOW = 0x100000
+
+FFS_ATTRIB_CHECKSUM = 0x40
+FFS_FIXED_CHECKSUM = 0xAA
+
+# Version of the parse tree saved in index files, to change with the parser
+PARSER_VERSION = 1
+INDEX_SUFFIX = ".fvidx"
+
+# Decoders of the headers read for every node of the parse tree, a lot
+# cheaper than copying them into the ctypes structures above
+FV_HEADER = struct.Struct("<16s16sQ4sIHHHBB")
+FV_EXT_HEADER = struct.Struct("<16sI")
+FFS_HEADER = struct.Struct("<16sHBBHBB")
+SECTION_HEADER = struct.Struct("<HBB")
+
+FvHeader = namedtuple("FvHeader", [
+    "ZeroVector", "FileSystemGuid", "FvLength", "Signature", "Attributes",
+    "HeaderLength", "Checksum", "ExtHeaderOffset", "Reserved", "Revision"])
+FfsHeader = namedtuple("FfsHeader", [
+    "Name", "IntegrityCheck", "Type", "Attributes", "Size", "State"])
+SectionHeader = namedtuple("SectionHeader", ["Size", "Type"])
+
+
+def fv_header(buffer, offset):
+    return FvHeader._make(FV_HEADER.unpack_from(buffer, offset))
+
+
+def ffs_header(buffer, offset):
+    name, check, ftype, attributes, size, size_hi, state = FFS_HEADER.unpack_from(buffer, offset)
+    return FfsHeader(name, check, ftype, attributes, size | size_hi << 16, state)
+
+
+def section_header(buffer, offset):
+    size, size_hi, stype = SECTION_HEADER.unpack_from(buffer, offset)
+    return SectionHeader(size | size_hi << 16, stype)
+
+
+EFI_GUIDED_SECTION_PROCESSING_REQUIRED = 0x01
+GUIDED_SECTION_FIELDS_SIZE = 20  # GUID, DataOffset and Attributes
+
+# Bytes of decoded sections kept by section_cache
+SECTION_CACHE_SIZE = 64 * 1024 * 1024
+
+
+class SectionCache:
+    """Decoded GUIDed sections by GUID and content, the least recently used
+    ones are dropped once their total size is over max_bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.sections = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def decode(self, guid, data, decoder):
+        """Return decoder(guid, data), from the cache when data was seen"""
+
+        key = (bytes(guid), hashlib.sha256(data).digest())
+        with self.lock:
+            decoded = self.sections.get(key)
+            if decoded is not None:
+                self.hits += 1
+                self.sections.move_to_end(key)
+                return decoded
+            self.misses += 1
+
+        # Sections are decoded outside of the lock, concurrent decoders of
+        # the same data store the same result
+        decoded = decoder(guid, data)
+        with self.lock:
+            if key not in self.sections:
+                self.size += len(decoded)
+            self.sections[key] = decoded
+            while len(self.sections) > 1 and self.size > self.max_bytes:
+                _, old = self.sections.popitem(last=False)
+                self.size -= len(old)
+        return decoded
+
+    def clear(self):
+        with self.lock:
+            self.sections.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            "sections": len(self.sections),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+section_cache = SectionCache(SECTION_CACHE_SIZE)
+
+
+def fv_is_valid(data, offset):
+    """Check for a firmware volume header at offset of data"""
+
+    if len(data) - offset < sizeof(EFI_FIRMWARE_VOLUME_HEADER):
+        return False
+    if data[offset + FV_SIGNATURE_OFFSET:offset + FV_SIGNATURE_OFFSET + 4] != FV_SIGNATURE:
+        return False
+    fvh = EFI_FIRMWARE_VOLUME_HEADER.from_buffer_copy(data, offset)
+    if fvh.HeaderLength < sizeof(fvh) or fvh.HeaderLength > fvh.FvLength \
+            or fvh.HeaderLength % 2 or fvh.FvLength > len(data) - offset:
+        return False
+    return _sum16(data[offset:offset + fvh.HeaderLength]) == 0
+
+
+def _sum16(data):
+    return sum(memoryview(data).cast("H")) & 0xFFFF
+
+
+def _find(data, sub, start, end):
+    if hasattr(data, "find"):
+        return data.find(sub, start, end)
+    # Memoryviews have no find(), a window is copied at a time
+    while start + len(sub) <= end:
+        window_end = min(start + FV_SCAN_WINDOW, end)
+        pos = data[start:window_end].tobytes().find(sub)
+        if pos >= 0:
+            return start + pos
+        start = window_end - len(sub) + 1 if window_end < end else end
+    return -1
+
+
+# Erased and zeroed windows are skipped without a search
+_FILLS = (b"\xff" * FV_SCAN_WINDOW, bytes(FV_SCAN_WINDOW))
+
+
+def _is_filled(data, start, end):
+    length = end - start
+    if hasattr(data, "startswith"):
+        return any(data.startswith(fill[:length], start) for fill in _FILLS)
+    window = data[start:end]
+    if isinstance(window, memoryview):
+        window = window.tobytes()
+    return any(window == fill[:length] for fill in _FILLS)
+
+
+def scan_volumes(data, start=0, end=None, release=None):
+    """Yield (offset, length) of the firmware volumes of data[start:end]
+
+    Volumes are found by their signature, at any 8 bytes aligned offset, and
+    must have a valid header checksum. The bytes in between are searched a
+    window at a time, erased or zeroed windows being skipped at once, and
+    release(offset, length) is called for the ranges scanned so the pages of
+    a map can be released.
+    """
+
+    end = len(data) if end is None else end
+    pos = start + FV_SIGNATURE_OFFSET
+    while pos + len(FV_SIGNATURE) <= end:
+        window_end = min(pos + FV_SCAN_WINDOW, end)
+        if _is_filled(data, pos, window_end):
+            sig = -1
+        else:
+            sig = _find(data, FV_SIGNATURE, pos, window_end)
+        if sig < 0:
+            # A signature may start in the last bytes of the window
+            next_pos = window_end - len(FV_SIGNATURE) + 1 if window_end < end else window_end
+            if release is not None:
+                release(pos, next_pos - pos)
+            pos = next_pos
+            continue
+
+        offset = sig - FV_SIGNATURE_OFFSET
+        if release is not None:
+            release(pos, sig - pos)
+        length = 0
+        if offset % 8 == 0 and fv_is_valid(data, offset):
+            length = EFI_FIRMWARE_VOLUME_HEADER.from_buffer_copy(data, offset).FvLength
+        if 0 < length <= end - offset:
+            yield offset, length
+            pos = offset + length + FV_SIGNATURE_OFFSET
+        else:
+            pos = offset + 1 + FV_SIGNATURE_OFFSET
+
+
+def bad_volume_headers(data, start, end, release=None):
+    """Yield the offsets in data[start:end] of the volume headers that are
+    not valid, or whose volume ends after end, while their signature and
+    lengths look right
+
+    Like scan_volumes(), data is searched a window at a time and release is
+    called for the ranges scanned.
+    """
+
+    header_size = sizeof(EFI_FIRMWARE_VOLUME_HEADER)
+    pos = start + FV_SIGNATURE_OFFSET
+    while pos + len(FV_SIGNATURE) <= end:
+        window_end = min(pos + FV_SCAN_WINDOW, end)
+        if _is_filled(data, pos, window_end):
+            sig = -1
+        else:
+            sig = _find(data, FV_SIGNATURE, pos, window_end)
+        if sig < 0:
+            next_pos = window_end - len(FV_SIGNATURE) + 1 if window_end < end else window_end
+            if release is not None:
+                release(pos, next_pos - pos)
+            pos = next_pos
+            continue
+
+        offset = sig - FV_SIGNATURE_OFFSET
+        if offset % 8 == 0 and len(data) - offset >= header_size:
+            fvh = fv_header(data, offset)
+            if header_size <= fvh.HeaderLength <= fvh.FvLength <= len(data) - offset \
+                    and (fvh.FvLength > end - offset or not fv_is_valid(data, offset)):
+                yield offset
+        pos = sig + 1
+
+
+def file_errors(buffer, event):
+    """Return the messages of the checksum errors of the file of an event"""
+
+    errors = []
+    header = bytearray(buffer[event.offset:event.offset + FFS_HEADER.size])
+    file_checksum = header[17]
+    # The file checksum and the state are not part of the header checksum
+    header[17] = header[23] = 0
+    if sum(header) & 0xFF:
+        errors.append("Bad header checksum")
+    if event.header.Attributes & FFS_ATTRIB_CHECKSUM:
+        body = buffer[event.offset + FFS_HEADER.size:event.offset + event.length]
+        if (sum(bytes(body)) + file_checksum) & 0xFF:
+            errors.append("Bad data checksum")
+    elif file_checksum != FFS_FIXED_CHECKSUM:
+        errors.append("Data checksum {:#x} instead of {:#x}".format(
+            file_checksum, FFS_FIXED_CHECKSUM))
+    return errors
+
+
+class FV_EVENT:
+    """Kinds of the events of FirmwareDevice.events()"""
+
+    PADDING = "padding"  # Filler between volumes
+    FV_START = "fv_start"
+    FV_END = "fv_end"
+    PAD_FILE = "pad_file"
+    FREE_SPACE = "free_space"
+    FFS = "ffs"
+    SECTION = "section"
+    VSS = "vss"
+    FTW = "ftw"
+    MICROCODE = "microcode"
+
+
+# An event of the parser: offset and length of the node in the buffer, its
+# header as given by fv_header(), ffs_header() and section_header(), or the
+# structure of VSS and FTW stores, and its name, a GUID in bytes or the
+# string of UI sections
+FvEvent = namedtuple("FvEvent", ["kind", "offset", "length", "header", "name"])
+
+
+def fv_name(fvh, buffer, base):
+    """Return the name of the volume of header fvh at base of buffer"""
+
+    if fvh.ExtHeaderOffset > 0:
+        return FV_EXT_HEADER.unpack_from(buffer, base + fvh.ExtHeaderOffset)[0]
+    return fvh.FileSystemGuid
+
+
+def file_events(buffer, base):
+    """Yield the events of the files of the volume at base of buffer"""
+
+    fvh = fv_header(buffer, base)
+    fvsize = min(fvh.FvLength, len(buffer) - base)
+    if fvh.ExtHeaderOffset > 0:
+        ext_size = FV_EXT_HEADER.unpack_from(buffer, base + fvh.ExtHeaderOffset)[1]
+        offset = fvh.ExtHeaderOffset + ext_size
+    else:
+        offset = fvh.HeaderLength
+    offset = align(offset)
+    while offset < fvsize:
+        ffshdr = ffs_header(buffer, base + offset)
+        name = ffshdr.Name
+        size = ffshdr.Size
+        if name not in _SPECIAL_FILES:
+            event = FvEvent(FV_EVENT.FFS, base + offset, size, ffshdr, name)
+        elif (name == _EMPTY) and (ffshdr.Type == EFI_FV_FILETYPE.FFS_PAD):
+            event = FvEvent(FV_EVENT.PAD_FILE, base + offset, size, ffshdr, name)
+        elif (name == _EMPTY) and (size == 0xFFFFFF):
+            event = FvEvent(FV_EVENT.FREE_SPACE, base + offset, fvsize - offset, ffshdr, name)
+        elif name == _VARIABLE_STORE:
+            vsshdr = VARIABLE_STORE_HEADER.from_buffer_copy(buffer, base + offset)
+            event = FvEvent(FV_EVENT.VSS, base + offset, vsshdr.Size, vsshdr,
+                            bytes(vsshdr.Signature))
+        elif name == _FTW_WORKING_BLOCK:
+            ftwhdr = FTW_HEADER.from_buffer_copy(buffer, base + offset)
+            event = FvEvent(FV_EVENT.FTW, base + offset,
+                            ftwhdr.WriteQueueSize + sizeof(FTW_HEADER), ftwhdr,
+                            bytes(ftwhdr.Signature))
+        elif name == _MICROCODE:
+            event = FvEvent(FV_EVENT.MICROCODE, base + offset, size, ffshdr, name)
+        else:
+            event = FvEvent(FV_EVENT.FFS, base + offset, size, ffshdr, name)
+        yield event
+        if event.length == 0:
+            break
+        offset += event.length
+
+        # Make sure 8-byte aligned
+        offset = align(offset)
+
+
+def section_events(buffer, base, length):
+    """Yield the events of the sections of buffer[base:base + length]"""
+
+    offset = 0
+    header_size = SECTION_HEADER.size
+    while offset + header_size <= length:
+        sechdr = section_header(buffer, base + offset)
+        size = min(sechdr.Size, length - offset)
+        if sechdr.Type == EFI_SECTION_TYPE.USER_INTERFACE:
+            name = bytes(buffer[base + offset + header_size:base + offset + size]).decode(
+                "utf-16le").rstrip("\0")
+        elif sechdr.Type == EFI_SECTION_TYPE.GUID_DEFINED:
+            name = bytes(buffer[base + offset + header_size:base + offset + header_size + 16])
+        else:
+            name = None
+        yield FvEvent(FV_EVENT.SECTION, base + offset, size, sechdr, name)
+        if size == 0:
+            break
+        offset += align(size, 4)
+
+
+def decode_section(buffer, offset):
+    """Return the (buffer, base, length) of the volume of a volume image
+    section, or of the sections encapsulated in a GUIDed section, at offset
+    of buffer. None for other sections and the ones that cannot be decoded
+    in-process.
+
+    The data of GUIDed sections needing processing is decoded through
+    section_cache, the other data is in the same buffer.
+    """
+
+    sechdr = section_header(buffer, offset)
+    header_size = SECTION_HEADER.size
+    if sechdr.Type == EFI_SECTION_TYPE.FIRMWARE_VOLUME_IMAGE:
+        return buffer, offset + header_size, sechdr.Size - header_size
+    if sechdr.Type != EFI_SECTION_TYPE.GUID_DEFINED:
+        return None
+
+    # The GUIDed section tools import this module
+    from common import guided_tools
+
+    guid = bytes(buffer[offset + header_size:offset + header_size + 16])
+    data_offset, attributes = struct.unpack_from("<HH", buffer, offset + header_size + 16)
+    if not header_size + GUIDED_SECTION_FIELDS_SIZE <= data_offset <= sechdr.Size:
+        return None
+    base = offset + data_offset
+    length = sechdr.Size - data_offset
+    if not attributes & EFI_GUIDED_SECTION_PROCESSING_REQUIRED:
+        pass
+    elif guid == GUIDED_SECTION_RSASHA256.bytes_le:
+        # The signed data follows the signature, no need to copy it
+        base += guided_tools.RSA_HEADER_SIZE
+        length -= guided_tools.RSA_HEADER_SIZE
+    else:
+        try:
+            buffer = byte_view(section_cache.decode(
+                guid, buffer[base:base + length], guided_tools.decode))
+        except guided_tools.GuidedToolError:
+            return None
+        base, length = 0, len(buffer)
+    if length < 0:
+        return None
+    return buffer, base, length
+
+
+def map_image(filename, writable=False):
+    """Map an image file read-only, or copy-on-write when writable: the map
+    can be changed but the changes are not written to the file. Empty files
+    are given as empty bytes."""
+
+    with open(filename, "rb") as image_fd:
+        if os.fstat(image_fd.fileno()).st_size == 0:
+            return bytearray() if writable else b""
+        access = mmap.ACCESS_COPY if writable else mmap.ACCESS_READ
+        return mmap.mmap(image_fd.fileno(), 0, access=access)
+
+
+def byte_view(data):
+    """Return a flat memoryview of the bytes of data, without copying them"""
+
+    if isinstance(data, memoryview) and data.format == "B" and data.ndim == 1:
+        return data
+    view = memoryview(data)
+    if view.format != "B" or view.ndim != 1:
+        view = view.cast("B")
+    return view
+
+
+class _Node:
+    """A range of the buffer shared by all the nodes of a parse tree
+
+    The bytes of a node are only copied when asked for: View is a memoryview
+    of the range, and the FdData, FvData, FfsData, SecData and Data
+    properties return a copy of it. The nodes have slots, their headers are
+    decoded again from the buffer when asked for.
+    """
+
+    __slots__ = ("Buffer", "Base", "Length")
+
+    def __init__(self, buffer, base, length):
+        self.Buffer = buffer
+        self.Base = base
+        self.Length = min(length, len(buffer) - base)
+
+    @property
+    def View(self):
+        return self.Buffer[self.Base:self.Base + self.Length]
+
+    def tobytes(self):
+        return self.View.tobytes()
+
+
+class FirmwareDevice(_Node):
+    __slots__ = ("FvList", "Offset", "_map", "_index_file", "_file_key", "FvIndex",
+                 "FfsIndex", "UiIndex", "Digests")
+
     def __init__(self, offset, data):
+        data = byte_view(data)
+        super().__init__(data, 0, len(data))
         self.FvList = []
         self.Offset = 0
-        self.FdData = bytearray(data)
+        self._map = None
+        self._index_file = None
+        self._file_key = None
+        self._clear_index()
+
+    @classmethod
+    def from_file(cls, filename, writable=False):
+        """Return the FirmwareDevice of a mapped image file, see map_image().
+        Only the pages that are parsed are read from the file. Its index
+        file is the image file name with INDEX_SUFFIX added."""
+
+        mapped = map_image(filename, writable)
+        fd = cls(0, mapped)
+        fd._map = mapped
+        fd._index_file = filename + INDEX_SUFFIX
+        if not writable:
+            # The size and time of the file tell if an index matches it
+            # without hashing the file, a writable map may differ from it
+            stat = os.stat(filename)
+            fd._file_key = [stat.st_size, stat.st_mtime_ns]
+        return fd
+
+    def close(self):
+        """Release the view of the image and unmap the file of from_file(),
+        the nodes cannot be read anymore"""
+
+        self.Buffer.release()
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    FdData = property(_Node.tobytes)
+
+    def events(self, sections=True):
+        """Yield the FvEvent of the volumes, files and, unless sections is
+        False, sections of the device in order, without building any node
+
+        Only the headers are read, the events of a volume are put between
+        its FV_START and FV_END events. Encapsulated sections are not
+        decoded.
+        """
+
+        data = self._searchable()
+        offset = self.Base
+        for fv_offset, fv_length in scan_volumes(data, self.Base, self.Base + self.Length):
+            if fv_offset > offset:
+                yield FvEvent(FV_EVENT.PADDING, offset, fv_offset - offset, None, None)
+            fvh = fv_header(self.Buffer, fv_offset)
+            name = fv_name(fvh, self.Buffer, fv_offset)
+            yield FvEvent(FV_EVENT.FV_START, fv_offset, fv_length, fvh, name)
+            for event in file_events(self.Buffer, fv_offset):
+                yield event
+                # Like ParseFv, the sections of the FSP info header are skipped
+                if sections and event.kind == FV_EVENT.FFS \
+                        and event.name != _FSP_INFO_HEADER:
+                    header_size = FFS_HEADER.size
+                    yield from section_events(self.Buffer, event.offset + header_size,
+                                              event.length - header_size)
+            yield FvEvent(FV_EVENT.FV_END, fv_offset, fv_length, fvh, name)
+            offset = fv_offset + fv_length
+
+    def _searchable(self):
+        # The signatures are searched in the object of the view when it is
+        # the whole of it, bytes and maps search without a copy
+        data = self.Buffer
+        if hasattr(data.obj, "find") and len(data.obj) == data.nbytes:
+            data = data.obj
+        return data
+
+    def verify(self):
+        """Return the (offset, message) of the integrity errors of the device
+
+        The header checksum of the volumes, and the header and data checksums
+        of their files, are checked from the events of the device, without
+        building the parse tree. A volume with a bad header checksum is not
+        found as a volume, its header is looked for in the padding.
+        """
+
+        errors = []
+        fv_end = None
+        for event in self.events(sections=False):
+            if event.kind == FV_EVENT.PADDING:
+                errors.extend((offset - self.Base, "Bad header checksum of volume")
+                              for offset in bad_volume_headers(
+                                  self._searchable(), event.offset,
+                                  event.offset + event.length))
+            elif event.kind == FV_EVENT.FV_START:
+                fv_end = event.offset + event.length
+            elif event.kind in (FV_EVENT.FFS, FV_EVENT.PAD_FILE, FV_EVENT.MICROCODE):
+                if event.offset + event.length > fv_end:
+                    problems = ["Data after the end of the volume"]
+                else:
+                    problems = file_errors(self.Buffer, event)
+                name = uuid.UUID(bytes_le=event.name) if problems else None
+                errors.extend((event.offset - self.Base, "{} of file {}".format(error, name))
+                              for error in problems)
+        return errors
+
+    def image_digest(self):
+        """Return the SHA256 of the data of the device, in hexadecimal"""
+
+        return hashlib.sha256(self.View).hexdigest()
+
+    def parse(self, index_file=None, write_index=False):
+        """Build the parse tree like ParseFd, without printing it
+
+        The tree is loaded from index_file, by default the index file of
+        from_file(), when it holds the layout of the same data parsed by
+        the same PARSER_VERSION. Otherwise the device is parsed, and its
+        layout saved to index_file when write_index is True. Returns True
+        when the index was loaded.
+        """
+
+        index_file = index_file or self._index_file
+        if self._load_index(index_file):
+            return True
+
+        # ParseFd reports the nodes on stdout as it finds them
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.ParseFd()
+        if write_index and index_file:
+            try:
+                self.save_index(index_file)
+            except OSError:
+                pass  # The next parse will not find the index
+        return False
+
+    # The index file is a line of compact JSON, holding the SHA256 of the
+    # data, the size and modification time of the image file when the device
+    # is a read-only map of it, the PARSER_VERSION and lists of the base and
+    # length of the nodes
+    # of the tree, with the names of the volumes and files and the types and
+    # names of the sections, followed by the SHA256 of the nodes in the order
+    # of _tree_nodes(). The encapsulated sections are not indexed.
+
+    def _tree_nodes(self):
+        for fv in self.FvList:
+            yield fv
+            for ffs in getattr(fv, "FfsList", ()):
+                yield ffs
+                yield from getattr(ffs, "SecList", ())
+
+    def hash_nodes(self):
+        """Set Digests to the SHA256 of the volumes, files and sections of
+        the parse tree by their Base"""
+
+        self.Digests = {node.Base: hashlib.sha256(node.View).digest()
+                        for node in self._tree_nodes()}
+
+    def save_index(self, filename=None):
+        """Write the layout of the parse tree to the index file filename, by
+        default the index file of from_file(). Raises OSError."""
+
+        filename = filename or self._index_file
+        self.hash_nodes()
+        layout = {
+            "parser": PARSER_VERSION,
+            "size": self.Length,
+            "digest": self.image_digest(),
+            "file": self._file_key,
+            "nodes": [_node_layout(node) for node in self.FvList],
+        }
+        # Tools opening the same image at once may write the index together,
+        # so it is written under a temporary name and renamed into place
+        folder = os.path.dirname(os.path.abspath(filename))
+        handle, tmp_path = tempfile.mkstemp(dir=folder, suffix=INDEX_SUFFIX)
+        try:
+            with os.fdopen(handle, "wb") as index_fd:
+                index_fd.write(json.dumps(layout, separators=(",", ":")).encode("utf-8"))
+                index_fd.write(b"\n")
+                index_fd.write(b"".join(self.Digests[node.Base]
+                                        for node in self._tree_nodes()))
+            os.replace(tmp_path, filename)
+        except OSError:
+            os.remove(tmp_path)
+            raise
+
+    def load_index(self, filename=None):
+        """Build the parse tree from the index file filename, by default the
+        index file of from_file(), without reading the headers of the nodes,
+        and return True, if it holds the layout of the same data parsed by
+        the same PARSER_VERSION. Returns False otherwise.
+
+        The index matches the image file of from_file() when their size and
+        modification time are the same, the data is only hashed to compare
+        it with the index otherwise."""
+
+        return self._load_index(filename or self._index_file)
+
+    def _load_index(self, filename):
+        if filename is None:
+            return False
+        try:
+            with open(filename, "rb") as index_fd:
+                layout = json.loads(index_fd.readline().decode("utf-8"))
+                digests = index_fd.read()
+        except (OSError, ValueError):
+            return False
+        if not isinstance(layout, dict) or layout.get("parser") != PARSER_VERSION \
+                or layout.get("size") != self.Length:
+            return False
+        if self._file_key is None or layout.get("file") != self._file_key:
+            if layout.get("digest") != self.image_digest():
+                return False
+
+        self.FvList = []
+        self._clear_index()
+        for entry in layout["nodes"]:
+            node = _load_node(self.Buffer, entry, self.Base)
+            if isinstance(node, FirmwareVolume):
+                self._index_fv(node, len(self.FvList))
+            self.FvList.append(node)
+        size = hashlib.sha256().digest_size
+        self.Digests = {node.Base: digests[pos:pos + size]
+                        for node, pos in zip(self._tree_nodes(), range(0, len(digests), size))}
+        return True
 
     def ParseFd(self):
-        offset = 0
-        fdsize = len(self.FdData)
         self.FvList = []
-        padding_size = 0
-        while offset < fdsize:
-            fvh = EFI_FIRMWARE_VOLUME_HEADER.from_buffer(self.FdData, offset)
-            if b"_FVH" != fvh.Signature:  # TODO: need more work to determine padding
-                offset += 0x1000  # Advance 4KB
-                padding_size += 0x1000
-                continue
-            if padding_size > 0:
+        self._clear_index()
+
+        fv = None
+        for event in self.events():
+            if event.kind == FV_EVENT.PADDING:
                 print(
                     "WARNING: Invalid FV header signature. Possible filler data between FVs"
                 )
                 fv_gap_file = PaddingFile(
-                    offset - padding_size, self.FdData[offset - padding_size : offset]
+                    event.offset - self.Base, self.Buffer, event.offset, event.length
                 )
                 self.FvList.append(fv_gap_file)
-                padding_size = 0
-
-            fv = FirmwareVolume(offset, self.FdData[offset : offset + fvh.FvLength])
-            print(
-                "\n=== FV {} @ {:x} len:{:x} ===".format(
-                    len(self.FvList), offset, len(fv.FvData)
+            elif event.kind == FV_EVENT.FV_START:
+                fv = FirmwareVolume(event.offset - self.Base, self.Buffer, event.offset)
+                print(
+                    "\n=== FV {} @ {:x} len:{:x} ===".format(
+                        len(self.FvList), fv.Offset, fv.Length
+                    )
                 )
-            )
-            fv.ParseFv()
-            self.FvList.append(fv)
-            offset += fv.FvHdr.FvLength
+            elif event.kind == FV_EVENT.FV_END:
+                self._index_fv(fv, len(self.FvList))
+                self.FvList.append(fv)
+            elif event.kind == FV_EVENT.SECTION:
+                fv.FfsList[-1].add_section(event)
+            else:
+                fv.add_file(event)
+
+    # Volumes and files are indexed while the device is parsed: FV GUID to
+    # the volume and its index in FvList, FFS GUID to the list of (volume,
+    # offset) of the files, and UI name to the file. Only the files of the
+    # top level volumes are indexed, index_encapsulated() adds the ones found
+    # by decoding the sections.
+
+    def _clear_index(self):
+        self.FvIndex = {}
+        self.FfsIndex = {}
+        self.UiIndex = {}
+        self.Digests = {}
+
+    def _index_fv(self, fv, idx=None):
+        self.FvIndex.setdefault(bytes(fv.Name), (fv, idx))
+        for ffs in fv.FfsList:
+            if isinstance(ffs, FirmwareFile):
+                self.FfsIndex.setdefault(bytes(ffs.Name), []).append((fv, ffs.Offset))
+                if ffs.UiName is not None:
+                    self.UiIndex.setdefault(ffs.UiName, ffs)
+
+    def index_encapsulated(self):
+        """Add the volumes and files found in encapsulated sections to the
+        index, decoding all of them"""
+
+        top = set(id(fv) for fv in self.FvList)
+        for node in self.walk():
+            if isinstance(node, FirmwareVolume) and id(node) not in top:
+                self._index_fv(node)
+
+    def get_fv_by_guid(self, guid):
+        """Return the first FV named guid, None if not found"""
+
+        return self.FvIndex.get(_guid_key(guid), (None, None))[0]
+
+    def get_ffs_by_guid(self, guid):
+        """Return the list of (FV, offset) of the files named guid"""
+
+        return self.FfsIndex.get(_guid_key(guid), [])
+
+    def get_ffs_by_name(self, name):
+        """Return the first file of UI name, None if not found"""
+
+        return self.UiIndex.get(name)
+
+    def walk(self):
+        """Yield the volumes, files and sections of the device depth first,
+        decoding the encapsulated ones as they are reached"""
+
+        for fv in self.FvList:
+            yield from walk_node(fv)
 
     def get_fv_index_by_guid(self, guid):
         """Return the index of FV within FvList, -1 if not found"""
-        for idx, fv in enumerate(self.FvList):
-            if isinstance(guid, bytes) and isinstance(fv, FirmwareVolume):
-                if guid == fv.Name:
-                    return idx
-        return -1
+        if not isinstance(guid, bytes):
+            return -1
+        idx = self.FvIndex.get(guid, (None, None))[1]
+        return -1 if idx is None else idx
 
     def is_fsp_wrapper(self):
         for i in self.FvList:
@@ -233,149 +950,215 @@ class FirmwareDevice:
         return False
 
 
-class MiscFile:
-    def __init__(self, name, offset, data):
+def _guid_key(guid):
+    return guid.bytes_le if isinstance(guid, uuid.UUID) else bytes(guid)
+
+
+def walk_node(node):
+    """Yield node and the nodes below it depth first"""
+
+    yield node
+    for child in getattr(node, "FfsList", getattr(node, "SecList", ())):
+        yield from walk_node(child)
+    if isinstance(node, Section):
+        for child in node.Children:
+            yield from walk_node(child)
+
+
+class MiscFile(_Node):
+    __slots__ = ("Name", "Offset")
+
+    def __init__(self, name, offset, data, base=0, length=None):
+        data = byte_view(data)
+        super().__init__(data, base, len(data) - base if length is None else length)
         self.Name = name[:]
         self.Offset = offset
-        self.Data = data[:]
 
+    Data = property(_Node.tobytes)
 
-class PaddingFile:
-    def __init__(self, offset, data):
+
+class PaddingFile(_Node):
+    __slots__ = ("Offset",)
+
+    def __init__(self, offset, data, base=0, length=None):
+        data = byte_view(data)
+        super().__init__(data, base, len(data) - base if length is None else length)
         self.Offset = offset
-        self.Data = data[:]
 
+    Data = property(_Node.tobytes)
+
+
+class FirmwareVolume(_Node):
+    """A firmware volume at base of fvdata, its start by default"""
 
-class FirmwareVolume:
-    def __init__(self, offset, fvdata):
-        self.FvHdr = EFI_FIRMWARE_VOLUME_HEADER.from_buffer(fvdata, 0)
-        self.FvData = fvdata[0 : self.FvHdr.FvLength]
+    __slots__ = ("Offset", "FspExists", "FfsList", "Name", "_ext_offset")
+
+    def __init__(self, offset, fvdata, base=0):
+        fvdata = byte_view(fvdata)
+        fvh = fv_header(fvdata, base)
+        super().__init__(fvdata, base, fvh.FvLength)
         self.Offset = offset
         self.FspExists = False
         self.FfsList = []
-        if self.FvHdr.ExtHeaderOffset > 0:
-            self.FvExtHdr = EFI_FIRMWARE_VOLUME_EXT_HEADER.from_buffer(
-                self.FvData, self.FvHdr.ExtHeaderOffset
-            )
-            self.Name = bytes(self.FvExtHdr.FvName)
-        else:
-            self.FvExtHdr = None
-            self.Name = bytes(self.FvHdr.FileSystemGuid)
+        self._ext_offset = fvh.ExtHeaderOffset
+        self.Name = fv_name(fvh, fvdata, base)
+
+    @property
+    def FvHdr(self):
+        return EFI_FIRMWARE_VOLUME_HEADER.from_buffer_copy(self.Buffer, self.Base)
+
+    @property
+    def FvExtHdr(self):
+        if self._ext_offset == 0:
+            return None
+        return EFI_FIRMWARE_VOLUME_EXT_HEADER.from_buffer_copy(
+            self.Buffer, self.Base + self._ext_offset
+        )
+
+    FvData = property(_Node.tobytes)
 
     def ParseFv(self):
-        fvsize = len(self.FvData)
-        if self.FvExtHdr:
-            offset = self.FvHdr.ExtHeaderOffset + self.FvExtHdr.ExtHeaderSize
-        else:
-            offset = self.FvHdr.HeaderLength
-        offset = align(offset)
-        while offset < fvsize:
-            ffshdr = EFI_FFS_FILE_HEADER.from_buffer(self.FvData, offset)
-            ffs_name = uuid.UUID(bytes_le=bytes(ffshdr.Name))
-            if (ffs_name == GUID_EMPTY) and (ffshdr.Type == EFI_FV_FILETYPE.FFS_PAD):
-                print(
-                    "  Padding file (off:{:x} len:{:x})".format(
-                        offset, int(ffshdr.Size)
-                    )
-                )
-                pad_file = PaddingFile(
-                    offset, self.FvData[offset : offset + int(ffshdr.Size)]
-                )
-                self.FfsList.append(pad_file)
-                offset += int(ffshdr.Size)
-            elif (ffs_name == GUID_EMPTY) and (int(ffshdr.Size) == 0xFFFFFF):
-                print(
-                    "  Free space (off: {:x} len: {:x})".format(offset, fvsize - offset)
-                )
-                pad_file = PaddingFile(offset, self.FvData[offset:fvsize])
-                self.FfsList.append(pad_file)
-                offset = fvsize
-            elif ffs_name == GUID_VARIABLE_STORE_SIGNATURE:
-                print("  VSS file")
-                vsshdr = VARIABLE_STORE_HEADER.from_buffer(self.FvData, offset)
-                vss = MiscFile(
-                    vsshdr.Signature, offset, self.FvData[offset : offset + vsshdr.Size]
-                )
-                self.FfsList.append(vss)
-                offset += vsshdr.Size
-            elif ffs_name == GUID_FTW_WORKING_BLOCK_SIGNATURE:
-                print("  FTW file")
-                ftwhdr = FTW_HEADER.from_buffer(self.FvData, offset)
-                ftw = MiscFile(
-                    ftwhdr.Signature,
-                    offset,
-                    self.FvData[
-                        offset : offset + ftwhdr.WriteQueueSize + sizeof(FTW_HEADER)
-                    ],
-                )
-                self.FfsList.append(ftw)
-                offset += ftwhdr.WriteQueueSize + sizeof(FTW_HEADER)
-            elif ffs_name == GUID_MICROCODE_SIGNATURE:
-                print("  Microcode file")
-                ucode = MiscFile(
-                    ffshdr.Name, offset, self.FvData[offset : offset + int(ffshdr.Size)]
-                )
-                self.FfsList.append(ucode)
-                offset += int(ffshdr.Size)
-            elif ffs_name == GUID_FSP_INFO_HEADER:
-                print("  FSP Info Header file")
-                self.FspExists = True
-                ffs = FirmwareFile(offset, self.FvData[offset : offset + int(ffshdr.Size)])
-                self.FfsList.append(ffs)
-                offset += int(ffshdr.Size)
-            else:
-                print("  FFS file")
-                ffs = FirmwareFile(
-                    offset, self.FvData[offset : offset + int(ffshdr.Size)]
-                )
+        for event in file_events(self.Buffer, self.Base):
+            ffs = self.add_file(event)
+            if event.kind == FV_EVENT.FFS and event.name != _FSP_INFO_HEADER:
                 ffs.ParseFfs()
-                self.FfsList.append(ffs)
-                offset += int(ffshdr.Size)
 
-            # Make sure 8-byte aligned
-            offset = align(offset)
+    def add_file(self, event):
+        """Add the node of a file event of the volume to FfsList"""
+
+        offset = event.offset - self.Base
+        if event.kind == FV_EVENT.PAD_FILE:
+            print(
+                "  Padding file (off:{:x} len:{:x})".format(
+                    offset, event.length
+                )
+            )
+            ffs = PaddingFile(offset, self.Buffer, event.offset, event.length)
+        elif event.kind == FV_EVENT.FREE_SPACE:
+            print(
+                "  Free space (off: {:x} len: {:x})".format(offset, event.length)
+            )
+            ffs = PaddingFile(offset, self.Buffer, event.offset, event.length)
+        elif event.kind == FV_EVENT.VSS:
+            print("  VSS file")
+            ffs = MiscFile(event.header.Signature, offset, self.Buffer, event.offset,
+                           event.length)
+        elif event.kind == FV_EVENT.FTW:
+            print("  FTW file")
+            ffs = MiscFile(event.header.Signature, offset, self.Buffer, event.offset,
+                           event.length)
+        elif event.kind == FV_EVENT.MICROCODE:
+            print("  Microcode file")
+            ffs = MiscFile(event.header.Name, offset, self.Buffer, event.offset,
+                           event.length)
+        elif event.name == _FSP_INFO_HEADER:
+            print("  FSP Info Header file")
+            self.FspExists = True
+            ffs = FirmwareFile(offset, self.Buffer, event.offset)
+        else:
+            print("  FFS file")
+            ffs = FirmwareFile(offset, self.Buffer, event.offset)
+        self.FfsList.append(ffs)
+        return ffs
+
 
+class FirmwareFile(_Node):
+    """A firmware file at base of filedata, its start by default"""
 
-class FirmwareFile:
-    def __init__(self, offset, filedata):
-        self.FfsHdr = EFI_FFS_FILE_HEADER.from_buffer(filedata, 0)
-        self.FfsData = filedata[0 : int(self.FfsHdr.Size)]
+    __slots__ = ("Offset", "SecList", "Name", "UiName")
+
+    def __init__(self, offset, filedata, base=0):
+        filedata = byte_view(filedata)
+        ffshdr = ffs_header(filedata, base)
+        super().__init__(filedata, base, ffshdr.Size)
         self.Offset = offset
         self.SecList = []
-        self.Name = self.FfsHdr.Name
+        self.Name = ffshdr.Name
+        self.UiName = None
+
+    @property
+    def FfsHdr(self):
+        return EFI_FFS_FILE_HEADER.from_buffer_copy(self.Buffer, self.Base)
+
+    FfsData = property(_Node.tobytes)
 
     def ParseFfs(self):
-        ffssize = len(self.FfsData)
-        offset = sizeof(self.FfsHdr)
-        if self.FfsHdr.Name != "\xff" * 16:
-            while offset < ffssize:
-                sechdr = EFI_COMMON_SECTION_HEADER.from_buffer(self.FfsData, offset)
-                sec = Section(offset, self.FfsData[offset : offset + int(sechdr.Size)])
-                self.SecList.append(sec)
-                offset += int(sechdr.Size)
-                offset = align(offset, 4)
-
-
-class Section:
-    def __init__(self, offset, secdata):
-        self.SecHdr = EFI_COMMON_SECTION_HEADER.from_buffer(secdata, 0)
-        self.SecData = secdata[0 : int(self.SecHdr.Size)]
+        for event in section_events(self.Buffer, self.Base + FFS_HEADER.size,
+                                    self.Length - FFS_HEADER.size):
+            self.add_section(event)
+
+    def add_section(self, event):
+        """Add the node of a section event of the file to SecList"""
+
+        sec = Section(event.offset - self.Base, self.Buffer, event.offset)
+        self.SecList.append(sec)
+        if sec.Type == EFI_SECTION_TYPE.USER_INTERFACE and self.UiName is None:
+            self.UiName = sec.Name
+        return sec
+
+
+def parse_sections(buffer, base, length):
+    """Return the Sections of buffer[base:base + length], with their Offset
+    counted from base"""
+
+    return [Section(event.offset - base, buffer, event.offset)
+            for event in section_events(buffer, base, length)]
+
+
+class Section(_Node):
+    """A section at base of secdata, its start by default"""
+
+    __slots__ = ("Offset", "Type", "Name", "_children")
+
+    def __init__(self, offset, secdata, base=0):
+        secdata = byte_view(secdata)
+        sechdr = section_header(secdata, base)
+        super().__init__(secdata, base, sechdr.Size)
         self.Offset = offset
-        self.Type = self.SecHdr.Type
-        if self.SecHdr.Type == EFI_SECTION_TYPE.USER_INTERFACE:
-            self.Name = self.SecData[4:].decode("utf-16le").rstrip("\0")
-        elif self.SecHdr.Type == EFI_SECTION_TYPE.FIRMWARE_VOLUME_IMAGE:
-            fv_sec = EFI_FIRMWARE_VOLUME_HEADER.from_buffer(
-                                           self.SecData,
-                                           sizeof(EFI_COMMON_SECTION_HEADER))
-            self.Name = fv_sec.FileSystemGuid
-        elif self.SecHdr.Type == EFI_SECTION_TYPE.GUID_DEFINED:
-            guided_sec = EFI_GUID_DEFINED_SECTION.from_buffer(
-                                self.SecData,
-                                sizeof(EFI_COMMON_SECTION_HEADER))
-            self.Name = guided_sec.SectionDefinitionGuid
+        self.Type = sechdr.Type
+        data = base + SECTION_HEADER.size
+        if self.Type == EFI_SECTION_TYPE.USER_INTERFACE:
+            self.Name = secdata[data:base + self.Length].tobytes().decode("utf-16le").rstrip("\0")
+        elif self.Type == EFI_SECTION_TYPE.FIRMWARE_VOLUME_IMAGE:
+            # FileSystemGuid of the volume header
+            self.Name = secdata[data + 16:data + 32].tobytes()
+        elif self.Type == EFI_SECTION_TYPE.GUID_DEFINED:
+            # SectionDefinitionGuid
+            self.Name = secdata[data:data + 16].tobytes()
         else:
-            self.Name = self.SecData[4:20]  # Any data
+            self.Name = secdata[data:data + 16].tobytes()  # Any data
+        self._children = None
+
+    @property
+    def SecHdr(self):
+        return EFI_COMMON_SECTION_HEADER.from_buffer_copy(self.Buffer, self.Base)
+
+    SecData = property(_Node.tobytes)
+
+    @property
+    def Children(self):
+        """The volume of a volume image section, or the sections encapsulated
+        in a GUIDed section, decoded the first time they are asked for
+
+        The data of GUIDed sections needing processing is decoded through
+        section_cache, the other children are views of the same buffer. The
+        list is empty for sections that cannot be decoded in-process.
+        """
+
+        if self._children is None:
+            self._children = self._decode_children()
+        return self._children
+
+    def _decode_children(self):
+        encapsulated = decode_section(self.Buffer, self.Base)
+        if encapsulated is None:
+            return []
+        buffer, base, length = encapsulated
+        if self.Type == EFI_SECTION_TYPE.FIRMWARE_VOLUME_IMAGE:
+            fv = FirmwareVolume(0, buffer, base)
+            fv.ParseFv()
+            return [fv]
+        return parse_sections(buffer, base, length)
 
     def __str__(self, indent=0):
         if (self.Type == EFI_SECTION_TYPE.FIRMWARE_VOLUME_IMAGE):
@@ -398,22 +1181,88 @@ class Section:
 
         return "Type:%02x Size:%x Info:%s" % (
                     self.Type,
-                    len(self.SecData),
+                    self.Length,
                     name)
 
 
-def main():
-    with open(sys.argv[1], "rb") as input_fd:
-        data = input_fd.read()
-        fd = FirmwareDevice(0, data)
-        fd.ParseFd()
+def _name_layout(name):
+    # The names of VSS and FTW stores are lists of bytes
+    return name.hex() if isinstance(name, bytes) else list(name)
+
+
+def _name_load(name):
+    return bytes.fromhex(name) if isinstance(name, str) else name
+
+
+def _node_layout(node):
+    """Return the index file entry of a node of the parse tree"""
+
+    if isinstance(node, FirmwareVolume):
+        return ["fv", node.Base, node.Length, node.Name.hex(), node._ext_offset,
+                [_node_layout(ffs) for ffs in node.FfsList]]
+    if isinstance(node, FirmwareFile):
+        sections = [[sec.Base, sec.Length, sec.Type,
+                     sec.Name if isinstance(sec.Name, str) else sec.Name.hex()]
+                    for sec in node.SecList]
+        return ["ffs", node.Base, node.Length, node.Name.hex(), sections]
+    if isinstance(node, MiscFile):
+        return ["misc", node.Base, node.Length, _name_layout(node.Name)]
+    return ["pad", node.Base, node.Length]
+
+
+def _load_node(buffer, entry, parent_base):
+    """Return the node of the parse tree of an index file entry
+
+    The entries were made from nodes within the same buffer, their slots are
+    set without going through __init__.
+    """
+
+    kind, base, length = entry[:3]
+    cls = _INDEX_KINDS.get(kind, PaddingFile)
+    node = cls.__new__(cls)
+    node.Buffer = buffer
+    node.Base = base
+    node.Length = length
+    node.Offset = base - parent_base
+    if cls is FirmwareFile:
+        node.Name = bytes.fromhex(entry[3])
+        node.SecList = sections = []
+        node.UiName = None
+        for sec_base, sec_length, sec_type, name in entry[4]:
+            sec = Section.__new__(Section)
+            sec.Buffer = buffer
+            sec.Base = sec_base
+            sec.Length = sec_length
+            sec.Offset = sec_base - base
+            sec.Type = sec_type
+            sec._children = None
+            if sec_type == EFI_SECTION_TYPE.USER_INTERFACE:
+                sec.Name = name
+                if node.UiName is None:
+                    node.UiName = name
+            else:
+                sec.Name = bytes.fromhex(name)
+            sections.append(sec)
+    elif cls is FirmwareVolume:
+        node.Name, node._ext_offset = bytes.fromhex(entry[3]), entry[4]
+        node.FfsList = [_load_node(buffer, ffs, base) for ffs in entry[5]]
+        node.FspExists = any(isinstance(ffs, FirmwareFile) and ffs.Name == _FSP_INFO_HEADER
+                             for ffs in node.FfsList)
+    elif cls is MiscFile:
+        node.Name = _name_load(entry[3])
+    return node
+
+
+_INDEX_KINDS = {"fv": FirmwareVolume, "ffs": FirmwareFile, "misc": MiscFile}
+
 
+def print_fd(fd):
     print("\nFound total {} Firmware Volumes:".format(len(fd.FvList)))
     for idx, fv in enumerate(fd.FvList):
         if isinstance(fv, PaddingFile):
             print("PAD%d:" % idx)
             print("  Offset : 0x%08X" % fv.Offset)
-            print("  Length : 0x%08X" % len(fv.Data))
+            print("  Length : 0x%08X" % fv.Length)
             continue
 
         if not fv.FvExtHdr:
@@ -439,7 +1288,7 @@ def main():
                     "    [%d] FFS (len:%x sections:%d guid:%s)"
                     % (
                         j,
-                        len(ffs.FfsData),
+                        ffs.Length,
                         len(ffs.SecList),
                         uuid.UUID(bytes_le=bytes(ffs.Name)),
                     )
@@ -447,15 +1296,41 @@ def main():
                 for k, sec in enumerate(ffs.SecList):
                     print("       | SEC%d (%s)" % (k, sec))
             elif isinstance(ffs, PaddingFile):
-                print("    [%d] FREE (len:%x)" % (j, len(ffs.Data)))
+                print("    [%d] FREE (len:%x)" % (j, ffs.Length))
             elif isinstance(ffs, MiscFile):
                 print(
                     "    [%d] MISC (len:%x guid:%s)"
-                    % (j, len(ffs.Data), uuid.UUID(bytes_le=bytes(ffs.Name)))
+                    % (j, ffs.Length, uuid.UUID(bytes_le=bytes(ffs.Name)))
                 )
 
     print("\n")
 
 
+def main():
+    parser = argparse.ArgumentParser(description="A simple UEFI firmware volume parser")
+    parser.add_argument("image", help="image to parse")
+    parser.add_argument("--verify", action="store_true",
+                        help="check the volume and file checksums instead of printing"
+                             " the volumes, exit with 1 on errors")
+    parser.add_argument("--index", action="store_true",
+                        help="load the volumes from the index file of the image, saving"
+                             " it next to the image if it is missing or out of date")
+    args = parser.parse_args()
+
+    with FirmwareDevice.from_file(args.image) as fd:
+        if args.verify:
+            errors = fd.verify()
+            for offset, error in errors:
+                print("{:#x}: {}".format(offset, error))
+            print("{} errors found".format(len(errors)))
+            return 1 if errors else 0
+
+        if args.index:
+            fd.parse(write_index=True)
+        else:
+            fd.ParseFd()
+        print_fd(fd)
+
+
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,226 @@
+# @file
+# Compare two images volume by volume, file by file and section by section
+#
+# Copyright (c) 2019, Intel Corporation. All rights reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+
+import os
+import sys
+import uuid
+import hashlib
+from collections import namedtuple
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.firmware_volume import (
+    EFI_SECTION_TYPE,
+    FFS_HEADER,
+    FV_EVENT,
+    FirmwareDevice,
+    decode_section,
+    file_events,
+    fv_header,
+    fv_name,
+    section_events,
+    section_header,
+)
+
+##############################################################################
+#
+# The top level volumes of each image, and the data between them, are found
+# from the events of FirmwareDevice. The files of a volume, the sections of a
+# file and the volume or sections encapsulated in a section are read from
+# their headers only when their parent differs, without building the parse
+# tree. Nodes are matched by name within their parent, the Nth volume or file
+# of a GUID in one image with the Nth of the same GUID in the other, sections
+# by their index.
+#
+# The SHA256 of the nodes are computed in parallel threads (hashlib does not
+# hold the GIL while hashing), so the volumes a stitch did not touch are
+# compared at the cost of hashing them once. The digests of the index file of
+# an image are used instead, when it has one.
+#
+##############################################################################
+
+# A node of an image: key matching it in the other image, label to report,
+# buffer holding it, offset and length in the buffer, and function returning
+# the list of its child nodes. The buffer of the nodes in compressed sections
+# is the decompressed data.
+DiffNode = namedtuple("DiffNode", ["key", "label", "buffer", "offset", "length", "children"])
+
+# A difference: "added", "removed" or "changed", depth of the node in the
+# image, and the node in the old and in the new image, None when missing
+Change = namedtuple("Change", ["status", "depth", "old", "new"])
+
+SECTION_NAMES = {value: name for name, value in vars(EFI_SECTION_TYPE).items()
+                 if not name.startswith("_")}
+
+# Files without a name of their own to match
+_UNNAMED_FILES = (FV_EVENT.PAD_FILE, FV_EVENT.FREE_SPACE)
+
+
+def _no_children():
+    return []
+
+
+def _occurrence_key(seen, kind, name):
+    count = seen.get((kind, name), 0)
+    seen[(kind, name)] = count + 1
+    return (kind, name, count)
+
+
+def _name(name):
+    if isinstance(name, bytes) and len(name) == 16:
+        return str(uuid.UUID(bytes_le=name)).upper()
+    return name.decode("ascii", "replace") if isinstance(name, bytes) else ""
+
+
+def volume_node(key, buffer, offset):
+    """Return the DiffNode of the volume at offset of buffer"""
+
+    fvh = fv_header(buffer, offset)
+    length = min(fvh.FvLength, len(buffer) - offset)
+    return DiffNode(key, "FV {}".format(_name(fv_name(fvh, buffer, offset))), buffer,
+                    offset, length, partial(file_nodes, buffer, offset))
+
+
+def file_nodes(buffer, base):
+    """Return the DiffNode of the files of the volume at base of buffer"""
+
+    nodes = []
+    seen = {}
+    for event in file_events(buffer, base):
+        if event.kind in _UNNAMED_FILES:
+            continue
+        label = "{} {}".format(event.kind.upper(), _name(event.name))
+        children = _no_children
+        if event.kind == FV_EVENT.FFS:
+            header_size = FFS_HEADER.size
+            children = partial(section_nodes, buffer, event.offset + header_size,
+                               event.length - header_size)
+            for sec in section_events(buffer, event.offset + header_size,
+                                      event.length - header_size):
+                if sec.header.Type == EFI_SECTION_TYPE.USER_INTERFACE:
+                    label = "{} {}".format(label, sec.name)
+                    break
+        nodes.append(DiffNode(_occurrence_key(seen, event.kind, event.name), label, buffer,
+                              event.offset, event.length, children))
+    return nodes
+
+
+def section_nodes(buffer, base, length):
+    """Return the DiffNode of the sections of buffer[base:base + length]"""
+
+    nodes = []
+    for event in section_events(buffer, base, length):
+        sec_type = event.header.Type
+        label = "Section {} {}".format(len(nodes), SECTION_NAMES.get(sec_type, hex(sec_type)))
+        children = _no_children
+        if sec_type in (EFI_SECTION_TYPE.GUID_DEFINED, EFI_SECTION_TYPE.FIRMWARE_VOLUME_IMAGE):
+            children = partial(encapsulated_nodes, buffer, event.offset)
+        nodes.append(DiffNode((FV_EVENT.SECTION, len(nodes)), label, buffer, event.offset,
+                              event.length, children))
+    return nodes
+
+
+def encapsulated_nodes(buffer, offset):
+    """Return the DiffNode of the volume or sections encapsulated in the
+    section at offset of buffer, none if it cannot be decoded"""
+
+    sec_type = section_header(buffer, offset).Type
+    encapsulated = decode_section(buffer, offset)
+    if encapsulated is None:
+        return []
+    buffer, base, length = encapsulated
+    if sec_type == EFI_SECTION_TYPE.FIRMWARE_VOLUME_IMAGE:
+        return [volume_node((FV_EVENT.FV_START, None, 0), buffer, base)]
+    return section_nodes(buffer, base, length)
+
+
+def image_nodes(fd):
+    """Return the DiffNode of the top level volumes of the FirmwareDevice
+    fd, and of the data between them"""
+
+    nodes = []
+    seen = {}
+    for event in fd.events(sections=False):
+        if event.kind == FV_EVENT.PADDING:
+            nodes.append(DiffNode(_occurrence_key(seen, event.kind, None), "Padding",
+                                  fd.Buffer, event.offset, event.length, _no_children))
+        elif event.kind == FV_EVENT.FV_START:
+            key = _occurrence_key(seen, event.kind, event.name)
+            nodes.append(volume_node(key, fd.Buffer, event.offset))
+    return nodes
+
+
+def _digest(node):
+    return hashlib.sha256(node.buffer[node.offset:node.offset + node.length]).digest()
+
+
+def _digest_function(fd):
+    """Return the function giving the digest of a node of fd, from the
+    Digests of its parse tree when known"""
+
+    def digest(node):
+        if node.buffer is fd.Buffer and node.offset in fd.Digests:
+            return fd.Digests[node.offset]
+        return _digest(node)
+
+    return digest if fd.Digests else _digest
+
+
+def _compare(pool, old_nodes, new_nodes, depth, changes, digests):
+    old_digest, new_digest = digests
+    old_digests = pool.map(old_digest, old_nodes)
+    new_digests = pool.map(new_digest, new_nodes)
+    old_by_key = {node.key: (node, digest) for node, digest in zip(old_nodes, old_digests)}
+    new_keys = set(node.key for node in new_nodes)
+
+    for node in old_nodes:
+        if node.key not in new_keys:
+            changes.append(Change("removed", depth, node, None))
+    for node, digest in zip(new_nodes, new_digests):
+        if node.key not in old_by_key:
+            changes.append(Change("added", depth, None, node))
+            continue
+        old_node, old_digest = old_by_key[node.key]
+        if digest != old_digest:
+            changes.append(Change("changed", depth, old_node, node))
+            _compare(pool, old_node.children(), node.children(), depth + 1, changes,
+                     digests)
+
+
+def diff_devices(old, new, max_workers=None):
+    """Return the list of Change from the FirmwareDevice old to new, each
+    changed node followed by the changes of its children"""
+
+    changes = []
+    digests = (_digest_function(old), _digest_function(new))
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        _compare(pool, image_nodes(old), image_nodes(new), 0, changes, digests)
+    return changes
+
+
+def diff_images(old_file, new_file, max_workers=None):
+    """Return the list of Change from the image file old_file to new_file,
+    using the digests of their index files when they have one"""
+
+    with FirmwareDevice.from_file(old_file) as old, FirmwareDevice.from_file(new_file) as new:
+        old.load_index()
+        new.load_index()
+        return diff_devices(old, new, max_workers)
+
+
+def format_change(change):
+    """Return a line describing change, with the offsets of the node"""
+
+    node = change.new or change.old
+    if change.status == "changed" and change.old.offset != change.new.offset:
+        where = "{:#x} -> {:#x}".format(change.old.offset, change.new.offset)
+    else:
+        where = "{:#x}".format(node.offset)
+    return "{:8} {}{} at {} ({:#x} bytes)".format(change.status, "  " * change.depth,
+                                                  node.label, where, node.length)
@@ -0,0 +1,151 @@
+# @file
+# In-process versions of the GUIDed section tools listed in FmmtConf.ini
+#
+# Copyright (c) 2019, Intel Corporation. All rights reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+
+import os
+import sys
+import lzma
+import uuid
+import time
+from functools import lru_cache
+
+from cryptography.hazmat.primitives import hashes as hashes
+from cryptography.hazmat.primitives import serialization as serialization
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import padding as crypto_padding
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import compression
+from common import utilities as utils
+from common.firmware_volume import GUIDED_SECTION_COMPRESSED, GUIDED_SECTION_RSASHA256
+
+##############################################################################
+#
+# An RSA2048SHA256SIGN section, as written by rsa_helper.py, holds the GUID
+# of the hash algorithm (16 bytes), the public key modulus (256 bytes, big
+# endian) and the PKCS#1 v1.5 signature of the data (256 bytes), followed by
+# the data itself.
+#
+##############################################################################
+
+# GUID for SHA 256 Hash Algorithm from UEFI Specification
+EFI_HASH_ALGORITHM_SHA256_GUID = uuid.UUID("51aa59de-fdf2-4ea3-bc63-875fb7842ee9")
+
+RSA_KEY_SIZE = 2048
+RSA_KEYMOD_SIZE = RSA_KEY_SIZE // 8
+RSA_SIGNATURE_SIZE = RSA_KEY_SIZE // 8
+RSA_HEADER_SIZE = 16 + RSA_KEYMOD_SIZE + RSA_SIGNATURE_SIZE
+
+
+class GuidedToolError(Exception):
+    """A GUIDed section cannot be processed in-process"""
+
+
+@lru_cache(maxsize=8)
+def _load_pem(pem):
+    key = serialization.load_pem_private_key(pem, password=None, backend=default_backend())
+    if key.key_size != RSA_KEY_SIZE:
+        raise GuidedToolError("Key size {} bits is not supported".format(key.key_size))
+    modulus = key.public_key().public_numbers().n.to_bytes(RSA_KEYMOD_SIZE, "big")
+    return key, modulus
+
+
+@lru_cache(maxsize=8)
+def _load_key(key_file, mtime, size):
+    with open(key_file, "rb") as privkey_file:
+        return _load_pem(privkey_file.read())
+
+
+def load_key(key_file):
+    """Return the private key object and public modulus of key_file, a file
+    name or the PEM data of the key
+
+    Keys are loaded once and reused while the file is unchanged.
+    """
+
+    if isinstance(key_file, (bytes, bytearray)):
+        try:
+            return _load_pem(bytes(key_file))
+        except ValueError as err:
+            raise GuidedToolError("Cannot load private key: {}".format(err))
+
+    key_file = os.path.abspath(key_file)
+    try:
+        stat = os.stat(key_file)
+    except OSError as err:
+        raise GuidedToolError("Cannot read private key: {}".format(err))
+    try:
+        return _load_key(key_file, stat.st_mtime_ns, stat.st_size)
+    except ValueError as err:
+        raise GuidedToolError("Cannot load private key {}: {}".format(key_file, err))
+
+
+def rsa_encode(data, key_file=None):
+    """Prepend the hash GUID, public key and signature of data, signed with
+    the private key key_file"""
+
+    if key_file is None:
+        raise GuidedToolError("A private key is required to sign the section")
+    key, modulus = load_key(key_file)
+    signature = key.sign(bytes(data), crypto_padding.PKCS1v15(), hashes.SHA256())
+    return EFI_HASH_ALGORITHM_SHA256_GUID.bytes_le + modulus + signature + bytes(data)
+
+
+def rsa_decode(data):
+    """Strip the hash GUID, public key and signature"""
+
+    if len(data) < RSA_HEADER_SIZE:
+        raise GuidedToolError("RSA signed section is truncated")
+    return bytes(data[RSA_HEADER_SIZE:])
+
+
+def lzma_encode(data, key_file=None):
+    return compression.cached_compress(compression.LZMA_METHOD, bytes(data),
+                                       compression.lzma_compress)
+
+
+def lzma_decode(data):
+    try:
+        return compression.lzma_decompress(data)
+    except (ValueError, EOFError, lzma.LZMAError) as err:
+        raise GuidedToolError("Bad LZMA section: {}".format(err))
+
+
+# GUIDed tools by section definition GUID: (decode, encode)
+GUIDED_TOOLS = {
+    GUIDED_SECTION_COMPRESSED.bytes_le: (lzma_decode, lzma_encode),
+    GUIDED_SECTION_RSASHA256.bytes_le: (rsa_decode, rsa_encode),
+}
+
+
+def is_supported(guid):
+    return bytes(guid) in GUIDED_TOOLS
+
+
+def _timed(tool, *args):
+    start = time.perf_counter()
+    try:
+        return tool(*args)
+    finally:
+        utils.record_timing(tool.__name__, time.perf_counter() - start,
+                            ["{} bytes".format(len(args[0]))])
+
+
+def decode(guid, data):
+    """Return the data of a GUIDed section as its tool decodes it"""
+
+    if not is_supported(guid):
+        raise GuidedToolError("No GUIDed tool for section")
+    return _timed(GUIDED_TOOLS[bytes(guid)][0], data)
+
+
+def encode(guid, data, key_file=None):
+    """Return the data of a GUIDed section as its tool encodes it"""
+
+    if not is_supported(guid):
+        raise GuidedToolError("No GUIDed tool for section")
+    return _timed(GUIDED_TOOLS[bytes(guid)][1], data, key_file)
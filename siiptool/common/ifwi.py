@@ -7,12 +7,13 @@
 """A simple IFWI image parser"""
 
 import sys
+import mmap
 import uuid
 from ctypes import Structure
 from ctypes import c_char, c_uint32, c_uint8, c_uint64, c_uint16, sizeof, ARRAY
 from functools import reduce
 
-from common.firmware_volume import FirmwareDevice
+from common.firmware_volume import FirmwareDevice, map_image
 
 
 class SPI_DESCRIPTOR(Structure):
@@ -37,11 +38,34 @@ class SPI_DESCRIPTOR(Structure):
 
 
 class IFWI_IMAGE:
-    def __init__(self, filename):
+    def __init__(self, filename, data=None):
+        """data is the content of filename when it is already loaded or
+        mapped, in which case the file is not read"""
         self.region_list = []
-        with open(filename, "rb") as fd:
-            self.data = bytearray(fd.read())
-        self.spi_desc = SPI_DESCRIPTOR.from_buffer(self.data)
+        if data is None:
+            with open(filename, "rb") as fd:
+                data = bytearray(fd.read())
+        self.data = data
+        self.spi_desc = SPI_DESCRIPTOR.from_buffer_copy(self.data)
+
+    @classmethod
+    def from_file(cls, filename, writable=False):
+        """Return the IFWI_IMAGE of a mapped file, see map_image(). Only the
+        pages that are read are loaded from the file."""
+
+        return cls(filename, map_image(filename, writable))
+
+    def close(self):
+        """Unmap the file of from_file()"""
+
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     def is_ifwi_image(self):
         return self.spi_desc.fl_val_sig == self.spi_desc.DESC_SIGNATURE
@@ -82,18 +106,18 @@ class IFWI_IMAGE:
 def main():
 
     # Sample code
-    ifwi = IFWI_IMAGE(sys.argv[1])
-    if not ifwi.is_ifwi_image():
-        print("Bad IFWI image")
-        exit(1)
-
-    ifwi.parse()
-    bios_start = ifwi.region_list[1][1]
-    bios_limit = ifwi.region_list[1][2]
-
-    print("Parsing BIOS ...")
-    bios = FirmwareDevice(0, ifwi.data[bios_start : bios_limit + 1])
-    bios.ParseFd()
+    with IFWI_IMAGE.from_file(sys.argv[1]) as ifwi:
+        if not ifwi.is_ifwi_image():
+            print("Bad IFWI image")
+            exit(1)
+
+        ifwi.parse()
+        bios_start = ifwi.region_list[1][1]
+        bios_limit = ifwi.region_list[1][2]
+
+        print("Parsing BIOS ...")
+        with FirmwareDevice(0, memoryview(ifwi.data)[bios_start : bios_limit + 1]) as bios:
+            bios.ParseFd()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,239 @@
+# @file
+# OBB digest of EDK2 and FSP wrapper BIOS images
+#
+# Copyright (c) 2019, Intel Corporation. All rights reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+
+import os
+import sys
+import uuid
+
+from cryptography.hazmat.primitives import hashes as hashes
+from cryptography.hazmat.backends import default_backend
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import ffs_replace
+from common import utilities as utils
+from common.firmware_volume import GUID_FSP_INFO_HEADER, fv_header, fv_name, scan_volumes
+from common.ifwi import IFWI_IMAGE
+
+##############################################################################
+#
+# The OBB digest is the SHA256 of the OBB volumes of the BIOS region, which
+# start at FVSECURITY: FVSECURITY, FVOSBOOT, FVUEFIBOOT_PRIME, FVADVANCED and
+# FVPOSTMEMORY for an EDK2 BIOS, followed by FSPS for an FSP wrapper BIOS.
+# The volumes are looked for at every 4KB of the region, the filler in
+# between is kept as an entry so the OBB volumes are known to be contiguous.
+#
+##############################################################################
+
+GUID_FVSECURITY = uuid.UUID("5A9A8B4E-149A-4CB2-BDC7-C8D62DE2C8CF")
+
+
+def _hash_range(ctx, view, offset, length, changes=None):
+    """Hash view[offset:offset + length] with the sorted (offset, data)
+    changes written over it, without copying view"""
+
+    end = offset + length
+    pos = offset
+    for c_off, new in changes or ():
+        c_end = c_off + len(new)
+        if c_end <= pos or c_off >= end:
+            continue
+        if c_off > pos:
+            ctx.update(view[pos:c_off])
+        ctx.update(memoryview(new)[max(pos, c_off) - c_off:min(end, c_end) - c_off])
+        pos = min(end, c_end)
+    if pos < end:
+        ctx.update(view[pos:end])
+
+
+class ObbDigestCache:
+    """Per-FV digests of base images and partial OBB hash contexts
+
+    FV digests are keyed by the key of the base image, as given by
+    ffs_replace.image_key(), and the (offset, length) of the FV within the
+    BIOS region. Only the FVs left unchanged from the base image are kept,
+    so the digests of one image are never used for another. A copy of the
+    running OBB hash context is kept after every FV, keyed by the digests of
+    all FVs hashed so far, so a later OBB digest only has to hash the bytes
+    from the first changed FV onwards.
+    """
+
+    MAX_CONTEXTS = 256
+    MAX_DIGESTS = 4096
+
+    def __init__(self):
+        self.fv_digests = {}
+        self.contexts = {}
+
+    def fv_digest(self, view, offset, length, base_key=None, release=None, changes=None):
+        """Return the digest of an FV, the one of the base image base_key
+        when known. The FV must be the same as in the base image. changes
+        are the (offset, data) written over view."""
+
+        key = (base_key, offset, length)
+        digest = self.fv_digests.get(key) if base_key is not None else None
+        if digest is None:
+            ctx = hashes.Hash(hashes.SHA256(), backend=default_backend())
+            _hash_range(ctx, view, offset, length, changes)
+            digest = ctx.finalize()
+            if base_key is not None:
+                if len(self.fv_digests) > self.MAX_DIGESTS:
+                    self.fv_digests.clear()
+                self.fv_digests[key] = digest
+            if release is not None:
+                release(offset, length)
+        return digest
+
+    def obb_digest(self, view, fv_ranges, changed_ranges=None, release=None,
+                   base_key=None, changes=None):
+        """Compute SHA256 over the FVs in fv_ranges
+
+        view is a memoryview over the BIOS region of an image made from the
+        base image base_key by changing the (offset, length) changed_ranges
+        of the region. The other FVs are only hashed the first time the base
+        image is seen. Without base_key or changed_ranges every FV is
+        hashed. release(offset, length) is called once an FV has been read.
+        changes are the sorted (offset, data) of the region written over
+        view, so a stitch can be hashed before it is applied.
+        """
+
+        if changed_ranges is not None and changes:
+            changed_ranges = list(changed_ranges) + [(offset, len(new))
+                                                     for offset, new in changes]
+
+        def is_changed(offset, length):
+            if changed_ranges is None:
+                return True
+            return any(offset < c_off + c_len and c_off < offset + length
+                       for c_off, c_len in changed_ranges)
+
+        keys = []
+        for offset, length in fv_ranges:
+            unchanged_base = None if is_changed(offset, length) else base_key
+            digest = self.fv_digest(view, offset, length, unchanged_base, release, changes)
+            keys.append((offset, length, digest))
+
+        # Resume from the longest prefix of FVs we already hashed
+        start = len(keys)
+        while start > 0 and tuple(keys[:start]) not in self.contexts:
+            start -= 1
+        if start > 0:
+            ctx = self.contexts[tuple(keys[:start])].copy()
+        else:
+            ctx = hashes.Hash(hashes.SHA256(), backend=default_backend())
+
+        if len(self.contexts) > self.MAX_CONTEXTS:
+            self.contexts.clear()
+
+        for idx in range(start, len(keys)):
+            offset, length, _ = keys[idx]
+            _hash_range(ctx, view, offset, length, changes)
+            if release is not None:
+                release(offset, length)
+            self.contexts[tuple(keys[:idx + 1])] = ctx.copy()
+
+        return ctx.finalize()
+
+
+def _has_fsp_info(fv):
+    """Check for the FSP info header file in a volume"""
+
+    try:
+        files = ffs_replace.fv_files(fv)
+    except ffs_replace.NativeReplaceError:
+        return False
+    return any(not ffs.is_free and fv[ffs.offset:ffs.offset + 16] == GUID_FSP_INFO_HEADER.bytes_le
+               for ffs in files)
+
+
+def bios_volumes(bios, release=None):
+    """List the volumes of a BIOS region, found with scan_volumes(), reading
+    only their headers and the names of their files.
+
+    bios is a memoryview of the region. Returns (offset, length, name, fsp)
+    of every volume, fsp telling if it holds an FSP, and (offset, length,
+    None, False) for the filler found between volumes. release(offset,
+    length) is called for the ranges that have been read.
+    """
+
+    volumes = []
+    end = 0
+    for offset, length in scan_volumes(bios, release=release):
+        if offset > end:
+            volumes.append((end, offset - end, None, False))
+        fv = bios[offset:offset + length]
+        name = bytes(fv_name(fv_header(bios, offset), bios, offset))
+        volumes.append((offset, length, name, _has_fsp_info(fv)))
+        if release is not None:
+            release(offset, length)
+        end = offset + length
+
+    return volumes
+
+
+def obb_ranges(log, volumes):
+    """Return the (offset, length) of the OBB volumes out of bios_volumes()"""
+
+    names = [name for _, _, name, _ in volumes]
+    obb_fv_idx = names.index(GUID_FVSECURITY.bytes_le) \
+        if GUID_FVSECURITY.bytes_le in names else -1
+    if not (0 < obb_fv_idx < len(volumes)):
+        raise ValueError("Starting OBB FV is not found")
+
+    log.debug("OBB region starts from FV{}".format(obb_fv_idx))
+    if any(fsp for _, _, _, fsp in volumes):
+        # FVSECURITY + FVOSBOOT + FVUEFIBOOT_PRIME + FVADVANCED + FVPOSTMEMORY + FSPS
+        log.info("FSP Wrapper BIOS")
+        obb_fv_end = obb_fv_idx + 6
+    else:
+        # FVSECURITY + FVOSBOOT + FVUEFIBOOT_PRIME + FVADVANCED + FVPOSTMEMORY
+        log.info("EDK2 BIOS")
+        obb_fv_end = obb_fv_idx + 5
+    if None in names[obb_fv_idx:obb_fv_end]:
+        raise ValueError("Filler data found between the OBB FVs")
+    fv_ranges = [(offset, length) for offset, length, _, _ in volumes[obb_fv_idx:obb_fv_end]]
+
+    log.debug("OBB offset: {:x} len {:x}".format(
+        fv_ranges[0][0], sum(length for _, length in fv_ranges)))
+    return fv_ranges
+
+
+def image_digest(log, data, cache, changed_ranges=None, base_key=None, changes=None):
+    """Return the OBB digest of the IFWI image data
+
+    data is the image bytes or a map of the image file, whose pages are
+    released once read. cache is an ObbDigestCache, and changed_ranges the
+    (offset, length) of data changed from the base image base_key, whose
+    unchanged volumes are hashed once for all the images made from it.
+    changes are the (offset, data) of volumes replaced in data, hashed in
+    place of the bytes of data.
+    """
+
+    ifwi = IFWI_IMAGE(None, data)
+    if not ifwi.is_ifwi_image():
+        raise ValueError("Bad IFWI image")
+    bios_start, bios_limit = ifwi.find_ifwi_region("bios")
+    if bios_start is None:
+        raise ValueError("No BIOS region in the IFWI image")
+    if changed_ranges is not None:
+        changed_ranges = [(offset - bios_start, length) for offset, length in changed_ranges]
+    if changes is not None:
+        changes = sorted((offset - bios_start, new) for offset, new in changes)
+
+    log.info("Parsing BIOS ...")
+    view = memoryview(data)[bios_start:bios_limit + 1]
+    try:
+        def release(offset, length):
+            utils.release_pages(data, bios_start + offset, length)
+
+        volumes = bios_volumes(view, release)
+        for idx, (offset, length, _, _) in enumerate(volumes):
+            log.debug("FV {} @ {:x} len:{:x}".format(idx, offset, length))
+        return cache.obb_digest(view, obb_ranges(log, volumes), changed_ranges, release,
+                                base_key, changes)
+    finally:
+        view.release()
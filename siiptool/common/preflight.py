@@ -0,0 +1,130 @@
+# @file
+# Check the structure of an input image before any tool is run on it
+#
+# Copyright (c) 2019, Intel Corporation. All rights reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+
+import os
+import sys
+from ctypes import sizeof
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import ffs_replace
+from common import utilities as utils
+from common.firmware_volume import bad_volume_headers, fv_is_valid, scan_volumes
+from common.ifwi import IFWI_IMAGE, SPI_DESCRIPTOR
+from common.verify import untouched_ranges
+
+##############################################################################
+#
+# FMMT only reports a malformed image after parsing it for a long time, or
+# hangs on it until it is killed. These checks read the SPI descriptor, the
+# firmware volume headers and the files holding UI names, so bad inputs are
+# rejected before any tool is started:
+#
+#  - an image with a descriptor must have its regions within the file and
+#    not overlapping, and a BIOS region
+#  - an image without a descriptor is taken as a BIOS region, unless an
+#    IFWI image is required
+#  - the BIOS region must hold firmware volumes, each within the region and
+#    with a valid header checksum
+#  - the file of the UI name to replace must be found in the volumes of the
+#    BIOS region, unless some of them cannot be parsed in-process
+#
+# Only the BIOS region is scanned for volumes, with the scanner and header
+# checks of firmware_volume.
+#
+##############################################################################
+
+
+class PreflightError(Exception):
+    """The input image is malformed"""
+
+
+def flash_regions(image):
+    """Return the (name, base, limit) of the regions of an IFWI image, with
+    limit the offset of their last byte"""
+
+    regions = []
+    for name in sorted(SPI_DESCRIPTOR.FLASH_REGIONS, key=SPI_DESCRIPTOR.FLASH_REGIONS.get):
+        base, limit = image.find_ifwi_region(name)
+        if base is not None:
+            regions.append((name, base, limit))
+    return regions
+
+
+def check_regions(image):
+    """Return the (offset, length) of the BIOS region of an IFWI_IMAGE"""
+
+    data = image.data
+    regions = flash_regions(image)
+    end = 0
+    for name, base, limit in sorted(regions, key=lambda region: region[1]):
+        if limit >= len(data):
+            raise PreflightError("Region {} ends at {:#x}, after the end of the image"
+                                 " at {:#x}".format(name, limit + 1, len(data)))
+        if base < end:
+            raise PreflightError("Region {} at {:#x} overlaps the previous region".format(
+                name, base))
+        end = limit + 1
+
+    bios = [(base, limit + 1 - base) for name, base, limit in regions if name == "bios"]
+    if not bios:
+        raise PreflightError("No BIOS region in the descriptor")
+    return bios[0]
+
+
+def check_volumes(data, start, length):
+    """Return the (offset, length) of the volumes of data[start:start + length]"""
+
+    end = start + length
+
+    # The pages of a map are released once scanned
+    def release(offset, size):
+        utils.release_pages(data, offset, size)
+
+    fvs = list(scan_volumes(data, start, end, release))
+    for gap_start, gap_length in untouched_ranges(end, [(0, start)] + fvs):
+        for offset in bad_volume_headers(data, gap_start, gap_start + gap_length, release):
+            if fv_is_valid(data, offset):
+                raise PreflightError("Volume at {:#x} ends after the end of the BIOS region"
+                                     " at {:#x}".format(offset, end))
+            raise PreflightError("Bad header checksum of the volume at {:#x}".format(offset))
+    if not fvs:
+        raise PreflightError("No firmware volume found")
+    return fvs
+
+
+def check_file(data, name, index=None, fvs=None):
+    """Check for one file of UI name in data
+
+    index is the index_files() of data when it is already known, fvs the
+    (offset, length) of the volumes to look in, all of them by default.
+    """
+
+    if index is not None and len(index.get(name, [])) == 1:
+        return
+    found, unparsed = ffs_replace.count_files(data, name, fvs)
+    if found > 1:
+        raise PreflightError("{} files named {} found".format(found, name))
+    if found == 0 and not unparsed:
+        raise PreflightError("Could not find file {}".format(name))
+
+
+def check_image(data, name=None, ifwi_required=False, index=None):
+    """Check the structure of the image data, and that it holds the file of
+    UI name. Raises PreflightError."""
+
+    image = IFWI_IMAGE(None, data) if len(data) >= sizeof(SPI_DESCRIPTOR) else None
+    if image is not None and image.is_ifwi_image():
+        bios_start, bios_length = check_regions(image)
+    elif ifwi_required:
+        raise PreflightError("No flash descriptor signature, not an IFWI image")
+    else:
+        bios_start, bios_length = 0, len(data)
+
+    fvs = check_volumes(data, bios_start, bios_length)
+    if name is not None:
+        check_file(data, name, index, fvs)
@@ -0,0 +1,213 @@
+# @file
+# Local stitch service answering requests on a Unix socket
+#
+# Copyright (c) 2019, Intel Corporation. All rights reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+
+import os
+import sys
+import json
+import stat
+import time
+import getpass
+import socket
+import socketserver
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+##############################################################################
+#
+# Requests and responses are JSON objects, one per line:
+#
+#  {"command": "stitch", "ifwi": ..., "ip": ..., "payload": ..., "key": ...,
+#   "output": ..., "delta": false}
+#      stitch payload into the base image ifwi and save the result, or its
+#      delta against ifwi, as output. Paths must be absolute, output and
+#      the optional "log" must not exist.
+#  {"command": "stats"}
+#      number of jobs run and failed since the service started
+#  {"command": "shutdown"}
+#      stop the service once the running jobs are done
+#
+# Every response has a "status" of "ok" or "failed", and "error" on failure.
+# Stitch responses also give "output", "returncode" and "seconds".
+#
+##############################################################################
+
+# The socket is only reachable by its user: it is made in the user's runtime
+# directory, or in a private directory of the temporary one, and is only
+# readable and writable by its owner
+RUNTIME_DIR_ENV = "XDG_RUNTIME_DIR"
+SOCKET_MODE = 0o600
+
+
+def _runtime_dir():
+    runtime_dir = os.environ.get(RUNTIME_DIR_ENV)
+    if runtime_dir:
+        return runtime_dir
+    return os.path.join(tempfile.gettempdir(), "siip_stitch-{}".format(getpass.getuser()))
+
+
+DEFAULT_SOCKET = os.path.join(_runtime_dir(), "siip_stitch.sock")
+
+# Memory for mapped base images in every worker
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+
+JOB_FIELDS = ("ifwi", "ip", "payload", "key", "output", "delta", "log")
+
+
+class ServiceError(Exception):
+    """The service cannot be reached or answered with an error"""
+
+
+def is_supported():
+    return hasattr(socket, "AF_UNIX")
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode("utf-8"))
+                if not isinstance(request, dict):
+                    raise ValueError("Request must be a JSON object")
+                response = self.server.dispatch(request)
+            except ValueError as err:
+                response = {"status": "failed", "error": str(err)}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+class StitchServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server running stitch requests in a pool of workers
+
+    worker(job) runs in the pool and returns the status of a job dictionary
+    holding JOB_FIELDS. validate(job) raises ValueError for bad jobs.
+    initializer(*initargs) is called once in every worker process, which is
+    where the workers set up the state they keep across jobs.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, worker, validate, max_workers=None,
+                 initializer=None, initargs=()):
+        self.worker = worker
+        self.validate = validate
+        self.pool = ProcessPoolExecutor(max_workers=max_workers,
+                                        initializer=initializer, initargs=initargs)
+        self.lock = threading.Lock()
+        self.jobs = 0
+        self.failed = 0
+        self.started = time.time()
+        super().__init__(path, _Handler)
+
+    def server_bind(self):
+        super().server_bind()
+        os.chmod(self.server_address, SOCKET_MODE)
+
+    def dispatch(self, request):
+        command = request.get("command")
+        if command == "stitch":
+            return self.stitch(request)
+        if command == "stats":
+            with self.lock:
+                return {"status": "ok", "jobs": self.jobs, "failed": self.failed,
+                        "uptime": time.time() - self.started}
+        if command == "shutdown":
+            threading.Thread(target=self.shutdown).start()
+            return {"status": "ok"}
+        raise ValueError("Unknown command {}".format(command))
+
+    def stitch(self, request):
+        job = {field: request.get(field) for field in JOB_FIELDS}
+        job["delta"] = bool(job["delta"])
+        self.validate(job)
+        job["log"] = job["log"] or os.devnull
+
+        start = time.perf_counter()
+        try:
+            status = self.pool.submit(self.worker, job).result()
+            error = None
+        except Exception as exc:
+            status, error = 1, str(exc)
+
+        with self.lock:
+            self.jobs += 1
+            if status != 0:
+                self.failed += 1
+
+        response = {
+            "status": "ok" if status == 0 else "failed",
+            "output": job["output"],
+            "delta": job["delta"],
+            "returncode": status,
+            "seconds": time.perf_counter() - start,
+        }
+        if error:
+            response["error"] = error
+        return response
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown()
+
+
+def remove_stale_socket(path):
+    """Remove the socket file of a service that is not running anymore"""
+
+    if not os.path.exists(path):
+        return
+    try:
+        request(path, {"command": "stats"})
+    except ServiceError:
+        os.remove(path)
+        return
+    raise ServiceError("A service is already running on {}".format(path))
+
+
+def make_socket_dir(path):
+    """Create the directory of the socket path. The default one must only
+    be accessible to the user, as it may be in the shared temporary one."""
+
+    socket_dir = os.path.dirname(os.path.abspath(path))
+    os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+    if socket_dir == os.path.dirname(DEFAULT_SOCKET):
+        info = os.stat(socket_dir)
+        if info.st_uid != os.getuid() or stat.S_IMODE(info.st_mode) & 0o077:
+            raise ServiceError("{} is accessible to other users".format(socket_dir))
+
+
+def serve(path, worker, validate, max_workers=None, initializer=None, initargs=()):
+    """Run the service on the Unix socket path until it is shut down"""
+
+    make_socket_dir(path)
+    remove_stale_socket(path)
+    server = StitchServer(path, worker, validate, max_workers, initializer, initargs)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def request(path, message, timeout=None):
+    """Send one request to the service on path and return its response"""
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            sock.sendall(json.dumps(message).encode("utf-8") + b"\n")
+            with sock.makefile("rb") as reply:
+                line = reply.readline()
+    except OSError as err:
+        raise ServiceError("Cannot reach the service on {}: {}".format(path, err))
+
+    if not line:
+        raise ServiceError("The service on {} closed the connection".format(path))
+    return json.loads(line.decode("utf-8"))
@@ -91,3 +91,6 @@ IP_OPTIONS = {
         ["peim", "76ED893A-B2F9-4C7D-A05F-1EA170ECF6CD", None],
     ],
 }
+
+# IPs signed with the RSA private key and included in the OBB digest
+KEY_REQUIRED_IPS = ["gop", "gfxpeim", "vbt"]
@@ -0,0 +1,126 @@
+# @file
+# Stitch IPs into images held in memory
+#
+# Copyright (c) 2019, Intel Corporation. All rights reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+
+import os
+import sys
+import logging
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import ffs_builder
+from common import ffs_replace
+from common import obb_digest
+from common import preflight
+from common import utilities as utils
+from common.firmware_volume import byte_view
+from common.siip_constants import IP_OPTIONS, KEY_REQUIRED_IPS
+
+##############################################################################
+#
+# Python entry points doing what siip_stitch.py does, without files or
+# processes: the firmware file of the IP is built in-process (see
+# ffs_builder.py), replaced in place in the top level volume holding it and,
+# for the IPs signed with a key, the OBB digest is updated the same way.
+#
+#   from common.stitch import stitch
+#   image = stitch(image, "pse", payload)
+#
+# The image is any bytes-like object, which is never copied: the OBB digest
+# is computed over the image with the changed volumes laid over it. The key
+# is the file name or the PEM data of the private RSA key. Only the changed
+# volumes are held in memory besides the image, and stitch_to() writes the
+# result to a stream without building it in memory.
+#
+##############################################################################
+
+logger = logging.getLogger(__name__)
+
+
+class StitchError(Exception):
+    """The IP cannot be stitched into the image"""
+
+
+def _searchable(image):
+    # The volume scan uses find() when there is one, so a memoryview over a
+    # whole bytes, bytearray or mmap is scanned through the object itself
+    if hasattr(image, "find"):
+        return image
+    view = byte_view(image)
+    if hasattr(view.obj, "find") and view.c_contiguous:
+        with memoryview(view.obj) as whole:
+            if whole.nbytes == view.nbytes:
+                return view.obj
+    return view
+
+
+def stitch_changes(image, ip, payload, key=None, log=logger):
+    """Return the sorted (offset, data) of the top level volumes of image
+    changed by stitching payload as the IP ip. Raises StitchError."""
+
+    if ip not in IP_OPTIONS:
+        raise StitchError("Unknown IP {}".format(ip))
+    if ip in KEY_REQUIRED_IPS and key is None:
+        raise StitchError("A private key is required to stitch {}".format(ip))
+    if not payload:
+        raise StitchError("The {} payload is empty".format(ip))
+
+    utils.reset_timings()
+    image = _searchable(image)
+    ui_name = IP_OPTIONS[ip][0][1]
+    try:
+        preflight.check_image(image, ui_name, ip in KEY_REQUIRED_IPS)
+        ffs = ffs_builder.build(log, ip, payload)
+        changes = dict(ffs_replace.replace_volumes(image, ui_name, ffs, key))
+
+        # The OBB digest is computed over the stitched volumes and stored in
+        # a volume of its own, both changes are merged by volume offset
+        if ip in KEY_REQUIRED_IPS:
+            digest = obb_digest.image_digest(log, image, obb_digest.ObbDigestCache(),
+                                             changes=changes.items())
+            digest_ffs = ffs_builder.build(log, "obb_digest", digest)
+            changes.update(ffs_replace.replace_volumes(
+                image, IP_OPTIONS["obb_digest"][0][1], digest_ffs, key, replaced=changes))
+    except (preflight.PreflightError, ffs_replace.NativeReplaceError,
+            ffs_builder.FfsBuildError, ValueError) as err:
+        raise StitchError(str(err))
+
+    return sorted(changes.items())
+
+
+def stitch(image, ip, payload, key=None, log=logger):
+    """Return a copy of image with payload stitched as the IP ip"""
+
+    view = memoryview(image)
+    try:
+        changes = stitch_changes(image, ip, payload, key, log)
+        pieces = []
+        offset = 0
+        for start, new in changes:
+            pieces.extend([view[offset:start], new])
+            offset = start + len(new)
+        pieces.append(view[offset:])
+        return b"".join(pieces)
+    finally:
+        view.release()
+
+
+def stitch_to(image, ip, payload, out, key=None, log=logger):
+    """Write image with payload stitched as the IP ip to the binary stream
+    out, and return the (offset, length) ranges that were changed"""
+
+    changes = stitch_changes(image, ip, payload, key, log)
+    view = memoryview(image)
+    try:
+        offset = 0
+        for start, new in changes:
+            out.write(view[offset:start])
+            out.write(new)
+            offset = start + len(new)
+        out.write(view[offset:])
+    finally:
+        view.release()
+    return [(start, len(new)) for start, new in changes]
@@ -13,6 +13,7 @@ import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from common import subregion_descriptor as subrgn_descptr
+from common import compression
 from common.utilities import get_key_and_value
 from common.siip_constants import IP_OPTIONS
 from common.tools_path import GENFV, GENFFS, GENSEC, LZCOMPRESS
@@ -32,7 +33,8 @@ from common.tools_path import GENFV, GENFFS, GENSEC, LZCOMPRESS
 # 'depex' creates EFI_SECTION_PEI_DEPEX
 # 'cmprs' creates EFI_SECTION_COMPRESSION
 #
-# 'lzma' calls the LzmaCompress
+# 'lzma' compresses like LzmaCompress (in-process for -e, see compression.py,
+#        decoded by LzmaCompress but not byte-identical to its output)
 #
 # The following list is for GenFfs.exe
 # 'free' creates EFI_FV_FILETYPE_FREEFORM
@@ -111,6 +113,10 @@ def create_gensec_cmd(cmd_options, inputfile):
 def compress(compress_method, inputfile):
     """ compress the sections """
 
+    # LZMA encoding is done in-process, results are cached per content
+    if compress_method == "-e":
+        return [compression.lzma_compress_file, inputfile, "tmp.cmps"]
+
     cmd = [LZCOMPRESS, compress_method, "-o", "tmp.cmps", inputfile]
     return cmd
 
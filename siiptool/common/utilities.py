@@ -6,25 +6,319 @@
 #
 
 import os
+import mmap
+import shutil
+import signal
 import subprocess
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 
-def execute_cmds(log, cmds):
-    """execute commands created from the build list"""
+# Seconds a tool may run before it is killed along with its children
+TOOL_TIMEOUT = 600
+
+# Tools writing files besides the one given by -o (GenFv writes a .map and
+# a .txt file next to the volume), never taken from the artifact cache since
+# only the -o file would be restored
+SIDE_OUTPUT_TOOLS = ("GenFv",)
+
+# (command name, seconds, argv) of every tool run by run_tool or
+# execute_cmds and of the in-process tools
+tool_timings = []
+# (phase name, seconds) of the parts of a stitch timed with phase()
+phase_timings = []
+_timings_lock = threading.Lock()
+
+
+def record_timing(name, seconds, argv=None):
+    with _timings_lock:
+        tool_timings.append((name, seconds, [str(arg) for arg in argv or []]))
+
+
+def reset_timings():
+    """Forget the timings recorded so far
+
+    Processes running several stitches, like the workers of a batch or of
+    the stitch service, call it before every stitch so the timings do not
+    grow with the number of stitches.
+    """
+
+    with _timings_lock:
+        del tool_timings[:]
+        del phase_timings[:]
+
+
+@contextmanager
+def phase(name):
+    """Record the time spent in the block as phase name"""
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        with _timings_lock:
+            phase_timings.append((name, time.perf_counter() - start))
+
+
+def timing_report(total=None):
+    """Return the phase and tool timings recorded so far as a dictionary"""
+
+    with _timings_lock:
+        return {
+            "total": total,
+            "phases": [{"name": name, "seconds": seconds}
+                       for name, seconds in phase_timings],
+            "tools": [{"name": name, "argv": argv, "seconds": seconds}
+                      for name, seconds, argv in tool_timings],
+        }
+
+
+def kill_process_group(proc):
+    """Kill a process started by run_tool and every process it started"""
+
+    if sys.platform == "win32":
+        subprocess.call(["taskkill", "/F", "/T", "/PID", str(proc.pid)],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    else:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def run_tool(command, timeout=TOOL_TIMEOUT, cwd=None, capture=False):
+    """Run a tool in its own process group and wait for it
+
+    On timeout, or when interrupted, only the tool and its children are
+    killed. Raises subprocess.TimeoutExpired or subprocess.CalledProcessError
+    like subprocess.run(check=True). stdout is returned as text if captured.
+    """
+
+    kwargs = {}
+    if sys.platform == "win32":
+        kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs["start_new_session"] = True
+    if capture:
+        kwargs["stdout"] = subprocess.PIPE
+        kwargs["universal_newlines"] = True
+
+    start = time.perf_counter()
+    with subprocess.Popen(command, cwd=cwd, **kwargs) as proc:
+        try:
+            stdout, _ = proc.communicate(timeout=timeout)
+        except BaseException:
+            kill_process_group(proc)
+            proc.wait()
+            raise
+        finally:
+            record_timing(os.path.basename(str(command[0])), time.perf_counter() - start,
+                          command)
+
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, command, stdout)
+    return subprocess.CompletedProcess(command, proc.returncode, stdout)
+
+
+def _in_dir(cwd, arg):
+    if cwd and isinstance(arg, str) and not os.path.isabs(arg):
+        return os.path.join(cwd, arg)
+    return arg
+
+
+def _step_key(cache, command, cwd):
+    """Cache key and output file of a tool writing the file given by -o
+
+    The key covers the tool, the command line and the content of every
+    argument naming an existing file. Returns None, None for other commands
+    and for the SIDE_OUTPUT_TOOLS.
+    """
+
+    if os.path.splitext(os.path.basename(str(command[0])))[0] in SIDE_OUTPUT_TOOLS:
+        return None, None
+    try:
+        output = command.index("-o") + 1
+        tool = os.stat(command[0])
+    except (ValueError, OSError):
+        return None, None
+    if output >= len(command):
+        return None, None
+
+    parts = [str(tool.st_size), str(tool.st_mtime_ns)] + list(command)
+    for index, arg in enumerate(command[1:], 1):
+        path = _in_dir(cwd, arg)
+        if index != output and os.path.isfile(path):
+            with open(path, "rb") as input_file:
+                parts.append(input_file.read())
+    return cache.key(*parts), _in_dir(cwd, command[output])
+
+
+def execute_cmds(log, cmds, cwd=None, timeout=TOOL_TIMEOUT, cache=None):
+    """execute commands created from the build list
+
+    Every tool runs in its own process group in cwd and is killed after
+    timeout seconds. A command whose first element is a function is run
+    in-process as command[0](*command[1:]) and returns a non-zero status on
+    failure; its arguments are file names, relative ones are taken relative
+    to cwd.
+
+    With an artifact cache, tools writing one file given by -o are only run
+    for new inputs or command lines, their output is taken from the cache
+    otherwise. Tools writing other files as well (SIDE_OUTPUT_TOOLS) always
+    run.
+    """
 
     for _, command in enumerate(cmds):
+        if callable(command[0]):
+            func, args = command[0], [_in_dir(cwd, a) for a in command[1:]]
+            log.info("\n{}".format(" ".join([func.__name__] + [str(a) for a in args])))
+            start = time.perf_counter()
+            try:
+                status = func(*args)
+            except (OSError, ValueError) as status_msg:
+                log.warning("\nStatus Message: {}".format(status_msg))
+                return 1
+            finally:
+                record_timing(func.__name__, time.perf_counter() - start, args)
+            if status != 0:
+                return 1
+            continue
+        key, output = _step_key(cache, command, cwd) if cache else (None, None)
+        if key is not None:
+            data = cache.get(key)
+            if data is not None:
+                log.info("\nReused {} from cache".format(command[command.index("-o") + 1]))
+                with open(output, "wb") as output_file:
+                    output_file.write(data)
+                continue
         try:
             log.info("\n{}".format(" ".join(command)))
-            subprocess.check_call(command)
-        except subprocess.CalledProcessError as status:
+            run_tool(command, timeout=timeout, cwd=cwd)
+            if key is not None:
+                with open(output, "rb") as output_file:
+                    cache.put(key, output_file.read())
+        except subprocess.TimeoutExpired as status:
+            log.warning("\n{} timed out after {} seconds".format(command[0], status.timeout))
+            return 1
+        except (subprocess.CalledProcessError, OSError) as status:
             log.warning("\nStatus Message: {}".format(status))
             return 1
     return 0
 
 
+def execute_chains(log, chains, max_workers=None, timeout=TOOL_TIMEOUT, cache=None):
+    """Run independent command lists concurrently
+
+    chains is a list of (cmds, cwd). The commands of one chain run in order
+    in its own folder so the temporary files of the chains do not collide.
+    Returns 0 if every chain succeeded, 1 otherwise.
+    """
+
+    if len(chains) == 1:
+        cmds, cwd = chains[0]
+        return execute_cmds(log, cmds, cwd, timeout, cache)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(execute_cmds, log, cmds, cwd, timeout, cache) for cmds, cwd in chains]
+        statuses = [future.result() for future in futures]
+    return 1 if any(statuses) else 0
+
+
+# ioctl sharing all extents of a file with another file (Linux FICLONE)
+FICLONE = 0x40049409
+
+
+def clone_file(src, dst):
+    """Copy src to dst sharing the data blocks when the file system allows it
+
+    A reflink clone is tried first (Btrfs, XFS), then copy_file_range() which
+    keeps the copy inside the kernel, then a plain copy.
+    """
+
+    with open(src, "rb") as src_fd, open(dst, "wb") as dst_fd:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(dst_fd.fileno(), FICLONE, src_fd.fileno())
+                return
+            except OSError:
+                pass
+
+        if hasattr(os, "copy_file_range"):
+            remaining = os.fstat(src_fd.fileno()).st_size
+            try:
+                while remaining > 0:
+                    copied = os.copy_file_range(src_fd.fileno(), dst_fd.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                if remaining == 0:
+                    return
+            except OSError:
+                pass
+            src_fd.seek(0)
+            dst_fd.seek(0)
+            dst_fd.truncate()
+
+        shutil.copyfileobj(src_fd, dst_fd)
+
+
+def _seek_write(fd, data, offset):
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.write(fd, data)
+
+
+_pwrite = getattr(os, "pwrite", _seek_write)
+
+
+def patch_file(filename, chunks, size=None):
+    """Write (offset, data) chunks into filename in place
+
+    The file is truncated or extended to size when given.
+    """
+
+    fd = os.open(filename, os.O_RDWR | getattr(os, "O_BINARY", 0))
+    try:
+        for offset, data in chunks:
+            view = memoryview(data)
+            while view:
+                written = _pwrite(fd, view, offset)
+                view = view[written:]
+                offset += written
+        if size is not None:
+            os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+
+def release_pages(data, offset, length):
+    """Drop the pages of a read-only file map from the memory of the process
+
+    Scanning a large map keeps every page it touched resident. The released
+    pages are read again from the page cache if needed. Other objects than
+    maps are left alone.
+    """
+
+    if not isinstance(data, mmap.mmap) or not hasattr(mmap, "MADV_DONTNEED"):
+        return
+    start = offset - offset % mmap.PAGESIZE
+    end = min(offset + length, len(data))
+    if end > start:
+        try:
+            data.madvise(mmap.MADV_DONTNEED, start, end - start)
+        except (OSError, ValueError):
+            pass
+
+
 def get_key_and_value(dict, lookup_value, value_loc):
     """ Finds the key and associated value from the lookup value based on the location of the lookup value """
 
@@ -0,0 +1,122 @@
+# @file
+# Check that a stitch only changed the firmware volumes it targeted
+#
+# Copyright (c) 2019, Intel Corporation. All rights reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+
+import os
+import sys
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import delta
+from common import ffs_replace
+from common import utilities as utils
+
+##############################################################################
+#
+# The top level volumes holding the replaced files are located in the input
+# image. Everything outside of them is hashed in chunks, in parallel threads
+# (hashlib does not hold the GIL while hashing), and must be the same in the
+# output. The targeted volumes of the output must still parse and hold each
+# replaced file once.
+#
+##############################################################################
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class VerifyError(Exception):
+    """The stitched image differs from the input where it should not"""
+
+
+def untouched_ranges(size, modified):
+    """Return the (offset, length) ranges of [0, size) outside of modified"""
+
+    ranges = []
+    offset = 0
+    for start, length in sorted(modified):
+        if start > offset:
+            ranges.append((offset, start - offset))
+        offset = max(offset, start + length)
+    if offset < size:
+        ranges.append((offset, size - offset))
+    return ranges
+
+
+def split_ranges(ranges, chunk_size=CHUNK_SIZE):
+    """Split ranges into chunks of at most chunk_size bytes"""
+
+    chunks = []
+    for offset, length in ranges:
+        for start in range(offset, offset + length, chunk_size):
+            chunks.append((start, min(chunk_size, offset + length - start)))
+    return chunks
+
+
+def _digest(data, view, offset, length):
+    digest = hashlib.sha256(view[offset:offset + length]).digest()
+    utils.release_pages(data, offset, length)
+    return digest
+
+
+def differing_ranges(base, result, ranges, max_workers=None):
+    """Return the chunks of ranges whose digests differ in base and result"""
+
+    chunks = split_ranges(ranges)
+    base_view = memoryview(base)
+    result_view = memoryview(result)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            base_digests = pool.map(lambda c: _digest(base, base_view, *c), chunks)
+            result_digests = pool.map(lambda c: _digest(result, result_view, *c), chunks)
+            return [chunk for chunk, old, new in zip(chunks, base_digests, result_digests)
+                    if old != new]
+    finally:
+        base_view.release()
+        result_view.release()
+
+
+def verify_stitch(base_file, out_file, names, max_workers=None):
+    """Check that out_file only differs from base_file in the volumes
+    holding the files of UI names, and that these volumes still parse.
+
+    Returns the list of (offset, length) targeted volumes. Raises VerifyError.
+    """
+
+    with delta.map_file(base_file) as base, delta.map_file(out_file) as result:
+        if len(base) != len(result):
+            raise VerifyError("Size changed from {:#x} to {:#x} bytes".format(
+                len(base), len(result)))
+
+        targets = {}
+        for name in names:
+            volumes = ffs_replace.find_volumes(base, name)
+            if len(volumes) != 1:
+                raise VerifyError("{} files named {} found in {}".format(
+                    len(volumes), name, base_file))
+            targets.setdefault(volumes[0], []).append(name)
+
+        changed = differing_ranges(base, result, untouched_ranges(len(base), targets),
+                                   max_workers)
+        if changed:
+            offset, length = changed[0]
+            first = delta.diff_ranges(base[offset:offset + length],
+                                      result[offset:offset + length])[0][0]
+            raise VerifyError("Data outside of the stitched volumes changed in {} chunks,"
+                              " first at {:#x}".format(len(changed), offset + first))
+
+        for (offset, length), volume_names in sorted(targets.items()):
+            volume = result[offset:offset + length]
+            if list(ffs_replace.find_fvs(volume)) != [(0, length)]:
+                raise VerifyError("Volume at {:#x} is not valid anymore".format(offset))
+            for name in volume_names:
+                found = len(ffs_replace.find_volumes(volume, name))
+                if found != 1:
+                    raise VerifyError("{} files named {} found in volume at {:#x}".format(
+                        found, name, offset))
+
+    return sorted(targets)
@@ -15,22 +15,32 @@ import sys
 import argparse
 import shutil
 import re
+import tempfile
+import time
+import json
+import cProfile
 import uuid
 import click
 from pathlib import Path
 
 
-from cryptography.hazmat.primitives import hashes as hashes
-from cryptography.hazmat.backends import default_backend
-
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import common.subregion_image as sbrgn_image
 import common.utilities as utils
+import common.artifact_cache as artifact_cache
+import common.batch as batch
+import common.delta as delta
+import common.fwdiff as fwdiff
+import common.ffs_replace as ffs_replace
+import common.obb_digest as obb_digest
+import common.preflight as preflight
+import common.service as service
 from common.subregion_descriptor import SubRegionDescriptor
 from common.subregion_image import generate_sub_region_image
 from common.ifwi import IFWI_IMAGE
-from common.firmware_volume import FirmwareDevice
-from common.siip_constants import IP_OPTIONS
+from common.verify import VerifyError, verify_stitch
+from common.obb_digest import ObbDigestCache
+from common.siip_constants import IP_OPTIONS, KEY_REQUIRED_IPS
 from common.tools_path import FMMT, GENFV, GENFFS, GENSEC, LZCOMPRESS, TOOLS_DIR
 from common.tools_path import RSA_HELPER, FMMT_CFG
 from common.banner import banner
@@ -48,18 +58,14 @@ if sys.version_info < (3, 6):
     raise Exception("Python 3.6 is the minimal version required")
 
 GUID_FVADVANCED = uuid.UUID("B23E7388-9953-45C7-9201-0473DDE5487A")
-GUID_FVSECURITY = uuid.UUID("5A9A8B4E-149A-4CB2-BDC7-C8D62DE2C8CF")
-
-def search_for_fv(inputfile, ipname):
-    """Search for the firmware volume."""
 
-    # use to find the name of the firmware to locate the firmware volume
-    build_list = IP_OPTIONS.get(ipname)
+def view_fv_layout(inputfile):
+    """List the firmware volumes and files of an image using FMMT.
 
-    ui_name = build_list[0][1]
-
-    logger.info("\nFinding the Firmware Volume")
-    fw_vol = None
+    Returns the status and the lines of the FMMT listing. The listing only
+    depends on the structure of the image, so it can be shared by several
+    stitches against the same base image.
+    """
 
     command = [FMMT, "-v", os.path.abspath(inputfile)]
 
@@ -69,33 +75,52 @@ def search_for_fv(inputfile, ipname):
         logger.info("PATH       : %s" % os.environ["PATH"])
         logger.info("\n{}".format(" ".join(command)))
 
-        p = subprocess.run(command,
-                           shell=False,
-                           check=True,
-                           stdout=subprocess.PIPE,
-                           universal_newlines=True,
-                           timeout=60)
+        p = utils.run_tool(command, timeout=60, capture=True)
 
     except subprocess.CalledProcessError as status:
         logger.warning("\nError using FMMT: {}".format(status))
-        return 1, fw_vol
+        return 1, None
     except subprocess.TimeoutExpired:
+        # run_tool only kills the FMMT started here, not the ones of
+        # other stitches running on the host
         logger.warning(
             "\nFMMT timed out viewing {}! Check input file for correct format".format(inputfile)
         )
+        return 1, None
 
-        if sys.platform == 'win32':
-            result = os.system("taskkill /f /im FMMT.exe")
-        elif sys.platform == 'linux':
-            result = os.system("killall FMMT")
-        if result == 0:
-            return 1, fw_vol
-        sys.exit("\nError Must kill process")
+    return 0, p.stdout.splitlines()
 
-    # search FFS by name in firmware volumes
+
+# FMMT listings of the images of this process, keyed by
+# ffs_replace.image_key(). An image is only listed when it needs FMMT, and
+# the later stitches of the process against it reuse the listing.
+fv_layouts = {}
+MAX_FV_LAYOUTS = 64
+
+
+def image_fv_layout(inputfile):
+    """view_fv_layout() of inputfile, listed once per version of the file"""
+
+    key = ffs_replace.image_key(inputfile)
+    fv_layout = fv_layouts.get(key)
+    if fv_layout is not None:
+        return 0, fv_layout
+
+    status, fv_layout = view_fv_layout(inputfile)
+    if status == 0:
+        if len(fv_layouts) >= MAX_FV_LAYOUTS:
+            fv_layouts.clear()
+        fv_layouts[key] = fv_layout
+    return status, fv_layout
+
+
+def find_fv(fv_layout, ui_name):
+    """Return the name of the firmware volume holding the file ui_name"""
+
+    fw_vol = None
     fwvol_found = False
 
-    for line in p.stdout.splitlines():
+    for line in fv_layout:
         print(">> %s" % line)
         match_fv = re.match(r"(^FV\d+) :", line)
         if match_fv:
@@ -105,43 +130,86 @@ def search_for_fv(inputfile, ipname):
         if fwvol_found:
             match_name = re.match(r'File "(%s)"' % ui_name, line.lstrip())
             if match_name:
-                break
-    else:
-        fw_vol = None  # firmware volume was not found.
+                return fw_vol
+
+    return None
+
+
+def search_for_fv(inputfile, ipname, fv_layout=None):
+    """Search for the firmware volume."""
+
+    # use to find the name of the firmware to locate the firmware volume
+    build_list = IP_OPTIONS.get(ipname)
+
+    ui_name = build_list[0][1]
+
+    logger.info("\nFinding the Firmware Volume")
+
+    if fv_layout is None:
+        status, fv_layout = image_fv_layout(inputfile)
+        if status != 0:
+            return status, None
+
+    # search FFS by name in firmware volumes
+    fw_vol = find_fv(fv_layout, ui_name)
+    if fw_vol is None:
         logger.warning("\nCould not find file {} in {}".format(ui_name, inputfile))
 
     return 0, fw_vol
 
 
-def replace_ip(outfile, fw_vol, ui_name, inputfile):
+def replace_ip(outfile, fw_vol, ui_name, inputfile, ffs_file="tmp.ffs"):
     """ replaces the give firmware value with the input file """
 
-    cmd = [FMMT, "-r", inputfile, fw_vol, ui_name, "tmp.ffs", outfile]
+    cmd = [FMMT, "-r", inputfile, fw_vol, ui_name, ffs_file, outfile]
     return cmd
 
 
-def create_commands(filenames, ipname, fwvol):
-    """Create Commands for the merge and replace of firmware section."""
+def create_commands(filenames, ipname, fwvol, ffs_file=None):
+    """Create Commands for the merge and replace of firmware section.
+
+    If ffs_file is given, it is a prebuilt FFS of the IP and only the
+    replace command is created.
+    """
 
-    inputfiles, num_replace_files = sbrgn_image.ip_inputfiles(filenames, ipname)
     build_list = IP_OPTIONS.get(ipname)
 
     # get the file name to be used to replace firmware volume
     ui_name = build_list[0][1]
 
-    cmd_list = sbrgn_image.build_command_list(build_list, inputfiles, num_replace_files)
+    if ffs_file is None:
+        inputfiles, num_replace_files = sbrgn_image.ip_inputfiles(filenames, ipname)
+        cmd_list = sbrgn_image.build_command_list(build_list, inputfiles, num_replace_files)
+        ffs_file = "tmp.ffs"
+    else:
+        cmd_list = []
 
     cmd = replace_ip(filenames[len(filenames) - 1], fwvol, ui_name,
-                     filenames[0])
+                     filenames[0], ffs_file)
     cmd_list.append(cmd)
 
     return cmd_list
 
 
-def merge_and_replace(filename, guid_values, fwvol):
+def build_ffs(ip_file, ipname):
+    """Build the FFS of ipname from ip_file as tmp.ffs in the current folder.
+
+    The FFS only depends on the IP file and the recipe in IP_OPTIONS, not on
+    the image it is stitched into, so it can be stitched into many images.
+    """
+
+    inputfiles, num_replace_files = sbrgn_image.ip_inputfiles([None, ip_file], ipname)
+    cmds = sbrgn_image.build_command_list(IP_OPTIONS.get(ipname), inputfiles,
+                                          num_replace_files)
+
+    logger.info("\nBuilding firmware file of {}".format(ipname))
+    return utils.execute_cmds(logger, cmds, cache=artifact_cache.cache)
+
+
+def merge_and_replace(filename, guid_values, fwvol, ffs_file=None):
     """Perform merge and replace of section using different executables."""
 
-    cmds = create_commands(filename, guid_values, fwvol)
+    cmds = create_commands(filename, guid_values, fwvol, ffs_file)
 
     logger.info("\nStarting merge and replacement of section")
 
@@ -151,6 +219,16 @@ def merge_and_replace(filename, guid_values, fwvol):
     return status
 
 
+def file_readable(file):
+    """Verify that file can be read, without keeping it open."""
+
+    try:
+        open(file, "rb").close()
+    except OSError as err:
+        raise argparse.ArgumentTypeError("can't open '{}': {}".format(file, err.strerror))
+    return file
+
+
 def file_not_exist(file):
     """Verify that file does not exist."""
 
@@ -199,6 +277,29 @@ def check_file_size(files):
     return 0
 
 
+def check_image(ifwi_file, ip_name, image_cache=None):
+    """Check the structure of the IFWI/BIOS file and that it holds the IP,
+    without running any tool on it"""
+
+    ui_name = IP_OPTIONS.get(ip_name)[0][1]
+    ifwi_required = ip_name in KEY_REQUIRED_IPS
+    try:
+        if image_cache is not None:
+            image = image_cache.get(ifwi_file)
+            preflight.check_image(image.data, ui_name, ifwi_required, image.index)
+        else:
+            with delta.map_file(ifwi_file) as data:
+                preflight.check_image(data, ui_name, ifwi_required)
+    except preflight.PreflightError as err:
+        logger.critical("\n{} is not a valid IFWI/BIOS image: {}".format(ifwi_file, err))
+        return 1
+
+    return 0
+
+
+DEFAULT_OUTPUT_FILE = "BIOS_OUT.bin"
+
+
 def parse_cmdline():
     """ Parsing and validating input arguments."""
 
@@ -212,12 +313,12 @@ def parse_cmdline():
 
     parser.add_argument(
         "IFWI_IN",
-        type=argparse.FileType("rb+"),
+        type=file_readable,
         help="Input BIOS Binary file(Ex: IFWI.bin) to be updated with the given input IP firmware",
     )
     parser.add_argument(
         "IPNAME_IN",
-        type=argparse.FileType("rb"),
+        type=file_readable,
         help="Input IP firmware Binary file(Ex: PseFw.Bin to be replaced in the IFWI.bin",
     )
     parser.add_argument(
@@ -246,18 +347,92 @@ def parse_cmdline():
         "--outputfile",
         dest="OUTPUT_FILE",
         type=file_not_exist,
-        help="IFWI binary file with the IP replaced with the IPNAME_IN",
+        help="IFWI binary file with the IP replaced with the IPNAME_IN"
+             " (default: {})".format(DEFAULT_OUTPUT_FILE),
+        metavar="FileName",
+    )
+    parser.add_argument(
+        "-d",
+        "--delta",
+        type=file_not_exist,
+        help="Write a delta of the updated IFWI against IFWI_IN instead of the"
+             " full IFWI binary file. Use the apply-delta command to restore it",
+        metavar="FileName",
+    )
+    parser.add_argument(
+        "--verify",
+        dest="verify",
+        action="store_true",
+        default=True,
+        help="Check that the stitch only changed the firmware volumes of the IP"
+             " and that they still parse (default)",
+    )
+    parser.add_argument(
+        "--no-verify",
+        dest="verify",
+        action="store_false",
+        help="Do not check the stitched image",
+    )
+    parser.add_argument(
+        "--profile",
+        help="Save the time spent in every part of the stitch and in every tool"
+             " it runs as a JSON file",
+        metavar="FileName",
+    )
+    parser.add_argument(
+        "--profile-stats",
+        help="Save the cProfile statistics of the stitch, to be read with pstats",
         metavar="FileName",
-        default="BIOS_OUT.bin",
     )
 
     return parser
 
 
-def stitch_and_update(ifwi_file, ip_name, file_list, out_file):
+def native_replace(ifwi_file, ip_name, ffs_file, out_file, key_file=None,
+                   image_cache=None):
+    """Replace the IP in place without FMMT.
+
+    image_cache is a BaseImageCache keeping ifwi_file mapped and indexed.
+    Returns the (offset, length) of the changed volumes, None if FMMT is
+    needed for this image.
+    """
+
+    ui_name = IP_OPTIONS.get(ip_name)[0][1]
+    try:
+        ranges = ffs_replace.replace_file_in_image(ifwi_file, ui_name, ffs_file, out_file,
+                                                   key_file, image_cache)
+    except ffs_replace.NativeReplaceError as err:
+        logger.info("\nUsing FMMT to replace {}: {}".format(ui_name, err))
+        return None
+
+    logger.info("\nReplaced {} in place".format(ui_name))
+    return ranges
+
+
+def stitch_and_update(ifwi_file, ip_name, file_list, out_file, fv_layout=None,
+                      ffs_file=None, key_file=None, image_cache=None):
+    """Replace the IP in ifwi_file and save it as out_file
+
+    Returns the status, 0 on success, and the (offset, length) of the
+    changed ranges of the image, None when FMMT rewrote it.
+    """
+
+    # Replace the file in place when the image allows it, FMMT is only
+    # needed for the other images
+    if ffs_file is None:
+        with utils.phase("build"):
+            status = build_ffs(file_list[1], ip_name)
+        if status != 0:
+            return status, None
+        ffs_file = "tmp.ffs"
+    with utils.phase("native_replace"):
+        ranges = native_replace(ifwi_file, ip_name, ffs_file, out_file, key_file, image_cache)
+    if ranges is not None:
+        return 0, ranges
 
     # search for firmware volume
-    status, fw_volume = search_for_fv(ifwi_file, ip_name)
+    with utils.phase("fv_search"):
+        status, fw_volume = search_for_fv(ifwi_file, ip_name, fv_layout)
 
     # Check for error in using FMMT.exe or if firmware volume was not found.
     if status == 1 or fw_volume is None:
@@ -278,79 +453,123 @@ def stitch_and_update(ifwi_file, ip_name, file_list, out_file):
     file_list.append(os.path.abspath(out_file))
 
     # Add firmware volume header and merge it in out_file
-    status = merge_and_replace(file_list, ip_name, fw_volume)
+    with utils.phase("merge_and_replace"):
+        status = merge_and_replace(file_list, ip_name, fw_volume, ffs_file)
 
+    return status, None
 
-def update_obb_digest(ifwi_file, digest_file):
-    """Calculate OBB hash according to a predefined range"""
 
-    ifwi = IFWI_IMAGE(ifwi_file)
-    if not ifwi.is_ifwi_image():
-        logger.critical("Bad IFWI image")
-        exit(1)
+obb_cache = ObbDigestCache()
 
-    ifwi.parse()
-    bios_start = ifwi.region_list[1][1]
-    bios_limit = ifwi.region_list[1][2]
 
-    logger.info("Parsing BIOS ...")
-    bios = FirmwareDevice(0, ifwi.data[bios_start:bios_limit+1])
-    bios.ParseFd()
+def update_obb_digest(ifwi_file, digest_file, changed_ranges=None, base_key=None):
+    """Calculate OBB hash according to a predefined range
 
-    # Extract FVs belongs to OBB
-    obb_fv_idx = bios.get_fv_index_by_guid(GUID_FVSECURITY.bytes_le)
-    if not (0 < obb_fv_idx < len(bios.FvList)):
-        raise ValueError("Starting OBB FV is not found")
+    changed_ranges is the list of (offset, length) of ifwi_file changed from
+    the base image of ffs_replace.image_key() base_key. The volumes left
+    unchanged are only hashed the first time the base image is stitched.
+    """
+
+    # The image is only mapped, the volumes are hashed straight out of the
+    # map without being copied
+    with IFWI_IMAGE.from_file(ifwi_file) as ifwi:
+        if not ifwi.is_ifwi_image():
+            logger.critical("Bad IFWI image")
+            exit(1)
+
+        ifwi.parse()
+        result = obb_digest.image_digest(logger, ifwi.data, obb_cache, changed_ranges,
+                                         base_key)
 
-    logger.debug("OBB region starts from FV{}".format(obb_fv_idx))
-    obb_offset = bios.FvList[obb_fv_idx].Offset
-    obb_length = 0
-    if bios.is_fsp_wrapper():
-        # FVSECURITY + FVOSBOOT + FVUEFIBOOT_PRIME + FVADVANCED + FVPOSTMEMORY + FSPS
-        logger.info("FSP Wrapper BIOS")
-        obb_fv_end = obb_fv_idx + 6
-    else:
-        # FVSECURITY + FVOSBOOT + FVUEFIBOOT_PRIME + FVADVANCED + FVPOSTMEMORY
-        logger.info("EDK2 BIOS")
-        obb_fv_end = obb_fv_idx + 5
-    for fv in bios.FvList[obb_fv_idx:obb_fv_end]:
-        obb_length += len(fv.FvData)
-
-    logger.debug("OBB offset: {:x} len {:x}".format(obb_offset, obb_length))
-
-    # Hash it
-    digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
-    digest.update(bios.FdData[obb_offset:obb_offset+obb_length])
-    result = digest.finalize()
     with open(digest_file, "wb") as hash_fd:
         hash_fd.write(result)
 
     return
 
 
-def main():
-    """Entry to script."""
+def install_private_key(key_file, tools_dir=TOOLS_DIR):
+    """Copy key file to the name required by rsa_helper.py in tools_dir"""
 
-    # files created that needs to be remove
-    to_remove = ["tmp.fmmt.txt", "tmp.raw", "tmp.ui", "tmp.all", "tmp.cmps",
-                 "tmp.guid", "tmp.pe32", "tmp.ffs"]
+    key_copy = os.path.join(tools_dir, "privkey.pem")
+    shutil.copyfile(key_file, key_copy)
+    return key_copy
+
+
+def save_changes(ifwi_file, stitched_file, out_file, ranges=None):
+    """Save stitched_file as out_file, a clone of ifwi_file patched in place.
+
+    ranges is the list of (offset, length) known to be changed by the
+    stitch, the images are only compared when it is None, e.g. after FMMT
+    rewrote the image. On file systems supporting reflinks out_file shares
+    the unchanged blocks with ifwi_file. Returns the list of changed ranges.
+    """
+
+    with delta.map_file(ifwi_file) as base, delta.map_file(stitched_file) as result:
+        if ranges is None:
+            ranges = delta.diff_ranges(base, result)
+
+        if not (os.path.exists(out_file) and os.path.samefile(ifwi_file, out_file)):
+            utils.clone_file(ifwi_file, out_file)
+        utils.patch_file(out_file, ((offset, result[offset:offset + length])
+                                    for offset, length in ranges), len(result))
+
+    return ranges
+
+
+def verify_output(ifwi_file, out_file, ip_name):
+    """Check that out_file only differs from ifwi_file in the volumes of the
+    files stitched for ip_name. Returns 0 on success."""
+
+    names = [IP_OPTIONS.get(ip_name)[0][1]]
+    if ip_name in KEY_REQUIRED_IPS:
+        names.append(IP_OPTIONS.get("obb_digest")[0][1])
+
+    start = time.perf_counter()
     try:
-        parser = parse_cmdline()
-        args = parser.parse_args()
+        volumes = verify_stitch(ifwi_file, out_file, names)
+    except ffs_replace.NativeReplaceError as err:
+        logger.warning("\nCannot verify {}: {}".format(out_file, err))
+        return 0
+    except VerifyError as err:
+        logger.critical("\nVerification of {} failed: {}".format(out_file, err))
+        return 1
+
+    logger.info("Verified {} in {:.3f}s, {} volume(s) changed".format(
+        out_file, time.perf_counter() - start, len(volumes)))
+    return 0
 
-        for f in (FMMT, GENFV, GENFFS, GENSEC, LZCOMPRESS, RSA_HELPER, FMMT_CFG):
-            if not os.path.exists(f):
-                raise FileNotFoundError("Thirdparty tool not found ({})".format(f))
 
+def stitch_image(ifwi_file, ip_file, ipname, out_file, key_file=None,
+                 fv_layout=None, tools_dir=TOOLS_DIR, ffs_file=None, image_cache=None,
+                 verify=True):
+    """Replace the IP ipname in ifwi_file with ip_file and save it as out_file.
+
+    fv_layout is an FMMT listing of ifwi_file from view_fv_layout() that is
+    reused instead of viewing the image again. tools_dir is where the private
+    key is placed for rsa_helper.py. ffs_file is an FFS prebuilt from ip_file
+    by build_ffs(). image_cache is a BaseImageCache keeping ifwi_file mapped
+    and indexed across stitches. With verify, out_file is checked to only
+    differ from ifwi_file in the volumes of the stitched files. Returns 0 on
+    success.
+    """
+
+    # files created that needs to be remove
+    to_remove = ["tmp.fmmt.txt", "tmp.raw", "tmp.ui", "tmp.all", "tmp.cmps",
+                 "tmp.guid", "tmp.pe32", "tmp.ffs", "tmp.stitch.bin"]
+
+    # FMMT rewrites the whole image, so let it work on a temporary file and
+    # only copy the bytes it changed to out_file
+    stitched = "tmp.stitch.bin"
+    try:
         # Use absolute path because GenSec does not like relative ones
-        IFWI_file = Path(args.IFWI_IN.name).resolve()
+        IFWI_file = Path(ifwi_file).resolve()
 
         # If input IP file is a JSON file, convert it to binary as the real input file
-        if args.IPNAME_IN.name.lower().endswith('.json'):
+        if ip_file.lower().endswith('.json'):
             logger.info("Found JSON as input file. Converting it to binary ...\n")
 
             desc = SubRegionDescriptor()
-            desc.parse_json_data(args.IPNAME_IN.name)
+            desc.parse_json_data(ip_file)
 
             # Currently only creates the first file
             generate_sub_region_image(desc.ffs_files[0], output_file="tmp.payload.bin")
@@ -359,49 +578,674 @@ def main():
             # add to remove files
             to_remove.append("tmp.payload.bin")
         else:
-            IPNAME_file = Path(args.IPNAME_IN.name).resolve()
+            IPNAME_file = Path(ip_file).resolve()
 
         filenames = [str(IFWI_file), str(IPNAME_file)]
-        if args.ipname in ["gop", "gfxpeim", "vbt"]:
-            if not args.private_key or not os.path.exists(args.private_key):
-                logger.critical("\nMissing RSA key to stitch GOP/PEIM GFX/VBT from command line\n")
-                parser.print_help()
-                sys.exit(2)
-            else:
-                key_file = Path(args.private_key).resolve()
-                filenames.append(key_file)
+        if key_file:
+            key_file = Path(key_file).resolve()
+            filenames.append(key_file)
 
         # Verify file is not empty or the IP files are smaller than the input file
-        status = check_file_size(filenames)
+        with utils.phase("checks"):
+            status = check_file_size(filenames)
+            if status == 0:
+                status = check_image(str(IFWI_file), ipname, image_cache)
         if status != 0:
-            sys.exit(status)
+            return status
 
         # Copy key file to the required name needed for the rsa_helper.py
-        if args.private_key:
-            shutil.copyfile(key_file, os.path.join(TOOLS_DIR, "privkey.pem"))
-            to_remove.append(os.path.join(TOOLS_DIR, 'privkey.pem'))
+        if key_file:
+            to_remove.append(install_private_key(key_file, tools_dir))
             filenames.remove(key_file)
 
-        logger.info("*** Replacing {} ...".format(args.ipname))
-        stitch_and_update(args.IFWI_IN.name, args.ipname, filenames, args.OUTPUT_FILE)
+        stitched_ip = ipname
+        logger.info("*** Replacing {} ...".format(ipname))
+        key_copy = os.path.join(tools_dir, "privkey.pem")
+        status, ranges = stitch_and_update(str(IFWI_file), ipname, filenames, stitched,
+                                           fv_layout, ffs_file, key_copy, image_cache)
+        if status != 0:
+            return status
 
         # Update OBB digest after stitching any data inside OBB region
-        if args.ipname in ["gop", "vbt", "gfxpeim"]:
+        if ipname in KEY_REQUIRED_IPS:
             ipname = "obb_digest"
             digest_file = "tmp.obb.hash.bin"
 
             to_remove.append(digest_file)
 
-            update_obb_digest(args.OUTPUT_FILE, digest_file)
+            with utils.phase("obb_digest"):
+                base_key = ffs_replace.image_key(str(IFWI_file)) if ranges else None
+                update_obb_digest(stitched, digest_file, ranges, base_key)
 
-            filenames = [str(Path(f).resolve()) for f in [args.OUTPUT_FILE, digest_file]]
+            filenames = [str(Path(f).resolve()) for f in [stitched, digest_file]]
 
+            # Stitching does not change the structure of the image, so the
+            # listing of the input is still valid for the output
+            if fv_layout is None:
+                fv_layout = fv_layouts.get(ffs_replace.image_key(str(IFWI_file)))
             logger.info("*** Replacing {} ...".format(ipname))
-            stitch_and_update(args.OUTPUT_FILE, ipname, filenames, args.OUTPUT_FILE)
+            status, digest_ranges = stitch_and_update(stitched, ipname, filenames, stitched,
+                                                      fv_layout, key_file=key_copy)
+            if status != 0:
+                return status
+            if ranges is not None and digest_ranges is not None:
+                ranges = delta.merge_ranges(ranges, digest_ranges)
+            else:
+                ranges = None
+
+        with utils.phase("save"):
+            ranges = save_changes(str(IFWI_file), stitched, out_file, ranges)
+        logger.info("{} changed ranges ({} bytes) written to {}".format(
+            len(ranges), sum(length for _, length in ranges), out_file))
+
+        if verify:
+            with utils.phase("verify"):
+                status = verify_output(str(IFWI_file), out_file, stitched_ip)
     finally:
-        utils.cleanup(to_remove)
+        with utils.phase("cleanup"):
+            utils.cleanup(to_remove)
+
+    return status
+
+
+def stitch_delta(ifwi_file, ip_file, ipname, delta_file, key_file=None,
+                 out_file=None, **kwargs):
+    """Stitch like stitch_image() but save a delta against ifwi_file.
+
+    The full image is only kept if out_file is given. Returns 0 on success.
+    """
+
+    stitched = out_file or "tmp.stitched.bin"
+    try:
+        status = stitch_image(ifwi_file, ip_file, ipname, stitched, key_file, **kwargs)
+        if status == 0:
+            with utils.phase("delta"):
+                ranges = delta.make_delta(ifwi_file, stitched, delta_file)
+            logger.info("Delta of {} changed ranges ({} bytes) saved as {}".format(
+                len(ranges), sum(length for _, length in ranges), delta_file))
+    finally:
+        if out_file is None:
+            utils.cleanup([stitched])
+
+    return status
+
+
+def save_profile(filename, status, total):
+    """Save the timings of the stitch as a JSON file"""
+
+    report = utils.timing_report(total)
+    report["status"] = status
+    with open(filename, "w") as profile_file:
+        json.dump(report, profile_file, indent=2)
+    logger.info("Profile saved as {}".format(filename))
+
+
+def main():
+    """Entry to script."""
+
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        return COMMANDS[sys.argv[1]](sys.argv[2:])
+
+    start = time.perf_counter()
+    with utils.phase("arguments"):
+        parser = parse_cmdline()
+        args = parser.parse_args()
+
+        for f in (FMMT, GENFV, GENFFS, GENSEC, LZCOMPRESS, RSA_HELPER, FMMT_CFG):
+            if not os.path.exists(f):
+                raise FileNotFoundError("Thirdparty tool not found ({})".format(f))
+
+        if args.OUTPUT_FILE is None and args.delta is None:
+            try:
+                args.OUTPUT_FILE = file_not_exist(DEFAULT_OUTPUT_FILE)
+            except argparse.ArgumentTypeError as err:
+                parser.error("argument -o/--outputfile: {}".format(err))
+
+        key_file = None
+        if args.ipname in KEY_REQUIRED_IPS:
+            if not args.private_key or not os.path.exists(args.private_key):
+                logger.critical("\nMissing RSA key to stitch GOP/PEIM GFX/VBT from command line\n")
+                parser.print_help()
+                sys.exit(2)
+            else:
+                key_file = args.private_key
+
+    profiler = cProfile.Profile() if args.profile_stats else None
+    if profiler is not None:
+        profiler.enable()
+    status = 1
+    try:
+        if args.delta:
+            status = stitch_delta(args.IFWI_IN, args.IPNAME_IN, args.ipname,
+                                  args.delta, key_file, out_file=args.OUTPUT_FILE,
+                                  verify=args.verify)
+        else:
+            status = stitch_image(args.IFWI_IN, args.IPNAME_IN, args.ipname,
+                                  args.OUTPUT_FILE, key_file, verify=args.verify)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile_stats)
+        if args.profile:
+            save_profile(args.profile, status, time.perf_counter() - start)
+    if status != 0:
+        sys.exit(status)
+
+
+def batch_job(job):
+    """Run one stitch job of a batch in its own workspace.
+
+    This is executed in a worker process of the batch pool, so the process
+    wide working directory and PATH can be changed for the job.
+    """
+
+    workspace = tempfile.mkdtemp(prefix="siip_job_")
+    tools_dir = os.path.join(workspace, "tools")
+    os.mkdir(tools_dir)
+    # rsa_helper.py picks up privkey.pem next to itself, so give every job
+    # its own copy ahead of TOOLS_DIR in PATH. FMMT keeps its temporary
+    # files in the working directory, which is why jobs cannot share it.
+    shutil.copy(RSA_HELPER, tools_dir)
+    saved_path = os.environ["PATH"]
+    os.environ["PATH"] = os.pathsep.join([tools_dir, TOOLS_DIR, saved_path])
+    cwd = os.getcwd()
+    os.chdir(workspace)
+
+    # The worker runs many jobs, only the timings of this one are kept
+    utils.reset_timings()
+    status = 1
+    try:
+        with batch.redirect_output(job["log"]):
+            try:
+                stitch = stitch_delta if job.get("delta") else stitch_image
+                status = stitch(job["ifwi"], job["payload"], job["ip"],
+                                job["output"], job.get("key"),
+                                fv_layout=job.get("fv_layout"),
+                                tools_dir=tools_dir,
+                                ffs_file=job.get("ffs"),
+                                image_cache=base_images)
+            except SystemExit as exc:
+                status = exc.code if isinstance(exc.code, int) else 1
+            except Exception:
+                logger.exception("Stitch job failed")
+                status = 1
+    finally:
+        os.chdir(cwd)
+        os.environ["PATH"] = saved_path
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    if status == 0 and not os.path.isfile(job["output"]):
+        status = 1
+    return status
+
+
+# Base images kept mapped and indexed by the workers of the stitch service
+base_images = None
+
+
+def serve_init(cache_size):
+    """Set up a worker process of the stitch service"""
+
+    global base_images
+    base_images = ffs_replace.BaseImageCache(cache_size)
+
+
+def serve_validate(job):
+    """Check a stitch request of the service, raising ValueError"""
+
+    missing = [f for f in ("ifwi", "ip", "payload", "output") if not job.get(f)]
+    if missing:
+        raise ValueError("Request is missing {}".format(", ".join(missing)))
+    if job["ip"] not in IP_OPTIONS:
+        raise ValueError("Unknown IP name {}".format(job["ip"]))
+    if job["ip"] in KEY_REQUIRED_IPS and not job.get("key"):
+        raise ValueError("Stitching {} requires a private key".format(job["ip"]))
+    for field in ("ifwi", "payload", "key", "output", "log"):
+        if job.get(field) and not os.path.isabs(job[field]):
+            raise ValueError("Path of {} must be absolute".format(field))
+    for field in ("ifwi", "payload", "key"):
+        if job.get(field) and not os.path.isfile(job[field]):
+            raise ValueError("{} is not found".format(job[field]))
+
+    # Like file_not_exist() without the prompt, nothing is overwritten
+    if os.path.realpath(job["output"]) == os.path.realpath(job["ifwi"]):
+        raise ValueError("The output cannot be the input IFWI {}".format(job["ifwi"]))
+    for field in ("output", "log"):
+        if job.get(field) and os.path.lexists(job[field]):
+            raise ValueError("{} exist!".format(job[field]))
+
+
+def cmd_batch(argv):
+    """Run a matrix of stitch jobs in a process pool"""
+
+    parser = argparse.ArgumentParser(
+        prog="{} batch".format(__prog__),
+        description="Stitch a matrix of IFWI, IP and key files in parallel",
+    )
+    parser.add_argument(
+        "matrix",
+        nargs="?",
+        help="JSON or YAML file describing the job matrix",
+    )
+    parser.add_argument(
+        "--ifwi",
+        action="append",
+        default=[],
+        metavar="pattern",
+        help="Glob pattern of base IFWI files",
+    )
+    parser.add_argument(
+        "--payload",
+        action="append",
+        default=[],
+        metavar="ipname=pattern",
+        help="Glob pattern of the IP files to stitch as the given IP name",
+    )
+    parser.add_argument(
+        "--key",
+        action="append",
+        default=[],
+        metavar="pattern",
+        help="Glob pattern of private keys used for GOP/PEIM GFX/VBT",
+    )
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        dest="output_dir",
+        help="Folder that will contain the updated IFWI images and logs",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of jobs to run in parallel (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--summary",
+        default="batch_summary.json",
+        metavar="FileName",
+        help="JSON summary with status and timings of every job",
+    )
+    parser.add_argument(
+        "-d",
+        "--delta",
+        action="store_true",
+        help="Write deltas against the base images instead of full images",
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        if args.matrix:
+            matrix = batch.load_matrix(args.matrix)
+            base_dir = os.path.dirname(os.path.abspath(args.matrix))
+        else:
+            matrix = {}
+            base_dir = os.getcwd()
+        matrix = batch.merge_matrix_args(matrix, args.ifwi, args.payload, args.key)
+        if args.output_dir:
+            matrix["output_dir"] = args.output_dir
+        if args.delta:
+            matrix["delta"] = True
+        jobs = batch.expand_jobs(matrix, base_dir, KEY_REQUIRED_IPS)
+    except (ValueError, OSError) as err:
+        parser.error(str(err))
+
+    unknown = {job["ip"] for job in jobs} - set(IP_OPTIONS)
+    if unknown:
+        parser.error("Unknown IP names: {}".format(", ".join(sorted(unknown))))
+
+    # The jobs replacing the IP in place never need the FMMT listing of
+    # their base, the others list it once per worker
+    summary = batch.run_jobs(jobs, batch_job, max_workers=args.jobs)
+    batch.write_summary(summary, args.summary)
+
+    logger.info("{} jobs: {} succeeded, {} failed in {:.1f}s".format(
+        len(jobs), summary["succeeded"], summary["failed"], summary["seconds"]))
+    return 0 if summary["failed"] == 0 else 1
+
+
+def cmd_fanout(argv):
+    """Build the FFS of one IP file once and stitch it into many images"""
+
+    visible_ip_list = list(IP_OPTIONS.keys())
+    visible_ip_list.remove("obb_digest")
+
+    parser = argparse.ArgumentParser(
+        prog="{} fanout".format(__prog__),
+        description="Stitch one IP file into many IFWI images in parallel",
+    )
+    parser.add_argument(
+        "IPNAME_IN",
+        help="Input IP firmware Binary or JSON file to be stitched into all images",
+    )
+    parser.add_argument(
+        "IFWI_IN",
+        nargs="+",
+        help="Input BIOS Binary files to be updated with IPNAME_IN",
+    )
+    parser.add_argument(
+        "-ip",
+        "--ipname",
+        help="The name of the IP in the IFWI_IN files to be replaced. This is required.",
+        metavar="ipname",
+        required=True,
+        choices=visible_ip_list,
+    )
+    parser.add_argument(
+        "-k",
+        "--private-key",
+        type=check_key,
+        help="Private RSA key in PEM format. Note: Key is required for stitching GOP features",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=batch.DEFAULT_FANOUT_OUTPUT,
+        metavar="template",
+        help="Template of the output file names (default: %(default)s). Fields"
+             " are {ifwi}, {ifwi_stem}, {ip}, {payload_stem} and {key_stem}",
+    )
+    parser.add_argument(
+        "--output-dir",
+        dest="output_dir",
+        default=".",
+        help="Folder that will contain the updated IFWI images and logs",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of images to stitch in parallel (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--summary",
+        metavar="FileName",
+        help="JSON summary with status and timings of every image",
+    )
+    parser.add_argument(
+        "-d",
+        "--delta",
+        action="store_true",
+        help="Write deltas against the input images instead of full images",
+    )
+    args = parser.parse_args(argv)
+
+    if args.ipname in KEY_REQUIRED_IPS and not args.private_key:
+        parser.error("Missing RSA key to stitch GOP/PEIM GFX/VBT")
+
+    jobs = []
+    for ifwi in args.IFWI_IN:
+        job = {
+            "ifwi": os.path.abspath(ifwi),
+            "ip": args.ipname,
+            "payload": os.path.abspath(args.IPNAME_IN),
+            "key": os.path.abspath(args.private_key) if args.private_key else None,
+            "delta": args.delta,
+        }
+        job["output"] = os.path.abspath(
+            os.path.join(args.output_dir, batch.output_name(args.output, job)))
+        if args.delta:
+            job["output"] += batch.DELTA_SUFFIX
+        job["log"] = os.path.splitext(job["output"])[0] + ".log"
+        jobs.append(job)
+    if len({job["output"] for job in jobs}) != len(jobs):
+        parser.error("Output template {} gives the same name to several images".format(args.output))
+
+    workspace = tempfile.mkdtemp(prefix="siip_fanout_")
+    cwd = os.getcwd()
+    try:
+        os.chdir(workspace)
+        payload = jobs[0]["payload"]
+        if payload.lower().endswith(".json"):
+            desc = SubRegionDescriptor()
+            desc.parse_json_data(payload)
+            generate_sub_region_image(desc.ffs_files[0], output_file="tmp.payload.bin")
+            payload = os.path.abspath("tmp.payload.bin")
+
+        status = build_ffs(payload, args.ipname)
+        if status != 0:
+            return status
+
+        ffs_file = os.path.abspath("tmp.ffs")
+        for job in jobs:
+            job.update(payload=payload, ffs=ffs_file)
+
+        summary = batch.run_jobs(jobs, batch_job, max_workers=args.jobs)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    if args.summary:
+        batch.write_summary(summary, args.summary)
+    for result in summary["jobs"]:
+        if result["status"] != "ok":
+            logger.warning("Failed to stitch {}, see {}".format(result["ifwi"], result["log"]))
+
+    logger.info("{} images: {} succeeded, {} failed in {:.1f}s".format(
+        len(jobs), summary["succeeded"], summary["failed"], summary["seconds"]))
+    return 0 if summary["failed"] == 0 else 1
+
+
+def cmd_apply_delta(argv):
+    """Recreate a stitched image from its base image and a delta"""
+
+    parser = argparse.ArgumentParser(
+        prog="{} apply-delta".format(__prog__),
+        description="Apply a delta written by --delta to its base IFWI image",
+    )
+    parser.add_argument(
+        "IFWI_IN",
+        help="Base IFWI image the delta was created against",
+    )
+    parser.add_argument(
+        "DELTA_IN",
+        help="Delta file",
+    )
+    parser.add_argument(
+        "-o",
+        "--outputfile",
+        dest="OUTPUT_FILE",
+        type=file_not_exist,
+        default=DEFAULT_OUTPUT_FILE,
+        metavar="FileName",
+        help="IFWI binary file to create (default: %(default)s)",
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        delta.apply_delta(args.IFWI_IN, args.DELTA_IN, args.OUTPUT_FILE)
+    except (delta.DeltaError, OSError) as err:
+        logger.critical("\nError: {}".format(err))
+        # Never remove the input image
+        if not (os.path.exists(args.OUTPUT_FILE)
+                and os.path.samefile(args.IFWI_IN, args.OUTPUT_FILE)):
+            utils.cleanup([args.OUTPUT_FILE])
+        return 1
+
+    logger.info("{} created from {} and {}".format(args.OUTPUT_FILE, args.IFWI_IN, args.DELTA_IN))
+    return 0
+
+
+def cmd_serve(argv):
+    """Run the stitch service on a Unix socket"""
+
+    parser = argparse.ArgumentParser(
+        prog="{} serve".format(__prog__),
+        description="Stitch requests sent to a Unix socket, keeping recently "
+                    "used base IFWI images mapped and indexed",
+    )
+    parser.add_argument(
+        "--socket",
+        default=service.DEFAULT_SOCKET,
+        help="Unix socket of the service (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of requests stitched in parallel (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=service.DEFAULT_CACHE_SIZE // (1024 * 1024),
+        metavar="MB",
+        help="Size of the base images kept by every worker (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--stop",
+        action="store_true",
+        help="Stop the service running on the socket",
+    )
+    args = parser.parse_args(argv)
+
+    if not service.is_supported():
+        parser.error("Unix sockets are not supported on this platform")
+
+    try:
+        if args.stop:
+            service.request(args.socket, {"command": "shutdown"})
+            return 0
+
+        logger.info("Stitch service listening on {}".format(args.socket))
+        service.serve(args.socket, batch_job, serve_validate, args.jobs,
+                      serve_init, (args.cache_size * 1024 * 1024,))
+    except service.ServiceError as err:
+        logger.critical("\nError: {}".format(err))
+        return 1
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def cmd_submit(argv):
+    """Send a stitch request to the stitch service"""
+
+    visible_ip_list = list(IP_OPTIONS.keys())
+    visible_ip_list.remove("obb_digest")
+
+    parser = argparse.ArgumentParser(
+        prog="{} submit".format(__prog__),
+        description="Stitch an IP with the stitch service started by serve",
+    )
+    parser.add_argument(
+        "IFWI_IN",
+        help="Input BIOS Binary file(Ex: IFWI.bin) to be updated with the given input IP firmware",
+    )
+    parser.add_argument(
+        "IPNAME_IN",
+        help="Input IP firmware Binary file(Ex: PseFw.Bin) to be replaced in the IFWI.bin",
+    )
+    parser.add_argument(
+        "-ip",
+        "--ipname",
+        help="The name of the IP in the IFWI_IN file to be replaced. This is required.",
+        metavar="ipname",
+        required=True,
+        choices=visible_ip_list,
+    )
+    parser.add_argument(
+        "-k",
+        "--private-key",
+        type=check_key,
+        help="Private RSA key in PEM format. Note: Key is required for stitching GOP features",
+    )
+    parser.add_argument(
+        "-o",
+        "--outputfile",
+        default=DEFAULT_OUTPUT_FILE,
+        metavar="FileName",
+        help="IFWI binary file with the IP replaced (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-d",
+        "--delta",
+        metavar="FileName",
+        help="Write a delta against IFWI_IN instead of the full IFWI binary file",
+    )
+    parser.add_argument(
+        "--socket",
+        default=service.DEFAULT_SOCKET,
+        help="Unix socket of the service (default: %(default)s)",
+    )
+    args = parser.parse_args(argv)
+
+    request = {
+        "command": "stitch",
+        "ifwi": os.path.abspath(args.IFWI_IN),
+        "ip": args.ipname,
+        "payload": os.path.abspath(args.IPNAME_IN),
+        "key": os.path.abspath(args.private_key) if args.private_key else None,
+        "output": os.path.abspath(args.delta or args.outputfile),
+        "delta": bool(args.delta),
+    }
+    try:
+        response = service.request(args.socket, request)
+    except service.ServiceError as err:
+        logger.critical("\nError: {}".format(err))
+        return 1
+
+    if response["status"] != "ok":
+        logger.critical("\nError: stitching failed{}".format(
+            ": " + response["error"] if response.get("error") else ""))
+        return response.get("returncode") or 1
+
+    logger.info("{} created in {:.2f}s".format(response["output"], response["seconds"]))
+    return 0
+
+
+def cmd_fwdiff(argv):
+    """Report the volumes, files and sections that differ in two images"""
+
+    parser = argparse.ArgumentParser(
+        prog="{} fwdiff".format(__prog__),
+        description="Compare two IFWI images volume by volume, file by file and "
+                    "section by section",
+    )
+    parser.add_argument(
+        "OLD_IFWI",
+        help="IFWI image to compare from, like the input of a stitch",
+    )
+    parser.add_argument(
+        "NEW_IFWI",
+        help="IFWI image to compare to, like the output of a stitch",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of threads hashing the nodes (default: %(default)s)",
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        changes = fwdiff.diff_images(args.OLD_IFWI, args.NEW_IFWI, args.jobs)
+    except (OSError, ValueError) as err:
+        logger.critical("\nError: {}".format(err))
+        return 1
+
+    for change in changes:
+        logger.info(fwdiff.format_change(change))
+    counts = [sum(1 for change in changes if change.status == status)
+              for status in ("added", "removed", "changed")]
+    logger.info("{} added, {} removed, {} changed".format(*counts))
+    return 0
+
+
+COMMANDS = {
+    "batch": cmd_batch,
+    "fanout": cmd_fanout,
+    "apply-delta": cmd_apply_delta,
+    "serve": cmd_serve,
+    "submit": cmd_submit,
+    "fwdiff": cmd_fwdiff,
+}
 
 
 if __name__ == "__main__":
 
-    main()
+    sys.exit(main())
@@ -13,11 +13,13 @@ import sys
 import os
 import argparse
 import glob
+import shutil
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import common.subregion_descriptor as subrgn_descrptr
 import common.subregion_image as sbrgn_image
 import common.utilities as utils
+import common.artifact_cache as artifact_cache
 from common.tools_path import EDK2_CAPSULE_TOOL
 from common.banner import banner
 import common.logging as logging
@@ -46,36 +48,50 @@ def generate_sub_region_fv(
 
     sub_region_image = "SubRegionImage.bin"
     fv_ffs_file_list = []
+    chains = []
 
-    for file_index, ffs_file in enumerate(sub_region_descriptor.ffs_files):
+    # The files are built concurrently, each in its own folder since the
+    # commands of every file use the same temporary file names
+    try:
+        for file_index, ffs_file in enumerate(sub_region_descriptor.ffs_files):
 
-        sbrgn_image.generate_sub_region_image(ffs_file, sub_region_image)
-        ip, ip_ops = sbrgn_image.ip_info_from_guid(ffs_file.ffs_guid)
+            ip, ip_ops = sbrgn_image.ip_info_from_guid(ffs_file.ffs_guid)
 
-        # if ffs GUID is not found exit.
-        if ip is None:
-            print("FFS GUIS {} not found".format(ffs_file.ffs_guid))
-            exit(-1)
+            # if ffs GUID is not found exit.
+            if ip is None:
+                print("FFS GUIS {} not found".format(ffs_file.ffs_guid))
+                exit(-1)
 
-        # Inputfiles should be minium of two files to work with function.
-        inputfiles, num_files = sbrgn_image.ip_inputfiles(
-            [None, sub_region_image],
-            ip
-            )
+            chain_dir = "tmp.{}.d".format(file_index)
+            os.makedirs(chain_dir, exist_ok=True)
+            chains.append(([], chain_dir))
+            sbrgn_image.generate_sub_region_image(
+                ffs_file, os.path.join(chain_dir, sub_region_image))
 
-        cmds = sbrgn_image.build_command_list(ip_ops, inputfiles, num_files)
+            # Inputfiles should be minium of two files to work with function.
+            inputfiles, num_files = sbrgn_image.ip_inputfiles(
+                [None, sub_region_image],
+                ip
+                )
 
-        if utils.execute_cmds(logger, cmds) == 1:
-            exit(-1)
+            cmds = sbrgn_image.build_command_list(ip_ops, inputfiles, num_files)
+            chains[-1] = (cmds, chain_dir)
 
-        ffs_file_path = "tmp.{}.ffs".format(file_index)
-        os.rename("tmp.ffs", ffs_file_path)
-        fv_ffs_file_list.append(ffs_file_path)
+        if utils.execute_chains(logger, chains, cache=artifact_cache.cache) == 1:
+            exit(-1)
 
-        fv_cmd_list = sbrgn_image.build_fv_from_ffs_files(
-                     sub_region_descriptor,
-                     output_fv_file,
-                     fv_ffs_file_list)
+        for file_index, (_, chain_dir) in enumerate(chains):
+            ffs_file_path = "tmp.{}.ffs".format(file_index)
+            os.replace(os.path.join(chain_dir, "tmp.ffs"), ffs_file_path)
+            fv_ffs_file_list.append(ffs_file_path)
+    finally:
+        for _, chain_dir in chains:
+            shutil.rmtree(chain_dir, ignore_errors=True)
+
+    fv_cmd_list = sbrgn_image.build_fv_from_ffs_files(
+                 sub_region_descriptor,
+                 output_fv_file,
+                 fv_ffs_file_list)
 
     if utils.execute_cmds(logger, fv_cmd_list) == 1:
         print("Error generating FV File")
@@ -0,0 +1,121 @@
+"""Benchmark of the firmware_volume.py parse tree
+
+   Parses a BIOS region and reports the time and peak memory taken, once
+   with the nodes holding views of the image, as the parser does, and once
+   with every node holding a copy of its bytes, as the parser used to. The
+   time and the memory kept by the parse tree are also given per node.
+
+   python tests/benchmark_firmware_volume.py [BIOS.bin] [--size MB]
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.firmware_volume import FirmwareDevice, FirmwareFile, FirmwareVolume
+from tests.image_builder import synthetic_bios
+
+
+def copy_nodes(fd):
+    """Return a copy of the bytes of every node, like the old parse tree held"""
+
+    copies = [fd.FdData]
+    for fv in fd.FvList:
+        if not isinstance(fv, FirmwareVolume):
+            continue
+        copies.append(fv.FvData)
+        for ffs in fv.FfsList:
+            if isinstance(ffs, FirmwareFile):
+                copies.append(ffs.FfsData)
+                copies.extend(sec.SecData for sec in ffs.SecList)
+    return copies
+
+
+def count_nodes(fd):
+    """Return the number of volumes, files and sections of the parse tree"""
+
+    count = 0
+    for fv in fd.FvList:
+        count += 1
+        for ffs in getattr(fv, "FfsList", []):
+            count += 1 + len(getattr(ffs, "SecList", []))
+    return count
+
+
+def node_cost(data, runs=5):
+    """Return the number of nodes of data, and the best seconds and the bytes
+    kept by the parse tree per node"""
+
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            fd = FirmwareDevice(0, data)
+            fd.ParseFd()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+        del fd
+
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        fd = FirmwareDevice(0, data)
+        fd.ParseFd()
+    kept, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    nodes = count_nodes(fd)
+    return nodes, best / nodes, kept / nodes
+
+
+def measure(data, copy):
+    """Return the seconds and peak bytes allocated to parse data"""
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        fd = FirmwareDevice(0, data)
+        fd.ParseFd()
+    copies = copy_nodes(fd) if copy else None
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del copies
+    return seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("image", nargs="?", help="BIOS region to parse")
+    parser.add_argument("--size", type=int, default=32,
+                        help="Size in MB of the synthetic BIOS parsed without image")
+    args = parser.parse_args()
+
+    if args.image:
+        with open(args.image, "rb") as image_fd:
+            data = image_fd.read()
+    else:
+        data = synthetic_bios(args.size * 1024 * 1024)
+
+    print("BIOS of {:.1f} MB".format(len(data) / (1024 * 1024)))
+    results = {}
+    for name, copy in (("views", False), ("copies", True)):
+        seconds, peak = measure(data, copy)
+        results[name] = (seconds, peak)
+        print("{:7} {:8.3f} s {:9.1f} MB peak ({:.2f}x the image)".format(
+            name, seconds, peak / (1024 * 1024), peak / len(data)))
+
+    saved = results["copies"][1] - results["views"][1]
+    print("Views save {:.1f} MB and {:.3f} s".format(
+        saved / (1024 * 1024), results["copies"][0] - results["views"][0]))
+
+    nodes, seconds, kept = node_cost(data)
+    print("{} nodes: {:.2f} us and {:.0f} bytes per node".format(
+        nodes, seconds * 1e6, kept))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
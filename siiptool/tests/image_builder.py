@@ -0,0 +1,183 @@
+"""Build a small synthetic IFWI image with the thirdparty EDK2 tools
+
+   The image has an SPI descriptor followed by a BIOS region laid out like an
+   EDK2 BIOS: an IBB FV with the ObbDigest and PSE files, followed by the five
+   OBB FVs. FVADVANCED holds the VBT inside an RSA signed, LZMA compressed FV.
+
+   synthetic_bios() builds BIOS regions of any size in Python, for parser
+   tests and benchmarks.
+"""
+
+import os
+import struct
+import subprocess
+import sys
+import uuid
+
+sys.path.insert(0, "..")
+from common import ffs_builder
+from common.firmware_volume import EFI_FV_FILETYPE, EFI_SECTION_TYPE
+from common.tools_path import GENSEC, GENFFS, GENFV, LZCOMPRESS, RSA_HELPER
+
+IMAGES_PATH = os.path.join("tests", "images")
+
+GUID_LZMA = "EE4E5898-3914-4259-9D6E-DC7BD79403CF"
+GUID_RSA = "A7717414-C616-4977-9420-844712A735BF"
+GUID_FFS2 = "8C8CE578-8A3D-4F1C-9935-896185C32DD3"
+
+OBB_FVS = [
+    ("sec", "5A9A8B4E-149A-4CB2-BDC7-C8D62DE2C8CF"),
+    ("osboot", "13BF8810-75FD-4B1A-91E6-E16C4201F80A"),
+    ("uefiboot", "9E21FD93-9C72-4C15-8C4B-E77F1DB2D792"),
+    ("adv", "B23E7388-9953-45C7-9201-0473DDE5487A"),
+    ("postmem", "9DFE49DB-8EF0-4D9C-B273-0036144DE917"),
+]
+
+
+def _run(*cmd):
+    subprocess.check_call([str(c) for c in cmd], stdout=subprocess.DEVNULL)
+
+
+def _ffs(workdir, name, guid, payload, ui, align=None, compress=False):
+    base = os.path.join(workdir, name)
+    _run(GENSEC, "-o", base + ".raw", "-s", "EFI_SECTION_RAW", "-c", "PI_NONE", payload)
+    _run(GENSEC, "-o", base + ".ui", "-s", "EFI_SECTION_USER_INTERFACE", "-n", ui)
+    _run(GENSEC, "-o", base + ".all", base + ".raw", base + ".ui")
+    section = base + ".all"
+    if compress:
+        _run(LZCOMPRESS, "-e", "-o", base + ".cmps", section)
+        _run(GENSEC, "-o", base + ".guid", "-s", "EFI_SECTION_GUID_DEFINED",
+             "-g", GUID_LZMA, "-r", "PROCESSING_REQUIRED", base + ".cmps")
+        section = base + ".guid"
+    cmd = [GENFFS, "-o", base + ".ffs", "-t", "EFI_FV_FILETYPE_FREEFORM",
+           "-g", guid, "-i", section]
+    if align:
+        cmd += ["-a", align]
+    _run(*cmd)
+    return base + ".ffs"
+
+
+def _fv(workdir, name, guid, ffs_files, blocks):
+    base = os.path.join(workdir, name)
+    cmd = [GENFV, "-o", base + ".fv", "-b", "0x1000", "-n", hex(blocks),
+           "-g", GUID_FFS2, "--FvNameGuid", guid]
+    for ffs in ffs_files:
+        cmd += ["-f", ffs]
+    _run(*cmd)
+    return base + ".fv"
+
+
+def _signed_fv_ffs(workdir, inner_fv):
+    base = os.path.join(workdir, "inner")
+    _run(GENSEC, "-o", base + ".fvsec", "-s", "EFI_SECTION_FIRMWARE_VOLUME_IMAGE", inner_fv)
+    _run(LZCOMPRESS, "-e", "-o", base + ".cmps", base + ".fvsec")
+    _run(GENSEC, "-o", base + ".lzma", "-s", "EFI_SECTION_GUID_DEFINED",
+         "-g", GUID_LZMA, "-r", "PROCESSING_REQUIRED", base + ".cmps")
+    _run(sys.executable, RSA_HELPER, "-e", "--private-key",
+         os.path.join(IMAGES_PATH, "privkey.pem"), "-o", base + ".signed", base + ".lzma")
+    _run(GENSEC, "-o", base + ".rsa", "-s", "EFI_SECTION_GUID_DEFINED",
+         "-g", GUID_RSA, "-r", "PROCESSING_REQUIRED", base + ".signed")
+    _run(GENFFS, "-o", base + ".ffs", "-t", "EFI_FV_FILETYPE_FIRMWARE_VOLUME_IMAGE",
+         "-g", "3A5E8B9D-1F2C-4E6A-9B7D-2C4E6F8A0B1C", "-i", base + ".rsa")
+    return base + ".ffs"
+
+
+def spi_descriptor(image_size):
+    """Return a 4KB SPI descriptor with only the descriptor and BIOS regions"""
+
+    desc = bytearray(b"\xff" * 0x1000)
+    frba = 0x40
+    struct.pack_into("<II", desc, 0x10, 0x0FF0A55A, (frba >> 4) << 16)
+    bios_limit = (image_size >> 12) - 1
+    struct.pack_into("<IIIIII", desc, frba, 0, (bios_limit << 16) | 1,
+                     0x7FFF, 0x7FFF, 0x7FFF, 0x7FFF)
+    return desc
+
+
+def build_ifwi(workdir, out_file, image_size=None):
+    """Create a synthetic IFWI image as out_file using workdir for temporaries
+
+    The BIOS region is padded to give an image of at least image_size bytes.
+    """
+
+    digest = os.path.join(workdir, "digest.bin")
+    with open(digest, "wb") as fd:
+        fd.write(bytes(32))
+    dummy = os.path.join(workdir, "dummy.bin")
+    with open(dummy, "wb") as fd:
+        fd.write(b"\x5a" * 256)
+
+    ibb_files = [
+        _ffs(workdir, "obb", "F57757FC-2603-404F-AAE2-34C6232388E8", digest, "ObbDigest"),
+        _ffs(workdir, "pse", "EBA4A247-42C0-4C11-A167-A4058BC9D423",
+             os.path.join(IMAGES_PATH, "PseFw.bin"), "IntelPseFw", align="1K", compress=True),
+    ]
+    fv_files = [_fv(workdir, "ibb", "7A4CC1E5-3A84-4E2D-A0E2-6D0B7E8D3A9C", ibb_files, 0x20)]
+
+    vbt = _ffs(workdir, "vbt", "56752da9-de6b-4895-8819-1945b6b76c22",
+               os.path.join(IMAGES_PATH, "Vbt.bin"), "IntelGopVbt")
+    inner_fv = _fv(workdir, "inner", "4F1C52D3-D824-4D2A-A2F0-EC40C23C5916", [vbt], 0x4)
+
+    for idx, (name, guid) in enumerate(OBB_FVS):
+        if name == "adv":
+            fv_files.append(_fv(workdir, name, guid, [_signed_fv_ffs(workdir, inner_fv)], 0x8))
+        else:
+            ffs = _ffs(workdir, name + "_ffs", "6B5D6A7C-%04X-4B5E-8D7A-1B2C3D4E5F60" % idx,
+                       dummy, name)
+            fv_files.append(_fv(workdir, name, guid, [ffs], 0x2))
+
+    bios = bytearray()
+    for fv in fv_files:
+        with open(fv, "rb") as fd:
+            bios += fd.read()
+
+    image_size = max(image_size or 0, (0x1000 + len(bios) + 0xFFFF) & ~0xFFFF)
+    with open(out_file, "wb") as fd:
+        fd.write(spi_descriptor(image_size))
+        fd.write(bios)
+        fd.write(b"\xff" * (image_size - 0x1000 - len(bios)))
+
+    return out_file
+
+
+FV_ATTRIBUTES = 0x0004FEFF  # Erase polarity 1, read and write enabled
+FV_BLOCK_SIZE = 0x1000
+
+
+def fv_image(files, length):
+    """Return a volume of length bytes holding the firmware files"""
+
+    block_map = struct.pack("<IIII", length // FV_BLOCK_SIZE, FV_BLOCK_SIZE, 0, 0)
+    header = bytearray(struct.pack("<16s16sQ4sIHHHBB", bytes(16),
+                                   uuid.UUID(GUID_FFS2).bytes_le, length, b"_FVH",
+                                   FV_ATTRIBUTES, 0x38 + len(block_map), 0, 0, 0, 2))
+    header += block_map
+    checksum = sum(struct.unpack("<{}H".format(len(header) // 2), header)) & 0xFFFF
+    struct.pack_into("<H", header, 0x32, (0x10000 - checksum) & 0xFFFF)
+
+    fv = header
+    for ffs in files:
+        fv += b"\xff" * (-len(fv) % 8) + ffs
+    if len(fv) > length:
+        raise ValueError("Files do not fit in a volume of {:#x} bytes".format(length))
+    return bytes(fv + b"\xff" * (length - len(fv)))
+
+
+def synthetic_bios(size, fv_size=0x400000, file_size=0x10000):
+    """Return a BIOS region of size bytes made of volumes of fv_size bytes,
+    filled with raw files of file_size bytes, each with a UI name"""
+
+    files_per_fv = (fv_size - 0x100) // (file_size + 0x100)
+    bios = bytearray()
+    for fv_idx in range(size // fv_size):
+        files = []
+        for file_idx in range(files_per_fv):
+            name = "File{}_{}".format(fv_idx, file_idx)
+            data = bytes([file_idx & 0xFF]) * file_size
+            sections = ffs_builder.merge_sections([
+                ffs_builder.section(EFI_SECTION_TYPE.RAW, data),
+                ffs_builder.ui_section(name)])
+            guid = str(uuid.uuid5(uuid.NAMESPACE_OID, name))
+            files.append(ffs_builder.ffs_file(EFI_FV_FILETYPE.FREEFORM, guid, sections))
+        bios += fv_image(files, fv_size)
+    return bytes(bios + b"\xff" * (size - len(bios)))
@@ -0,0 +1,365 @@
+"""Test the firmware volume parser
+
+   TestFirmwareVolume - test the parse tree of a BIOS region
+"""
+
+import contextlib
+import hashlib
+import io
+import os
+import sys
+import tempfile
+import tracemalloc
+import unittest
+import uuid
+from unittest import mock
+
+sys.path.insert(0, "..")
+from common import compression
+from common import ffs_builder
+from common import ffs_replace
+from common import firmware_volume
+from common.firmware_volume import (
+    EFI_FV_FILETYPE,
+    EFI_SECTION_TYPE,
+    FV_EVENT,
+    FirmwareDevice,
+    FirmwareFile,
+    FirmwareVolume,
+    INDEX_SUFFIX,
+    Section,
+    section_cache,
+)
+from common.ifwi import IFWI_IMAGE
+from tests.image_builder import GUID_LZMA, fv_image, spi_descriptor, synthetic_bios
+
+BIOS_SIZE = 0x800000
+FV_SIZE = 0x200000
+FILE_SIZE = 0x8000
+
+
+def encapsulated_bios():
+    """Return a BIOS region with a volume in a compressed file, like OBB"""
+
+    inner_file = ffs_builder.ffs_file(
+        EFI_FV_FILETYPE.FREEFORM, "6B2F2C5E-9C2D-4F4B-8B8A-1B0C3E4D5F60",
+        ffs_builder.merge_sections([
+            ffs_builder.section(EFI_SECTION_TYPE.RAW, b"\x5a" * 0x1000),
+            ffs_builder.ui_section("Inner")]))
+    fv_section = ffs_builder.section(EFI_SECTION_TYPE.FIRMWARE_VOLUME_IMAGE,
+                                     fv_image([inner_file], 0x2000))
+    compressed = ffs_builder.guid_section(GUID_LZMA, compression.lzma_compress(fv_section),
+                                          "PROCESSING_REQUIRED")
+    outer_file = ffs_builder.ffs_file(EFI_FV_FILETYPE.FIRMWARE_VOLUME_IMAGE,
+                                      "0E1B4A5C-3D2F-4E6A-9B8C-7D6E5F4A3B2C", compressed)
+    return fv_image([outer_file], 0x10000)
+
+
+def parse(data):
+    with contextlib.redirect_stdout(io.StringIO()):
+        fd = FirmwareDevice(0, data)
+        fd.ParseFd()
+    return fd
+
+
+class TestFirmwareVolume(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.data = synthetic_bios(BIOS_SIZE, FV_SIZE, FILE_SIZE)
+
+    def test_parse_tree(self):
+        fd = parse(self.data)
+        self.assertEqual(len(fd.FvList), BIOS_SIZE // FV_SIZE)
+
+        fv = fd.FvList[1]
+        self.assertIsInstance(fv, FirmwareVolume)
+        self.assertEqual(fv.Offset, FV_SIZE)
+        self.assertEqual(fv.FvData, self.data[FV_SIZE:2 * FV_SIZE])
+
+        ffs = fv.FfsList[3]
+        self.assertIsInstance(ffs, FirmwareFile)
+        start = FV_SIZE + ffs.Offset
+        self.assertEqual(ffs.FfsData, self.data[start:start + ffs.Length])
+        raw, ui = ffs.SecList
+        self.assertEqual(raw.Type, EFI_SECTION_TYPE.RAW)
+        self.assertEqual(raw.SecData[4:], bytes([3]) * FILE_SIZE)
+        self.assertEqual(ui.Name, "File1_3")
+
+    def test_headers(self):
+        fd = parse(self.data)
+        fv = fd.FvList[1]
+        ffs = fv.FfsList[2]
+        sec = ffs.SecList[0]
+        for node in (fd, fv, ffs, sec, fv.FfsList[-1]):
+            self.assertFalse(hasattr(node, "__dict__"))
+
+        # The header structures are decoded again from the buffer
+        self.assertEqual(fv.FvHdr.FvLength, FV_SIZE)
+        self.assertIsNone(fv.FvExtHdr)
+        self.assertEqual(int(ffs.FfsHdr.Size), ffs.Length)
+        self.assertEqual(bytes(ffs.FfsHdr.Name), ffs.Name)
+        self.assertEqual((int(sec.SecHdr.Size), sec.SecHdr.Type), (sec.Length, sec.Type))
+
+    def test_nodes_share_the_buffer(self):
+        fd = parse(self.data)
+        for fv in fd.FvList:
+            self.assertIs(fv.View.obj, self.data)
+            for ffs in fv.FfsList:
+                self.assertIs(ffs.View.obj, self.data)
+                for sec in getattr(ffs, "SecList", []):
+                    self.assertIs(sec.View.obj, self.data)
+
+        # Nodes built on their own still take their own data
+        ffs = fd.FvList[0].FfsList[0]
+        alone = FirmwareFile(0, ffs.FfsData)
+        alone.ParseFfs()
+        self.assertEqual([sec.SecData for sec in alone.SecList],
+                         [sec.SecData for sec in ffs.SecList])
+        self.assertEqual(Section(0, ffs.SecList[1].SecData).Name, "File0_0")
+
+    def test_parse_does_not_copy(self):
+        tracemalloc.start()
+        parse(self.data)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.assertLess(peak, len(self.data) // 8)
+
+    def test_volume_scan(self):
+        fv = self.data[:FV_SIZE]
+        fake = bytearray(fv[:0x48])
+        fake[0x30] ^= 0xFF  # Bad header checksum
+        data = fv + b"\xff" * 0x808 + fake + b"\xff" * 0x1000 + fv + b"\xff" * 0x20
+        fd = parse(data)
+
+        # The gaps are found to the byte, the volume after them is not 4KB aligned
+        offsets = [(type(node).__name__, node.Offset, node.Length) for node in fd.FvList]
+        self.assertEqual(offsets, [
+            ("FirmwareVolume", 0, FV_SIZE),
+            ("PaddingFile", FV_SIZE, 0x1850),
+            ("FirmwareVolume", FV_SIZE + 0x1850, FV_SIZE),
+        ])
+        self.assertEqual(fd.FvList[2].FvData, fv)
+
+        # Views of a larger buffer are searched a window at a time
+        fd = parse(memoryview(b"\0" * 8 + data)[8:])
+        self.assertEqual([(type(node).__name__, node.Offset, node.Length) for node in fd.FvList],
+                         offsets)
+
+    def test_events(self):
+        data = self.data[:FV_SIZE] + b"\xff" * 0x1000 + self.data[FV_SIZE:]
+        fd = FirmwareDevice(0, data)
+        tracemalloc.start()
+        kinds = {}
+        for event in fd.events():
+            kinds[event.kind] = kinds.get(event.kind, 0) + 1
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.assertLess(peak, 64 * 1024)
+
+        fvs = BIOS_SIZE // FV_SIZE
+        files = (FV_SIZE - 0x100) // (FILE_SIZE + 0x100)
+        self.assertEqual(kinds, {
+            FV_EVENT.FV_START: fvs,
+            FV_EVENT.FV_END: fvs,
+            FV_EVENT.FFS: fvs * files,
+            FV_EVENT.SECTION: 2 * fvs * files,
+            FV_EVENT.FREE_SPACE: fvs,
+            FV_EVENT.PADDING: 1,
+        })
+
+        # The parse tree is built from the same events
+        tree = parse(data)
+        events = [event for event in fd.events() if event.kind == FV_EVENT.SECTION]
+        sections = [(ffs.Base + sec.Offset, sec.Length, sec.Name)
+                    for fv in tree.FvList if isinstance(fv, FirmwareVolume)
+                    for ffs in fv.FfsList if isinstance(ffs, FirmwareFile)
+                    for sec in ffs.SecList if sec.Type == EFI_SECTION_TYPE.USER_INTERFACE]
+        self.assertEqual([(event.offset, event.length, event.name) for event in events
+                          if event.header.Type == EFI_SECTION_TYPE.USER_INTERFACE], sections)
+        self.assertEqual(len([event for event in fd.events(sections=False)
+                              if event.kind == FV_EVENT.SECTION]), 0)
+
+    def test_verify(self):
+        fd = FirmwareDevice(0, self.data)
+        self.assertEqual(fd.verify(), [])
+
+        data = bytearray(self.data)
+        ffs = parse(self.data).FvList[1].FfsList[2]
+        data[FV_SIZE + ffs.Offset + 18] ^= 1  # File type
+        data[FV_SIZE * 2 + 0x20] ^= 1  # Volume length
+        # A file with a data checksum, in the free space of the last volume
+        fv = parse(self.data).FvList[-1]
+        free = fv.Base + fv.FfsList[-1].Offset
+        body = b"\x5a" * 0x100
+        header = bytearray(uuid.uuid4().bytes_le + bytes(8))
+        header[18] = EFI_FV_FILETYPE.FREEFORM
+        header[19] = ffs_replace.FFS_ATTRIB_CHECKSUM
+        header[23] = 0x07
+        data[free:free + 0x118] = ffs_replace.file_header(header, body) + body
+        self.assertEqual(len(FirmwareDevice(0, bytes(data)).verify()), 2)
+        data[free + 0x20] ^= 1
+
+        errors = FirmwareDevice(0, bytes(data)).verify()
+        self.assertEqual([(offset, error.split(" of ")[0]) for offset, error in errors], [
+            (FV_SIZE + ffs.Offset, "Bad header checksum"),
+            (FV_SIZE * 2, "Bad header checksum"),
+            (free, "Bad data checksum"),
+        ])
+
+    def test_index(self):
+        fd = parse(self.data)
+        # The volumes all have the same name, the first one is found
+        self.assertIs(fd.get_fv_by_guid(fd.FvList[2].Name), fd.FvList[0])
+        self.assertEqual(fd.get_fv_index_by_guid(bytes(fd.FvList[2].Name)), 0)
+        self.assertEqual(fd.get_fv_index_by_guid(b"\x01" * 16), -1)
+
+        fv = fd.FvList[2]
+
+        ffs = fd.get_ffs_by_name("File2_3")
+        self.assertIs(ffs, fv.FfsList[3])
+        self.assertEqual(ffs.UiName, "File2_3")
+        self.assertEqual(fd.get_ffs_by_guid(uuid.UUID(bytes_le=bytes(ffs.Name))),
+                         [(fv, ffs.Offset)])
+        self.assertIsNone(fd.get_ffs_by_name("File9_9"))
+
+        # Files in encapsulated volumes are indexed once decoded
+        fd = parse(encapsulated_bios())
+        self.assertIsNone(fd.get_ffs_by_name("Inner"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            fd.index_encapsulated()
+        inner = fd.get_ffs_by_name("Inner")
+        self.assertEqual(inner.SecList[0].SecData[4:], b"\x5a" * 0x1000)
+        ((inner_fv, offset),) = fd.get_ffs_by_guid(inner.Name)
+        self.assertIsNot(inner_fv, fd.FvList[0])
+        self.assertEqual(inner_fv.FfsList[0].Offset, offset)
+
+    def test_encapsulated_sections(self):
+        data = encapsulated_bios()
+        fd = parse(data)
+        misses = section_cache.misses
+        (guided,) = fd.FvList[0].FfsList[0].SecList
+        self.assertEqual(guided.Type, EFI_SECTION_TYPE.GUID_DEFINED)
+        self.assertEqual(section_cache.misses, misses)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            names = [node.Name for node in fd.walk()
+                     if isinstance(node, Section) and node.Type == EFI_SECTION_TYPE.USER_INTERFACE]
+        self.assertEqual(names, ["Inner"])
+        self.assertEqual(section_cache.misses, misses + 1)
+
+        (fv_section,) = guided.Children
+        (inner,) = fv_section.Children
+        self.assertIsInstance(inner, FirmwareVolume)
+        self.assertIs(inner.Buffer, fv_section.Buffer)
+        self.assertEqual(inner.FfsList[0].SecList[0].SecData[4:], b"\x5a" * 0x1000)
+
+        # Parsing the image again reuses the decoded section
+        hits = section_cache.hits
+        self.assertEqual(len(parse(data).FvList[0].FfsList[0].SecList[0].Children), 1)
+        self.assertEqual(section_cache.hits, hits + 1)
+        self.assertEqual(section_cache.misses, misses + 1)
+
+    def test_from_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            image_file = os.path.join(tmpdir, "ifwi.bin")
+            with open(image_file, "wb") as image_fd:
+                image_fd.write(spi_descriptor(0x1000 + BIOS_SIZE))
+                image_fd.write(self.data)
+
+            tracemalloc.start()
+            with IFWI_IMAGE.from_file(image_file) as ifwi:
+                self.assertTrue(ifwi.is_ifwi_image())
+                with contextlib.redirect_stdout(io.StringIO()):
+                    ifwi.parse()
+                self.assertEqual(ifwi.find_ifwi_region("bios"), (0x1000, BIOS_SIZE + 0xFFF))
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.assertLess(peak, len(self.data) // 8)
+
+            with FirmwareDevice.from_file(image_file) as fd:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    fd.ParseFd()
+                self.assertEqual(fd.FvList[2].FvData, self.data[FV_SIZE:2 * FV_SIZE])
+
+            # Changes to a writable map are not written to the file
+            with IFWI_IMAGE.from_file(image_file, writable=True) as ifwi:
+                ifwi.data[0x10:0x14] = bytes(4)
+                self.assertEqual(ifwi.data[0x10:0x14], bytes(4))
+            with IFWI_IMAGE.from_file(image_file) as ifwi:
+                self.assertTrue(ifwi.is_ifwi_image())
+
+    def test_index_file(self):
+        def layout(fd):
+            return [(type(node).__name__, node.Offset, node.Base, node.Length,
+                     getattr(node, "Name", None), getattr(node, "Type", None),
+                     getattr(node, "UiName", None), getattr(node, "FspExists", None))
+                    for fv in fd.FvList for node in walk_tree(fv)]
+
+        def walk_tree(fv):
+            yield fv
+            for ffs in getattr(fv, "FfsList", ()):
+                yield ffs
+                yield from getattr(ffs, "SecList", ())
+
+        expected = parse(self.data)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            image_file = os.path.join(tmpdir, "bios.bin")
+            with open(image_file, "wb") as image_fd:
+                image_fd.write(self.data)
+
+            # The index is only saved on request
+            with FirmwareDevice.from_file(image_file) as fd:
+                self.assertFalse(fd.parse())
+            self.assertFalse(os.path.exists(image_file + INDEX_SUFFIX))
+            with FirmwareDevice.from_file(image_file) as fd:
+                self.assertFalse(fd.parse(write_index=True))
+                self.assertEqual(layout(fd), layout(expected))
+                digests = fd.Digests
+            self.assertTrue(os.path.exists(image_file + INDEX_SUFFIX))
+            self.assertEqual(digests[FV_SIZE], hashlib.sha256(self.data[FV_SIZE:2 * FV_SIZE]).digest())
+
+            # The next open loads the tree from the index, matching the image
+            # file by its size and time without hashing it
+            with FirmwareDevice.from_file(image_file) as fd, \
+                    mock.patch.object(FirmwareDevice, "image_digest", side_effect=AssertionError):
+                self.assertTrue(fd.parse())
+                self.assertEqual(layout(fd), layout(expected))
+                self.assertEqual(fd.Digests, digests)
+                ffs = fd.get_ffs_by_name("File2_3")
+                self.assertIs(ffs, fd.FvList[2].FfsList[3])
+                self.assertEqual(ffs.SecList[0].SecData[4:], bytes([3]) * FILE_SIZE)
+                self.assertEqual(fd.FvList[1].FvHdr.FvLength, FV_SIZE)
+
+            # Another parser version or other data parse the image again
+            with mock.patch.object(firmware_volume, "PARSER_VERSION", 0):
+                with FirmwareDevice.from_file(image_file) as fd:
+                    self.assertFalse(fd.parse(write_index=True))
+            with FirmwareDevice.from_file(image_file) as fd:
+                self.assertFalse(fd.parse(write_index=True))
+            with open(image_file, "r+b") as image_fd:
+                image_fd.seek(FV_SIZE + 0x100)
+                image_fd.write(b"\x5a")
+            with FirmwareDevice.from_file(image_file) as fd:
+                self.assertFalse(fd.parse(write_index=True))
+                self.assertNotEqual(fd.Digests, digests)
+                self.assertEqual(len(fd.FvList), BIOS_SIZE // FV_SIZE)
+            with FirmwareDevice.from_file(image_file) as fd:
+                self.assertTrue(fd.parse())
+
+            # A touched image is compared by its digest, the same data in
+            # memory too
+            os.utime(image_file, ns=(0, 0))
+            with FirmwareDevice.from_file(image_file) as fd:
+                self.assertTrue(fd.parse())
+            with open(image_file, "rb") as image_fd:
+                self.assertTrue(FirmwareDevice(0, image_fd.read()).load_index(
+                    image_file + INDEX_SUFFIX))
+
+            # An index that cannot be written is left out
+            with FirmwareDevice.from_file(image_file) as fd:
+                self.assertFalse(fd.parse(os.path.join(tmpdir, "missing", "bios.fvidx"),
+                                          write_index=True))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,6 +5,14 @@
    TestReplaceSubRegions - test for replacing subregions
    TestReplaceGop - test replacing of the Graphic output Protocal regions
    TestExceptions - force exception code to execute
+   TestObbDigest - test the OBB digest update
+   TestBatchStitch - test stitching a matrix of jobs in parallel
+   TestDelta - test saving and applying deltas of stitched images
+   TestNativeReplace - test replacing files without FMMT
+   TestService - test the local stitch service
+   TestCompression - test in-process LZMA compression
+   TestToolExecutor - test running tools with timeouts
+   TestArtifactCache - test caching of build steps
 """
 
 import os
@@ -17,6 +25,12 @@ import filecmp
 import shutil
 import platform
 import glob
+import hashlib
+import json
+import socket
+import tempfile
+import stat
+import time
 
 sys.path.insert(0, "..")
 from common.tools_path import (
@@ -30,10 +44,44 @@ from common.tools_path import (
     FMMT_CFG,
 )
 from functools import wraps
+from tests.image_builder import build_ifwi
 
 SIIPSTITCH = os.path.join("scripts", "siip_stitch.py")
 IMAGES_PATH = os.path.join("tests", "images")
 
+_cache_dir = None
+_previous_cache_dir = None
+
+
+def set_cache_dir(cache_dir):
+    """Point SIIP_CACHE_DIR, for the tools run by the tests, and the artifact
+    cache of this process at cache_dir. Returns the previous SIIP_CACHE_DIR"""
+
+    from common import artifact_cache
+
+    previous = os.environ.get(artifact_cache.CACHE_DIR_ENV)
+    if cache_dir is None:
+        os.environ.pop(artifact_cache.CACHE_DIR_ENV, None)
+    else:
+        os.environ[artifact_cache.CACHE_DIR_ENV] = cache_dir
+    artifact_cache.cache.configure(os.environ.get(artifact_cache.CACHE_DIR_ENV,
+                                                  artifact_cache.DEFAULT_CACHE_DIR),
+                                   artifact_cache.cache_size_from_env())
+    artifact_cache.cache.clear()
+    return previous
+
+
+def setUpModule():
+    # Keep the artifacts of the tests out of the cache of the user
+    global _cache_dir, _previous_cache_dir
+    _cache_dir = tempfile.mkdtemp()
+    _previous_cache_dir = set_cache_dir(_cache_dir)
+
+
+def tearDownModule():
+    set_cache_dir(_previous_cache_dir)
+    shutil.rmtree(_cache_dir, ignore_errors=True)
+
 
 class TestFunctionality(unittest.TestCase):
     """Test general functionality of SIIP Stitch Tool"""
@@ -205,7 +253,8 @@ class TestErrorCases(unittest.TestCase):
         ]
 
         results = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        assert b"FMMT timed out" in results.stderr
+        assert b"is not a valid IFWI/BIOS image" in results.stderr
+        assert b"FMMT" not in results.stdout + results.stderr
 
     def test_overwrite_output(
         self
@@ -582,6 +631,809 @@ class TestFilesAbsPath(unittest.TestCase):  # files with absolute path
         subprocess.check_call(cmd)
 
 
+class TestObbDigest(unittest.TestCase):
+    """Test OBB digest update on a synthetic IFWI image"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.workdir = tempfile.mkdtemp()
+        cls.ifwi = build_ifwi(cls.workdir, os.path.join(cls.workdir, "ifwi.bin"))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workdir)
+
+    def tearDown(self):
+        cleanup()
+
+    def test_obb_digest_cache(self):
+        from scripts.siip_stitch import ObbDigestCache
+
+        base = bytes(os.urandom(0x4000))
+        fv_ranges = [(0x0, 0x1000), (0x1000, 0x2000), (0x3000, 0x1000)]
+        cache = ObbDigestCache()
+        data = bytearray(base)
+        view = memoryview(data)
+        self.assertEqual(cache.obb_digest(view, fv_ranges, [], base_key="a"),
+                         hashlib.sha256(data).digest())
+
+        data[0x3010] ^= 0xFF
+        digest = cache.obb_digest(view, fv_ranges, [(0x3010, 1)], base_key="a")
+        self.assertEqual(digest, hashlib.sha256(data).digest())
+
+        # Only the volumes unchanged from the base image are reused
+        data[:] = base
+        data[0x10] ^= 0xFF
+        digest = cache.obb_digest(view, fv_ranges, [(0x10, 1)], base_key="a")
+        self.assertEqual(digest, hashlib.sha256(data).digest())
+
+        # Another base image with volumes at the same offsets
+        other = bytearray(os.urandom(0x4000))
+        digest = cache.obb_digest(memoryview(other), fv_ranges, [], base_key="b")
+        self.assertEqual(digest, hashlib.sha256(other).digest())
+
+        # Without a base image every volume is hashed
+        data[0x2000] ^= 0xFF
+        self.assertEqual(cache.obb_digest(view, fv_ranges), hashlib.sha256(data).digest())
+
+    def test_bios_volumes(self):
+        from common import obb_digest
+        from common.ifwi import IFWI_IMAGE
+
+        with open(self.ifwi, "rb") as fd:
+            data = fd.read()
+        bios_start, bios_limit = IFWI_IMAGE(None, data).find_ifwi_region("bios")
+        bios = data[bios_start:bios_limit + 1]
+        volumes = obb_digest.bios_volumes(memoryview(bios))
+        self.assertEqual(len(volumes), 6)
+
+        # Erased space before and between the volumes is listed as filler
+        first = volumes[0][1]
+        padded = b"\xff" * 0x3000 + bios[:first] + b"\xff" * 0x2000 + bios[first:]
+        padded_volumes = obb_digest.bios_volumes(memoryview(padded))
+        self.assertEqual(padded_volumes[0], (0, 0x3000, None, False))
+        self.assertEqual(padded_volumes[2], (0x3000 + first, 0x2000, None, False))
+        self.assertEqual([volume[1:] for volume in padded_volumes[1:2] + padded_volumes[3:]],
+                         [volume[1:] for volume in volumes])
+
+    def test_replace_vbt_updates_obb_digest(self):
+        from common.ifwi import IFWI_IMAGE
+        from common.firmware_volume import FirmwareDevice
+
+        cmd = [
+            "python",
+            SIIPSTITCH,
+            self.ifwi,
+            os.path.join(IMAGES_PATH, "Vbt.bin"),
+            "-ip",
+            "vbt",
+            "-k",
+            os.path.join(IMAGES_PATH, "privkey.pem"),
+        ]
+        subprocess.check_call(cmd)
+
+        ifwi = IFWI_IMAGE("BIOS_OUT.bin")
+        ifwi.parse()
+        _, bios_start, bios_limit = ifwi.region_list[1]
+        bios = FirmwareDevice(0, ifwi.data[bios_start:bios_limit + 1])
+        bios.ParseFd()
+        obb_start = bios.FvList[1].Offset
+        obb_end = bios.FvList[5].Offset + len(bios.FvList[5].FvData)
+        expected = hashlib.sha256(bios.FdData[obb_start:obb_end]).digest()
+        self.assertIn(expected, bios.FvList[0].FvData)
+
+
+class TestBatchStitch(unittest.TestCase):
+    """Test stitching a job matrix in parallel"""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        build_ifwi(self.workdir, os.path.join(self.workdir, "v1_spi.bin"))
+        shutil.copy(os.path.join(self.workdir, "v1_spi.bin"),
+                    os.path.join(self.workdir, "v2_spi.bin"))
+        shutil.copy(os.path.join(IMAGES_PATH, "Vbt.bin"), self.workdir)
+        shutil.copy(os.path.join(IMAGES_PATH, "privkey.pem"), self.workdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+        cleanup()
+
+    def test_batch_matrix(self):
+        matrix = {
+            "output_dir": "out",
+            "ifwi": ["v*_spi.bin"],
+            "payloads": {"vbt": ["Vbt.bin"]},
+            "keys": ["privkey.pem"],
+            "jobs": [{"ifwi": "v1_spi.bin", "ip": "pse",
+                      "payload": os.path.abspath(os.path.join(IMAGES_PATH, "PseFw.bin")),
+                      "output": "pse.bin"}],
+        }
+        with open(os.path.join(self.workdir, "matrix.json"), "w") as fd:
+            json.dump(matrix, fd)
+
+        cmd = ["python", SIIPSTITCH, "batch", os.path.join(self.workdir, "matrix.json"),
+               "-j", "2", "--summary", "tmp.summary.json"]
+        subprocess.check_call(cmd)
+
+        with open("tmp.summary.json") as fd:
+            summary = json.load(fd)
+        self.assertEqual(summary["succeeded"], 3)
+        self.assertEqual(summary["failed"], 0)
+
+        cmd = ["python", SIIPSTITCH, os.path.join(self.workdir, "v1_spi.bin"),
+               os.path.join(IMAGES_PATH, "Vbt.bin"), "-ip", "vbt",
+               "-k", os.path.join(IMAGES_PATH, "privkey.pem")]
+        subprocess.check_call(cmd)
+        self.assertTrue(filecmp.cmp(
+            "BIOS_OUT.bin", os.path.join(self.workdir, "out", "Vbt_v1_spi.bin"), shallow=False))
+        self.assertTrue(os.path.exists(os.path.join(self.workdir, "out", "pse.bin")))
+
+    def test_fanout(self):
+        images = [os.path.join(self.workdir, f) for f in ("v1_spi.bin", "v2_spi.bin")]
+        cmd = ["python", SIIPSTITCH, "fanout", os.path.join(IMAGES_PATH, "PseFw.bin")] + images
+        cmd += ["-ip", "pse", "--output-dir", self.workdir, "-o", "{ifwi_stem}.{ip}.bin"]
+        subprocess.check_call(cmd)
+
+        cmd = ["python", SIIPSTITCH, images[0], os.path.join(IMAGES_PATH, "PseFw.bin"),
+               "-ip", "pse"]
+        subprocess.check_call(cmd)
+        for name in ("v1_spi.pse.bin", "v2_spi.pse.bin"):
+            self.assertTrue(filecmp.cmp(
+                "BIOS_OUT.bin", os.path.join(self.workdir, name), shallow=False))
+
+
+class TestDelta(unittest.TestCase):
+    """Test delta output and apply-delta"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.workdir = tempfile.mkdtemp()
+        cls.ifwi = build_ifwi(cls.workdir, os.path.join(cls.workdir, "ifwi.bin"))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workdir)
+
+    def tearDown(self):
+        cleanup()
+
+    def test_diff_ranges(self):
+        from common.delta import diff_ranges
+
+        old = os.urandom(0x30000)
+        new = bytearray(old)
+        new[0x10] ^= 1
+        new[0x18] ^= 1
+        new[0x20000:0x20100] = bytes(0x100)
+        new += b"tail"
+        self.assertEqual(diff_ranges(old, new),
+                         [(0x10, 9), (0x20000, 0x100), (0x30000, 4)])
+        self.assertEqual(diff_ranges(old, old), [])
+
+    def test_merge_ranges(self):
+        from common.delta import merge_ranges
+
+        self.assertEqual(merge_ranges([(0x100, 0x10), (0x0, 0x10)],
+                                      [(0x108, 0x10), (0x10, 0x4), (0x200, 1)]),
+                         [(0x0, 0x14), (0x100, 0x18), (0x200, 1)])
+        self.assertEqual(merge_ranges([(0x0, 0x100)], [(0x10, 0x10)]), [(0x0, 0x100)])
+
+    def test_clone_and_patch(self):
+        import common.utilities as utils
+
+        out = os.path.join(self.workdir, "clone.bin")
+        utils.clone_file(self.ifwi, out)
+        self.assertTrue(filecmp.cmp(self.ifwi, out, shallow=False))
+
+        utils.patch_file(out, [(0x10, b"\xaa\xbb"), (0x2000, b"\xcc")], 0x3000)
+        with open(self.ifwi, "rb") as fd:
+            expected = bytearray(fd.read(0x3000))
+        expected[0x10:0x12] = b"\xaa\xbb"
+        expected[0x2000] = 0xcc
+        with open(out, "rb") as fd:
+            self.assertEqual(fd.read(), expected)
+
+    def test_delta_round_trip(self):
+        cmd = ["python", SIIPSTITCH, self.ifwi, os.path.join(IMAGES_PATH, "Vbt.bin"),
+               "-ip", "vbt", "-k", os.path.join(IMAGES_PATH, "privkey.pem")]
+        subprocess.check_call(cmd + ["-d", "tmp.vbt.delta"])
+        self.assertFalse(os.path.exists("BIOS_OUT.bin"))
+        self.assertLess(os.path.getsize("tmp.vbt.delta"), 0x1000)
+
+        subprocess.check_call(cmd)
+        cmd = ["python", SIIPSTITCH, "apply-delta", self.ifwi, "tmp.vbt.delta", "-o", "IFWI.bin"]
+        subprocess.check_call(cmd)
+        self.assertTrue(filecmp.cmp("BIOS_OUT.bin", "IFWI.bin", shallow=False))
+
+        # The delta only applies to its own base image
+        cmd = ["python", SIIPSTITCH, "apply-delta", "BIOS_OUT.bin", "tmp.vbt.delta",
+               "-o", "tmp.out.bin"]
+        results = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.assertNotEqual(results.returncode, 0)
+        assert b"is not the base image" in results.stderr
+        self.assertFalse(os.path.exists("tmp.out.bin"))
+
+        # Nor over its base image, which is left as it is
+        shutil.copyfile(self.ifwi, "tmp.base.bin")
+        cmd = ["python", SIIPSTITCH, "apply-delta", "tmp.base.bin", "tmp.vbt.delta",
+               "-o", "tmp.base.bin"]
+        results = subprocess.run(cmd, input=b"y\n", stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+        self.assertNotEqual(results.returncode, 0)
+        assert b"is the base image" in results.stderr
+        self.assertTrue(filecmp.cmp(self.ifwi, "tmp.base.bin", shallow=False))
+
+
+class TestNativeReplace(unittest.TestCase):
+    """Test replacing files in place without FMMT"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.workdir = tempfile.mkdtemp()
+        cls.ifwi = build_ifwi(cls.workdir, os.path.join(cls.workdir, "ifwi.bin"))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workdir)
+
+    def tearDown(self):
+        cleanup()
+
+    def test_rsa_matches_rsa_helper(self):
+        from common import guided_tools
+
+        key = os.path.join(IMAGES_PATH, "privkey.pem")
+        data_file = os.path.join(IMAGES_PATH, "Vbt.bin")
+        signed = os.path.join(self.workdir, "vbt.signed")
+        subprocess.check_call(["python", RSA_HELPER, "-e", "--private-key", key,
+                               "-o", signed, data_file])
+        with open(data_file, "rb") as fd:
+            data = fd.read()
+        with open(signed, "rb") as fd:
+            expected = fd.read()
+
+        self.assertEqual(guided_tools.rsa_encode(data, key), expected)
+        self.assertEqual(guided_tools.rsa_decode(expected), data)
+
+    def test_replace_signed_vbt(self):
+        from common import ffs_replace
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import padding
+
+        vbt = os.path.join(self.workdir, "vbt_new.bin")
+        with open(os.path.join(IMAGES_PATH, "Vbt.bin"), "rb") as fd:
+            data = bytearray(fd.read())
+        data[0x100:0x200] = os.urandom(0x100)
+        data += os.urandom(0x400)
+        with open(vbt, "wb") as fd:
+            fd.write(data)
+
+        cmd = ["python", SIIPSTITCH, self.ifwi, vbt, "-ip", "vbt",
+               "-k", os.path.join(IMAGES_PATH, "privkey.pem")]
+        results = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.assertEqual(results.returncode, 0)
+        assert b"Replaced IntelGopVbt in place" in results.stdout
+
+        with open("BIOS_OUT.bin", "rb") as fd:
+            image = fd.read()
+        files = ffs_replace.find_files(image, "IntelGopVbt")
+        self.assertEqual(len(files), 1)
+        self.assertIn(bytes(data), files[0])
+
+        # The signature of the rebuilt RSA section checks with the key
+        with open(os.path.join(IMAGES_PATH, "privkey.pem"), "rb") as fd:
+            key = serialization.load_pem_private_key(fd.read(), password=None)
+        fv_start, fv_len = list(ffs_replace.find_fvs(image))[4]
+        fv = image[fv_start:fv_start + fv_len]
+        signed_file = [f for f in ffs_replace.fv_files(fv) if not f.is_free and not f.is_pad][0]
+        section = fv[signed_file.offset + signed_file.header_size:signed_file.end]
+        payload = section[24:]
+        key.public_key().verify(payload[0x110:0x210], payload[0x210:],
+                                padding.PKCS1v15(), hashes.SHA256())
+        self.assertEqual(payload[0x10:0x110],
+                         key.public_key().public_numbers().n.to_bytes(256, "big"))
+
+        # FMMT still reads the image
+        env = dict(os.environ, PATH=TOOLS_DIR + os.pathsep + os.environ["PATH"])
+        listing = subprocess.check_output([FMMT, "-v", "BIOS_OUT.bin"], env=env)
+        assert b'File "IntelGopVbt"' in listing
+
+    def test_verify(self):
+        from common import verify
+
+        vbt = os.path.join(IMAGES_PATH, "Vbt.bin")
+        cmd = ["python", SIIPSTITCH, self.ifwi, vbt, "-ip", "vbt",
+               "-k", os.path.join(IMAGES_PATH, "privkey.pem"), "-o", "tmp.verify.bin"]
+        results = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.assertEqual(results.returncode, 0)
+        assert b"2 volume(s) changed" in results.stdout
+
+        names = ["IntelGopVbt", "ObbDigest"]
+        volumes = verify.verify_stitch(self.ifwi, "tmp.verify.bin", names)
+        self.assertEqual(len(volumes), 2)
+
+        # A change outside of the stitched volumes is caught
+        with open("tmp.verify.bin", "r+b") as fd:
+            fd.seek(volumes[0][0] - 1)
+            byte = fd.read(1)
+            fd.seek(-1, os.SEEK_CUR)
+            fd.write(bytes([byte[0] ^ 0xFF]))
+        with self.assertRaises(verify.VerifyError):
+            verify.verify_stitch(self.ifwi, "tmp.verify.bin", names)
+
+    def test_fwdiff(self):
+        from common import fwdiff
+        from common.stitch import stitch
+
+        with open(self.ifwi, "rb") as fd:
+            image = fd.read()
+        with open(os.path.join(IMAGES_PATH, "Vbt.bin"), "rb") as fd:
+            vbt = bytearray(fd.read())
+        vbt[-1] ^= 0xFF
+        with open("tmp.fwdiff.bin", "wb") as fd:
+            fd.write(stitch(image, "vbt", vbt, key=os.path.join(IMAGES_PATH, "privkey.pem")))
+
+        self.assertEqual(fwdiff.diff_images(self.ifwi, self.ifwi), [])
+        changes = fwdiff.diff_images(self.ifwi, "tmp.fwdiff.bin")
+        self.assertEqual(set(change.status for change in changes), {"changed"})
+        labels = [change.new.label for change in changes]
+        assert any(label.endswith("ObbDigest") for label in labels)
+        assert any(label.endswith("IntelGopVbt") for label in labels)
+        self.assertEqual(len([change for change in changes if change.depth == 0]), 2)
+
+        # The digests of the index files give the same changes, without
+        # hashing the whole images
+        from unittest import mock
+        from common.firmware_volume import INDEX_SUFFIX, FirmwareDevice
+        for image in (self.ifwi, "tmp.fwdiff.bin"):
+            with FirmwareDevice.from_file(image) as fd:
+                fd.parse(write_index=True)
+        try:
+            with mock.patch.object(FirmwareDevice, "image_digest", side_effect=AssertionError):
+                indexed = fwdiff.diff_images(self.ifwi, "tmp.fwdiff.bin")
+            self.assertEqual([fwdiff.format_change(change) for change in indexed],
+                             [fwdiff.format_change(change) for change in changes])
+        finally:
+            os.remove(self.ifwi + INDEX_SUFFIX)
+
+        cmd = ["python", SIIPSTITCH, "fwdiff", self.ifwi, "tmp.fwdiff.bin"]
+        results = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.assertEqual(results.returncode, 0)
+        assert b"IntelGopVbt" in results.stdout
+        assert "0 added, 0 removed, {} changed".format(len(changes)).encode() in results.stdout
+
+    @pytest.mark.skipif(sys.platform == "win32", reason="uses the resource module")
+    def test_large_image_memory(self):
+        # Peak memory of a stitch does not grow with the size of the image:
+        # it is compared with the stitch of a small image, both with an empty
+        # build cache, so the fixed costs (interpreter, LZMA encoder) cancel
+        image_size = 128 * 1024 * 1024
+        script = ("import resource, subprocess, sys;"
+                  "status = subprocess.call(sys.argv[1:], stdout=subprocess.DEVNULL);"
+                  "print(status, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)")
+
+        def max_rss(name, size=None):
+            ifwi = build_ifwi(self.workdir, os.path.join(self.workdir, name), size)
+            out = os.path.join(self.workdir, "out_" + name)
+            env = dict(os.environ, SIIP_CACHE_DIR=tempfile.mkdtemp(dir=self.workdir))
+            cmd = [sys.executable, "-c", script, sys.executable, SIIPSTITCH, ifwi,
+                   os.path.join(IMAGES_PATH, "Vbt.bin"), "-ip", "vbt",
+                   "-k", os.path.join(IMAGES_PATH, "privkey.pem"), "-o", out]
+            try:
+                status, rss = subprocess.check_output(cmd, env=env).split()
+            finally:
+                for path in (ifwi, out):
+                    if os.path.exists(path):
+                        os.remove(path)
+            self.assertEqual(int(status), 0)
+            return int(rss) * 1024
+
+        small = max_rss("small.bin")
+        large = max_rss("large.bin", image_size)
+        self.assertLess(large - small, image_size // 4)
+
+    def test_profile(self):
+        import pstats
+
+        cmd = ["python", SIIPSTITCH, self.ifwi, os.path.join(IMAGES_PATH, "PseFw.bin"),
+               "-ip", "pse", "-o", "tmp.profile.bin", "--profile", "tmp.profile.json",
+               "--profile-stats", "tmp.profile.stats"]
+        subprocess.check_call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        with open("tmp.profile.json") as fd:
+            report = json.load(fd)
+        self.assertEqual(report["status"], 0)
+        phases = [phase["name"] for phase in report["phases"]]
+        for name in ("arguments", "checks", "build", "native_replace", "save",
+                     "verify", "cleanup"):
+            self.assertIn(name, phases)
+        self.assertGreaterEqual(report["total"], sum(p["seconds"] for p in report["phases"]))
+        tools = {tool["name"]: tool for tool in report["tools"]}
+        self.assertEqual(tools["lzma_compress_file"]["argv"], ["tmp.all", "tmp.cmps"])
+
+        stats = pstats.Stats("tmp.profile.stats")
+        self.assertGreater(stats.total_calls, 0)
+
+    def test_preflight(self):
+        from common import preflight
+        from common.firmware_volume import section_cache
+        from common.ifwi import IFWI_IMAGE
+
+        with open(self.ifwi, "rb") as fd:
+            image = bytearray(fd.read())
+        section_cache.clear()
+        preflight.check_image(image, "IntelPseFw", ifwi_required=True)
+        # The sections decoded by the checks are reused by the stitch
+        misses = section_cache.stats()["misses"]
+        self.assertGreater(misses, 0)
+        self.assertEqual(len(preflight.ffs_replace.find_volumes(image, "IntelPseFw")), 1)
+        self.assertEqual(section_cache.stats()["misses"], misses)
+        with self.assertRaises(preflight.PreflightError):
+            preflight.check_image(image, "IntelTccConfig")
+        with self.assertRaises(preflight.PreflightError):
+            preflight.check_image(image[:0x30000], "IntelPseFw")
+        with self.assertRaises(preflight.PreflightError):
+            preflight.check_image(image[0x1000:], "IntelPseFw", ifwi_required=True)
+
+        # Only the BIOS region is scanned for volumes
+        bios_start, bios_length = preflight.check_regions(IFWI_IMAGE(None, image))
+        fvs = preflight.check_volumes(image, bios_start, bios_length)
+        with_header = bytearray(image)
+        with_header[0x800:0x800 + 0x48] = image[fvs[0][0]:fvs[0][0] + 0x48]
+        self.assertEqual(preflight.check_volumes(with_header, bios_start, bios_length), fvs)
+        preflight.check_image(with_header, "IntelPseFw", ifwi_required=True)
+        last, last_length = fvs[-1]
+        with self.assertRaisesRegex(preflight.PreflightError, "ends after the end"):
+            preflight.check_volumes(image, bios_start, last + last_length - 8 - bios_start)
+
+        # The header checksum of the second volume is broken
+        fv = list(preflight.ffs_replace.find_fvs(image))[1][0]
+        image[fv + 0x32] ^= 0xFF
+        with open("tmp.bad.bin", "wb") as fd:
+            fd.write(image)
+        cmd = ["python", SIIPSTITCH, "tmp.bad.bin", os.path.join(IMAGES_PATH, "PseFw.bin"),
+               "-ip", "pse", "-o", "tmp.out.bin"]
+        results = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.assertNotEqual(results.returncode, 0)
+        self.assertIn("Bad header checksum of the volume at {:#x}".format(fv).encode(),
+                      results.stdout)
+        self.assertNotIn(b"GenSec", results.stdout)
+        self.assertFalse(os.path.exists("tmp.out.bin"))
+
+    def test_stitch_api(self):
+        import io
+        import logging
+        from common import ffs_builder
+        from common import utilities
+        from common.firmware_volume import FirmwareDevice
+        from common.siip_constants import IP_OPTIONS
+        from common.stitch import StitchError, _searchable, stitch, stitch_to
+
+        with open(self.ifwi, "rb") as fd:
+            image = fd.read()
+        with open(os.path.join(IMAGES_PATH, "Vbt.bin"), "rb") as fd:
+            vbt = fd.read()
+        key = os.path.join(IMAGES_PATH, "privkey.pem")
+        with open(key, "rb") as fd:
+            pem = fd.read()
+
+        log = logging.getLogger("test")
+        self.assertEqual(ffs_builder.build_recipe(IP_OPTIONS["vbt"], vbt),
+                         ffs_builder.build_with_tools(log, "vbt", vbt))
+
+        cmd = ["python", SIIPSTITCH, self.ifwi, os.path.join(IMAGES_PATH, "Vbt.bin"),
+               "-ip", "vbt", "-k", key, "-o", "tmp.out.bin"]
+        subprocess.check_call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with open("tmp.out.bin", "rb") as fd:
+            expected = fd.read()
+
+        utilities.record_timing("stale", 1.0)
+        self.assertEqual(stitch(memoryview(image), "vbt", vbt, key=pem), expected)
+        # Every stitch starts with no timings
+        self.assertNotIn("stale", [name for name, _, _ in utilities.tool_timings])
+        out = io.BytesIO()
+        changed = stitch_to(image, "vbt", vbt, out, key=key)
+        self.assertEqual(out.getvalue(), expected)
+        self.assertEqual(len(changed), 2)
+        self.assertEqual(FirmwareDevice(0, expected).verify(), [])
+
+        # Memoryviews are searched through the object they view, or in place
+        self.assertIs(_searchable(memoryview(image)), image)
+        self.assertIsInstance(_searchable(memoryview(image)[0x1000:]), memoryview)
+
+        with self.assertRaises(StitchError):
+            stitch(image, "vbt", vbt)
+        with self.assertRaises(StitchError):
+            stitch(image, "tcc", vbt)
+
+    def test_no_room_in_place(self):
+        from common import ffs_replace
+
+        with open(self.ifwi, "rb") as fd:
+            image = fd.read()
+        ffs = ffs_replace.find_files(image, "ObbDigest")[0]
+
+        # Same size fits, a file running over the following PSE file does not
+        new = ffs_replace.replace_file(image, "ObbDigest", ffs)
+        self.assertEqual(new, image)
+        big = bytearray(ffs) + bytes(0x1000)
+        big[20:23] = len(big).to_bytes(3, "little")
+        with self.assertRaises(ffs_replace.NativeReplaceError):
+            ffs_replace.replace_file(image, "ObbDigest", big)
+        with self.assertRaises(ffs_replace.NativeReplaceError):
+            ffs_replace.replace_file(image, "NoSuchFile", ffs)
+
+
+@unittest.skipUnless(hasattr(socket, "AF_UNIX"), "requires Unix sockets")
+class TestService(unittest.TestCase):
+    """Test stitching through the stitch service"""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.ifwi = build_ifwi(self.workdir, os.path.join(self.workdir, "ifwi.bin"))
+        self.socket = os.path.join(self.workdir, "siip.sock")
+        self.server = subprocess.Popen(["python", SIIPSTITCH, "serve", "--socket",
+                                        self.socket, "-j", "2"])
+        for _ in range(100):
+            if os.path.exists(self.socket):
+                break
+            time.sleep(0.1)
+
+    def tearDown(self):
+        subprocess.call(["python", SIIPSTITCH, "serve", "--socket", self.socket, "--stop"])
+        self.server.wait(timeout=30)
+        shutil.rmtree(self.workdir)
+        cleanup()
+
+    def test_submit(self):
+        key = os.path.join(IMAGES_PATH, "privkey.pem")
+        vbt = os.path.join(IMAGES_PATH, "Vbt.bin")
+        subprocess.check_call(["python", SIIPSTITCH, self.ifwi, vbt, "-ip", "vbt", "-k", key])
+
+        submit = ["python", SIIPSTITCH, "submit", "--socket", self.socket,
+                  self.ifwi, vbt, "-ip", "vbt", "-k", key]
+        for name in ("tmp.1.bin", "tmp.2.bin"):
+            subprocess.check_call(submit + ["-o", name])
+            self.assertTrue(filecmp.cmp("BIOS_OUT.bin", name, shallow=False))
+
+        subprocess.check_call(submit + ["-d", "tmp.vbt.delta"])
+        subprocess.check_call(["python", SIIPSTITCH, "apply-delta", self.ifwi,
+                               "tmp.vbt.delta", "-o", "tmp.3.bin"])
+        self.assertTrue(filecmp.cmp("BIOS_OUT.bin", "tmp.3.bin", shallow=False))
+
+        # Errors are reported to the client
+        cmd = ["python", SIIPSTITCH, "submit", "--socket", self.socket,
+               self.ifwi, vbt, "-ip", "vbt", "-o", "tmp.4.bin"]
+        results = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.assertNotEqual(results.returncode, 0)
+        assert b"requires a private key" in results.stderr
+
+        # Nothing is overwritten, not even with the stitched image
+        for output, error in (("tmp.1.bin", b"exist!"), (self.ifwi, b"cannot be the input")):
+            results = subprocess.run(submit + ["-o", output], stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+            self.assertNotEqual(results.returncode, 0)
+            self.assertIn(error, results.stderr)
+
+    def test_socket_private(self):
+        self.assertEqual(stat.S_IMODE(os.stat(self.socket).st_mode), 0o600)
+
+
+class TestCompression(unittest.TestCase):
+    """Test in-process LZMA compression against LzmaCompress"""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_lzma_compatible(self):
+        from common import compression
+
+        payload = os.path.join(IMAGES_PATH, "PseFw.bin")
+        with open(payload, "rb") as fd:
+            data = fd.read()
+
+        packed = os.path.join(self.workdir, "py.cmps")
+        unpacked = os.path.join(self.workdir, "py.bin")
+        self.assertEqual(compression.lzma_compress_file(payload, packed), 0)
+        subprocess.check_call([LZCOMPRESS, "-d", "-o", unpacked, packed])
+        self.assertTrue(filecmp.cmp(payload, unpacked, shallow=False))
+
+        packed = os.path.join(self.workdir, "tool.cmps")
+        subprocess.check_call([LZCOMPRESS, "-e", "-o", packed, payload])
+        with open(packed, "rb") as fd:
+            self.assertEqual(compression.lzma_decompress(fd.read()), data)
+
+    def test_recipes_match_tools(self):
+        import logging
+        from common import ffs_builder
+        from common.siip_constants import IP_OPTIONS
+
+        with open(os.path.join(IMAGES_PATH, "Vbt.bin"), "rb") as fd:
+            payload = fd.read()
+
+        log = logging.getLogger("test")
+        for ipname, recipe in IP_OPTIONS.items():
+            try:
+                built = ffs_builder.build_recipe(recipe, payload)
+            except ffs_builder.FfsBuildError:
+                continue
+            self.assertEqual(built, ffs_builder.build_with_tools(log, ipname, payload), ipname)
+            if ["lzma", "-e"] not in recipe:
+                continue
+
+            # The compressed data of the GUIDed section is decoded by LzmaCompress
+            packed = os.path.join(self.workdir, ipname + ".cmps")
+            unpacked = os.path.join(self.workdir, ipname + ".bin")
+            with open(packed, "wb") as fd:
+                fd.write(built[ffs_builder.FFS_HEADER_SIZE + ffs_builder.GUIDED_HEADER_SIZE:])
+            subprocess.check_call([LZCOMPRESS, "-d", "-o", unpacked, packed])
+            sections = ffs_builder.merge_sections([
+                ffs_builder.section(ffs_builder.SECTION_TYPES["raw"], payload),
+                ffs_builder.ui_section(recipe[0][1])])
+            with open(unpacked, "rb") as fd:
+                self.assertEqual(fd.read(), sections, ipname)
+
+    def test_cache(self):
+        from common import artifact_cache
+        from common import compression
+
+        cache = artifact_cache.ArtifactCache(self.workdir)
+        calls = []
+
+        def compressor(data):
+            calls.append(data)
+            return compression.lzma_compress(data)
+
+        first = compression.cached_compress("lzma", b"\x5a" * 4096, compressor, cache)
+        self.assertEqual(compression.cached_compress("lzma", b"\x5a" * 4096, compressor, cache),
+                         first)
+        self.assertEqual(len(calls), 1)
+
+        # A new process finds the entry on disk
+        cache = artifact_cache.ArtifactCache(self.workdir)
+        self.assertEqual(compression.cached_compress("lzma", b"\x5a" * 4096, compressor, cache),
+                         first)
+        self.assertEqual(len(calls), 1)
+        compression.cached_compress("lzma", b"\xa5" * 4096, compressor, cache)
+        self.assertEqual(len(calls), 2)
+
+
+class TestToolExecutor(unittest.TestCase):
+    """Test running tools in their own process groups"""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.cache_dir = set_cache_dir(os.path.join(self.workdir, "cache"))
+
+    def tearDown(self):
+        set_cache_dir(self.cache_dir)
+        shutil.rmtree(self.workdir)
+
+    @pytest.mark.skipif(sys.platform == "win32", reason="uses a POSIX shell")
+    def test_timeout_kills_children(self):
+        from common import utilities
+
+        pid_file = os.path.join(self.workdir, "child.pid")
+        command = ["sh", "-c", "sleep 30 & echo $! > {}; wait".format(pid_file)]
+        start = time.time()
+        with self.assertRaises(subprocess.TimeoutExpired):
+            utilities.run_tool(command, timeout=1)
+        self.assertLess(time.time() - start, 20)
+
+        with open(pid_file) as fd:
+            child = int(fd.read())
+        with self.assertRaises(ProcessLookupError):
+            for _ in range(50):
+                os.kill(child, 0)
+                time.sleep(0.1)
+        self.assertEqual(utilities.tool_timings[-1][0], "sh")
+
+    def test_chains(self):
+        from common import utilities
+        import common.logging as logging
+
+        def copy(src, dst):
+            shutil.copyfile(src, dst)
+            return 0
+
+        script = "import shutil; shutil.copy('tmp.in', 'tmp.out')"
+        chains = []
+        for name in ("a", "b", "c"):
+            chain_dir = os.path.join(self.workdir, name)
+            os.mkdir(chain_dir)
+            with open(os.path.join(self.workdir, name + ".txt"), "w") as fd:
+                fd.write(name)
+            cmds = [[copy, os.path.join(self.workdir, name + ".txt"), "tmp.in"],
+                    [sys.executable, "-c", script]]
+            chains.append((cmds, chain_dir))
+
+        log = logging.getLogger("test")
+        self.assertEqual(utilities.execute_chains(log, chains), 0)
+        for name in ("a", "b", "c"):
+            with open(os.path.join(self.workdir, name, "tmp.out")) as fd:
+                self.assertEqual(fd.read(), name)
+
+        chains.append(([[sys.executable, "-c", "raise SystemExit(3)"]], self.workdir))
+        self.assertEqual(utilities.execute_chains(log, chains), 1)
+
+
+class TestArtifactCache(unittest.TestCase):
+    """Test caching of build steps"""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.cache_dir = set_cache_dir(os.path.join(self.workdir, "cache"))
+
+    def tearDown(self):
+        set_cache_dir(self.cache_dir)
+        shutil.rmtree(self.workdir)
+        cleanup()
+
+    def test_lru_eviction(self):
+        from common import artifact_cache
+
+        cache_dir = os.path.join(self.workdir, "cache")
+        max_bytes = 3 * (1000 + artifact_cache.ENTRY_DIGEST_SIZE)
+        cache = artifact_cache.ArtifactCache(cache_dir, max_bytes=max_bytes, memory_bytes=2000)
+        for name in ("a", "b", "c"):
+            cache.put(cache.key(name), bytes(1000))
+            time.sleep(0.01)
+        cache.get(cache.key("a"))
+        cache.put(cache.key("d"), bytes(1000))
+
+        cache = artifact_cache.ArtifactCache(cache_dir, max_bytes=max_bytes)
+        self.assertIsNone(cache.get(cache.key("b")))
+        for name in ("a", "c", "d"):
+            self.assertEqual(cache.get(cache.key(name)), bytes(1000))
+
+    def test_damaged_entry(self):
+        from common import artifact_cache
+
+        cache_dir = os.path.join(self.workdir, "cache")
+        cache = artifact_cache.ArtifactCache(cache_dir)
+        key = cache.key("a")
+        cache.put(key, b"\x5a" * 1000)
+        with open(os.path.join(cache_dir, key[:2], key), "r+b") as fd:
+            fd.seek(500)
+            fd.write(b"\xa5")
+
+        # The damaged file is dropped rather than used
+        cache = artifact_cache.ArtifactCache(cache_dir)
+        self.assertIsNone(cache.get(key))
+        self.assertFalse(os.path.exists(os.path.join(cache_dir, key[:2], key)))
+        self.assertEqual(cache.compute(key, lambda: b"\x5a" * 1000), b"\x5a" * 1000)
+        self.assertEqual(artifact_cache.ArtifactCache(cache_dir).get(key), b"\x5a" * 1000)
+
+    def test_build_steps_cached(self):
+        ifwi = build_ifwi(self.workdir, os.path.join(self.workdir, "ifwi.bin"))
+        outputs = []
+        for index in range(2):
+            out = os.path.join(self.workdir, "out{}.bin".format(index))
+            cmd = ["python", SIIPSTITCH, ifwi, os.path.join(IMAGES_PATH, "Vbt.bin"),
+                   "-ip", "vbt", "-k", os.path.join(IMAGES_PATH, "privkey.pem"), "-o", out]
+            results = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            self.assertEqual(results.returncode, 0)
+            outputs.append(out)
+        self.assertNotIn(b"GenFfs -o", results.stdout)
+        assert b"Reused tmp.ffs from cache" in results.stdout
+        self.assertTrue(filecmp.cmp(outputs[0], outputs[1], shallow=False))
+
+    def test_side_outputs_not_cached(self):
+        from common import artifact_cache
+        from common import utilities
+
+        cache = artifact_cache.ArtifactCache()
+        key, output = utilities._step_key(cache, [GENFFS, "-o", "tmp.ffs"], self.workdir)
+        self.assertIsNotNone(key)
+        self.assertEqual(output, os.path.join(self.workdir, "tmp.ffs"))
+        # GenFv also writes tmp.map and tmp.fv.txt, which the cache cannot restore
+        self.assertEqual(utilities._step_key(cache, [GENFV, "-o", "tmp.fv"], self.workdir),
+                         (None, None))
+
+
 def cleanup():
     print("Cleaning up generated files ...")
     to_remove = [
@@ -7,6 +7,8 @@ import unittest
 import uuid
 import filecmp
 import glob
+import shutil
+import tempfile
 from math import log
 
 import common.subregion_descriptor as dscrptr
@@ -19,6 +21,26 @@ IMAGES_PATH = os.path.join("tests", "images")
 JSON_PATH = os.path.join("scripts", "Examples")
 COLLATER_PATH = os.path.join("tests", "Collateral")
 
+_cache_dir = None
+_previous_cache_dir = None
+
+
+def setUpModule():
+    # Keep the artifacts of the tools run by the tests out of the cache of
+    # the user
+    global _cache_dir, _previous_cache_dir
+    _cache_dir = tempfile.mkdtemp()
+    _previous_cache_dir = os.environ.get("SIIP_CACHE_DIR")
+    os.environ["SIIP_CACHE_DIR"] = _cache_dir
+
+
+def tearDownModule():
+    if _previous_cache_dir is None:
+        os.environ.pop("SIIP_CACHE_DIR", None)
+    else:
+        os.environ["SIIP_CACHE_DIR"] = _previous_cache_dir
+    shutil.rmtree(_cache_dir, ignore_errors=True)
+
 class JsonPayloadParserTestCase(unittest.TestCase):
 
     def tearDown(self):
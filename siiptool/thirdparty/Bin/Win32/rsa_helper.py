@@ -41,24 +41,23 @@ def pack_num(val, minlen=0):
     return buf
 
 
-def get_pubkey_from_privkey(privkey_pem):
-    """Extract public key from private key in PEM format"""
+def load_privkey(privkey_pem):
+    """Load private key in PEM format"""
 
     with open(privkey_pem, "rb") as privkey_file:
-        key = serialization.load_pem_private_key(
+        return serialization.load_pem_private_key(
             privkey_file.read(), password=None, backend=default_backend()
         )
 
-    return key.public_key()
 
+def get_pubkey_from_privkey(privkey_pem):
+    """Extract public key from private key in PEM format"""
 
-def compute_signature(data, privkey_pem):
-    """Compute signature from data"""
+    return load_privkey(privkey_pem).public_key()
 
-    with open(privkey_pem, "rb") as privkey_file:
-        key = serialization.load_pem_private_key(
-            privkey_file.read(), password=None, backend=default_backend()
-        )
+
+def compute_signature(data, key):
+    """Compute signature from data"""
 
     if key.key_size < 2048:
         raise Exception("Key size {} bits is too small.".format(key.key_size))
@@ -123,11 +122,10 @@ def main():
 
     # Prepend GUID (16B), public key modulus (256B) and signature (256B)
     if args.encode and args.privkey_file:
-        pubkey = get_pubkey_from_privkey(args.privkey_file)
-        (signature, key) = compute_signature(in_data, args.privkey_file)
+        key = load_privkey(args.privkey_file)
+        (signature, key) = compute_signature(in_data, key)
 
-        puk = get_pubkey_from_privkey(args.privkey_file)
-        puk_num = puk.public_numbers()
+        puk_num = key.public_key().public_numbers()
         mod_buf = pack_num(puk_num.n, RSA_KEYMOD_SIZE)
 
         with open(args.output_file, "wb") as out_fd: